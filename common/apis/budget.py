@@ -0,0 +1,212 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .ratelimit import QuotaExceeded
+
+# Approximate list prices of the calls in USD, by operation and SKU
+# tier (per element for the Distance Matrix API). They are only used
+# for cost ceilings, so check them against the current pricing of the
+# Maps Platform from time to time.
+CALL_COSTS = {
+    ('places:searchNearby', 'BASIC'): 0.032,
+    ('places:searchNearby', 'ADVANCED'): 0.035,
+    ('places:searchNearby', 'PREFERRED'): 0.040,
+    ('places:get', 'BASIC'): 0.005,
+    ('places:get', 'ADVANCED'): 0.020,
+    ('places:get', 'PREFERRED'): 0.025,
+    ('places:media', 'NONE'): 0.007,
+    ('distancematrix', 'NONE'): 0.005,
+}
+DEFAULT_CALL_COST = 0.005
+
+_budget = ContextVar('maps_budget', default=None)
+
+
+def get_call_cost(operation, tier, elements=1):
+    """Returns the approximate cost of a call in USD."""
+    return CALL_COSTS.get((operation, tier), DEFAULT_CALL_COST) * elements
+
+
+class BudgetExceeded(QuotaExceeded):
+    """
+    Raised when a call would exceed the budget of the current request.
+    It is a QuotaExceeded (of the request rather than of an endpoint), so
+    services degrade the same way for both.
+    """
+
+    def __init__(self, reason):
+        super().__init__(
+            None, f'The budget of the request is used up ({reason}).')
+        self.reason = reason
+
+
+class CallBudget:
+    """
+    Budget of the Maps API calls made on behalf of one request: at most
+    `max_calls` calls (counting retries), until `deadline` seconds from
+    now, for at most `max_cost` USD (see CALL_COSTS). Limits that are
+    None are not enforced.
+
+    Budgets can be nested (see call_budget); a call is charged to the
+    budget and all of its parents. Services that return partial results
+    because a call was refused (or because they hit a cap of their own)
+    mark the budget as degraded, so that the caller can tell the results
+    are best-effort. A budget that refused a call is also `exhausted`.
+    """
+
+    def __init__(self, max_calls=None, deadline=None, max_cost=None,
+                 parent=None):
+        self.max_calls = max_calls
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = time.monotonic() + deadline
+        self.max_cost = max_cost
+        self.parent = parent
+        self.calls = 0
+        self.cost = 0.0
+        self.degraded = False
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def get_remaining_time(self):
+        """
+        Returns the seconds left until the nearest deadline of the budget
+        and its parents, or None if there is none.
+        """
+        remaining = None
+        budget = self
+        while budget is not None:
+            if budget.deadline is not None:
+                left = max(0.0, budget.deadline - time.monotonic())
+                remaining = left if remaining is None else min(remaining, left)
+            budget = budget.parent
+        return remaining
+
+    def get_timeout(self, timeout):
+        """Returns the given timeout, shortened to the remaining time."""
+        remaining = self.get_remaining_time()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _check(self, cost):
+        if self.max_calls is not None and self.calls >= self.max_calls:
+            raise BudgetExceeded('too many calls')
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BudgetExceeded('deadline passed')
+        if self.max_cost is not None and self.cost + cost > self.max_cost:
+            raise BudgetExceeded('cost ceiling reached')
+
+    def charge(self, cost):
+        """
+        Charges a call of the given cost to the budget and its parents,
+        or raises BudgetExceeded (without charging anything) if any of
+        them cannot afford it.
+        """
+        chain = []
+        budget = self
+        while budget is not None:
+            chain.append(budget)
+            budget = budget.parent
+        for budget in chain:
+            budget._lock.acquire()
+        try:
+            for budget in chain:
+                try:
+                    budget._check(cost)
+                except BudgetExceeded:
+                    budget.exhausted = True
+                    raise
+            for budget in chain:
+                budget.calls += 1
+                budget.cost += cost
+        finally:
+            for budget in reversed(chain):
+                budget._lock.release()
+
+    def refund(self, cost):
+        """
+        Gives back a call of the given cost that was charged to the
+        budget and its parents (see charge) but was not made after all.
+        """
+        budget = self
+        while budget is not None:
+            with budget._lock:
+                budget.calls -= 1
+                budget.cost -= cost
+            budget = budget.parent
+
+    def mark_degraded(self):
+        budget = self
+        while budget is not None:
+            budget.degraded = True
+            budget = budget.parent
+
+
+def get_budget():
+    """Returns the budget of the current context, or None."""
+    return _budget.get()
+
+
+@contextmanager
+def call_budget(max_calls=None, deadline=None, max_cost=None):
+    """
+    Runs the block with a call budget (nested in the current one, if
+    any), and yields it. Like the priority of calls, the budget carries
+    over to tasks that copy the context.
+    """
+    budget = CallBudget(max_calls, deadline, max_cost, parent=_budget.get())
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+@contextmanager
+def use_budget(budget):
+    """
+    Runs the block with an existing budget (e.g. the one of a request)
+    as the budget of the current context.
+    """
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def charge_call(operation, tier, elements=1):
+    """
+    Charges a call to the budget of the current context, if any. Returns
+    the seconds left until its deadline, which is how long the call may
+    still wait (None if there is no deadline).
+    """
+    budget = _budget.get()
+    if budget is None:
+        return None
+    budget.charge(get_call_cost(operation, tier, elements))
+    return budget.get_remaining_time()
+
+
+def refund_call(operation, tier, elements=1):
+    """
+    Gives back a call charged with charge_call to the budget of the
+    current context (if any), when it was not made after all, e.g.
+    because the scheduler refused it.
+    """
+    budget = _budget.get()
+    if budget is not None:
+        budget.refund(get_call_cost(operation, tier, elements))
+
+
+def mark_degraded():
+    """
+    Marks the budget of the current context (if any) as degraded, when a
+    service returns partial results because a call was refused.
+    """
+    budget = _budget.get()
+    if budget is not None:
+        budget.mark_degraded()
@@ -0,0 +1,389 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from math import asin, cos, radians, sqrt
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from .maps import PLACES_V2_BASE_URL, ROUTES_BASE_URL
+from .ratelimit import LEGACY, PLACES_V2, ROUTES
+
+LEGACY_BASE_URL = 'https://maps.googleapis.com'
+# Host of the synthetic photos that photo media requests point to.
+SYNTHETIC_PHOTO_BASE_URL = 'https://photos.fake.invalid'
+PHOTOS = 'photos'
+
+# Synthetic places are laid out on a grid of cells of this size (in
+# degrees), with a fixed number of places in every cell.
+SYNTHETIC_CELL_SIZE = 0.002
+SYNTHETIC_PLACES_PER_CELL = 3
+SYNTHETIC_MAX_CELLS = 40000
+SYNTHETIC_SPEED = 8.0
+SYNTHETIC_TYPES = (
+    'cafe',
+    'restaurant',
+    'bar',
+    'bakery',
+    'museum',
+    'park',
+    'book_store',
+    'shopping_mall',
+    'tourist_attraction',
+    'art_gallery',
+)
+
+
+def _get_endpoint(url):
+    if url.startswith(SYNTHETIC_PHOTO_BASE_URL):
+        return PHOTOS
+    if url.startswith(PLACES_V2_BASE_URL):
+        return PLACES_V2
+    if url.startswith(ROUTES_BASE_URL):
+        return ROUTES
+    return LEGACY
+
+
+def get_request_key(method, url, body=None):
+    """
+    Returns the key of a request in a fixture file: the method, the path,
+    the sorted query parameters (without the API key and signature) and
+    the canonical JSON body.
+    """
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query)
+                    if k not in ('key', 'signature', 'client'))
+    if isinstance(body, bytes):
+        body = body.decode()
+    if body:
+        body = json.dumps(json.loads(body), sort_keys=True)
+    return json.dumps([method.upper(), parts.path, params, body or None])
+
+
+def _hash(*values):
+    digest = hashlib.sha1(repr(values).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def _select(place, fields):
+    if fields is None:
+        return place
+    return {f: v for f, v in place.items() if f in fields}
+
+
+def _distance(a, b):
+    lat1, lng1, lat2, lng2 = map(radians, (*a, *b))
+    h = (1 - cos(lat2 - lat1)
+         + cos(lat1) * cos(lat2) * (1 - cos(lng2 - lng1))) / 2
+    return 2 * 6371008.8 * asin(sqrt(h))
+
+
+class SyntheticMaps:
+    """
+    Generates plausible, deterministic responses for the endpoints used
+    by the services, for requests that have no recorded fixture.
+
+    Places are laid out on a fixed grid of cells covering the world, so
+    the same location always has the same places, and every place ID
+    encodes its cell. Travel times are straight-line distances at a
+    constant speed, with a detour factor.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def handle(self, method, url, body, field_mask=None):
+        path = urlsplit(url).path
+        params = dict(parse_qsl(urlsplit(url).query))
+        fields = None
+        if field_mask:
+            fields = {f.split('.')[-1] for f in field_mask.split(',')}
+        if url.startswith(SYNTHETIC_PHOTO_BASE_URL):
+            return 200, self.photo(path, params)
+        if path == '/v1/places:searchNearby':
+            return 200, self.search_nearby(json.loads(body), fields)
+        if path.startswith('/v1/places/') and path.endswith('/media'):
+            return 200, self.photo_media(path[len('/v1/'):-len('/media')],
+                                         params)
+        if path.startswith('/v1/places/'):
+            return 200, self.place(path[len('/v1/places/'):], fields)
+        if path == '/maps/api/distancematrix/json':
+            return 200, self.distance_matrix(params)
+        return 404, {'error': {'code': 404, 'status': 'NOT_FOUND'}}
+
+    def _get_place(self, cell, k):
+        i, j = cell
+        h = _hash(self.seed, i, j, k)
+        return {
+            'id': f'fake_{i}_{j}_{k}',
+            'location': {
+                'latitude': (i + (h % 1000) / 1000) * SYNTHETIC_CELL_SIZE,
+                'longitude': (j + (h // 1000 % 1000) / 1000)
+                             * SYNTHETIC_CELL_SIZE,
+            },
+            'types': [SYNTHETIC_TYPES[h // 10 ** 6 % len(SYNTHETIC_TYPES)],
+                      'point_of_interest', 'establishment'],
+            'displayName': {'text': f'Place {i}/{j}/{k}'},
+            'rating': round(1 + (h // 10 ** 8 % 41) / 10, 1),
+            'userRatingCount': h // 10 ** 10 % 5000,
+        }
+
+    def _get_location(self, place_id):
+        _, i, j, k = place_id.split('_')
+        point = self._get_place((int(i), int(j)), int(k))['location']
+        return point['latitude'], point['longitude']
+
+    def search_nearby(self, body, fields=None):
+        circle = body['locationRestriction']['circle']
+        center = (circle['center']['latitude'], circle['center']['longitude'])
+        radius = circle['radius']
+        max_count = body.get('maxResultCount', 20)
+
+        step = radius / 111320.0 / SYNTHETIC_CELL_SIZE
+        step_lng = step / max(cos(radians(center[0])), 1e-6)
+        i0 = int(center[0] // SYNTHETIC_CELL_SIZE)
+        j0 = int(center[1] // SYNTHETIC_CELL_SIZE)
+        di, dj = int(step) + 1, int(step_lng) + 1
+        if (2 * di + 1) * (2 * dj + 1) > SYNTHETIC_MAX_CELLS:
+            di = dj = int(sqrt(SYNTHETIC_MAX_CELLS)) // 2
+
+        found = []
+        for i in range(i0 - di, i0 + di + 1):
+            for j in range(j0 - dj, j0 + dj + 1):
+                for k in range(SYNTHETIC_PLACES_PER_CELL):
+                    place = self._get_place((i, j), k)
+                    point = place['location']
+                    distance = _distance(
+                        center, (point['latitude'], point['longitude']))
+                    if distance <= radius:
+                        found.append((distance, place))
+
+        if body.get('rankPreference') == 'DISTANCE':
+            found.sort(key=lambda p: p[0])
+        else:
+            found.sort(key=lambda p: -p[1]['userRatingCount'])
+        return {'places': [
+            _select(place, fields) for _, place in found[:max_count]]}
+
+    def place(self, place_id, fields=None):
+        try:
+            _, i, j, k = place_id.split('_')
+        except ValueError:
+            return {}
+        return _select(self._get_place((int(i), int(j)), int(k)), fields)
+
+    def photo_media(self, name, params):
+        query = '&'.join(f'{k}={params[k]}' for k in
+                         ('maxWidthPx', 'maxHeightPx') if k in params)
+        return {
+            'name': name,
+            'photoUri': f'{SYNTHETIC_PHOTO_BASE_URL}/{name}?{query}',
+        }
+
+    def photo(self, path, params):
+        """
+        Returns the bytes of a synthetic photo, whose size grows with
+        the requested width.
+        """
+        size = min(int(params.get('maxWidthPx', 400)), 4800) * 16
+        seed = hashlib.sha1(f'{self.seed}{path}'.encode()).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def distance_matrix(self, params):
+        def locations(value):
+            points = []
+            for waypoint in value.split('|'):
+                if waypoint.startswith('place_id:'):
+                    points.append(self._get_location(waypoint[9:]))
+                else:
+                    points.append(tuple(map(float, waypoint.split(','))))
+            return points
+
+        origins = locations(params['origins'])
+        destinations = locations(params['destinations'])
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                meters = _distance(origin, destination) * 1.3
+                elements.append({
+                    'status': 'OK',
+                    'distance': {'value': round(meters)},
+                    'duration': {'value': round(meters / SYNTHETIC_SPEED)},
+                })
+            rows.append({'elements': elements})
+        return {'status': 'OK', 'rows': rows}
+
+
+class FakeMapsBackend:
+    """
+    Stand-in for the Maps API servers (Places v2, Routes and the legacy
+    endpoints) that replays recorded responses.
+
+    Responses are looked up in the fixtures by request key (see
+    get_request_key). Requests without a fixture are answered by
+    SyntheticMaps, or with a 404 if `synthetic` is False.
+    Every response can be delayed by `latency` seconds (give or take
+    `jitter` of it), and a share of them (`error_rate`) can be replaced
+    by an error with `error_status`. The calls are counted per endpoint.
+
+    Use session() for the synchronous client and async_transport() for
+    the asynchronous one. Payloads that are bytes (e.g. photos) are
+    sent as they are, as JPEG images.
+    """
+
+    def __init__(
+        self,
+        fixtures=None,
+        synthetic=True,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_status=503,
+        seed=0,
+    ):
+        self.fixtures = dict(fixtures or {})
+        self.synthetic = SyntheticMaps(seed) if synthetic else None
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            return cls(fixtures=json.load(f), **kwargs)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _draw(self):
+        with self._lock:
+            delay = self.latency * (
+                1 + self.jitter * (2 * self._random.random() - 1))
+            failed = self._random.random() < self.error_rate
+        return max(0.0, delay), failed
+
+    def respond(self, method, url, body=None, headers=None):
+        """
+        Returns the `(delay, status, payload)` of a request, without
+        waiting for the delay.
+        """
+        with self._lock:
+            self.calls[_get_endpoint(url)] += 1
+        delay, failed = self._draw()
+        if failed:
+            return delay, self.error_status, {'error': {
+                'code': self.error_status, 'status': 'INJECTED'}}
+
+        fixture = self.fixtures.get(get_request_key(method, url, body))
+        if fixture is not None:
+            return delay, fixture['status'], fixture['body']
+        if self.synthetic is not None:
+            field_mask = (headers or {}).get('X-Goog-FieldMask')
+            return (delay,
+                    *self.synthetic.handle(method, url, body, field_mask))
+        return delay, 404, {'error': {'code': 404, 'status': 'NOT_FOUND'}}
+
+    def session(self):
+        """Returns a requests session that is served by this backend."""
+        session = requests.Session()
+        adapter = _FakeAdapter(self)
+        for base_url in (PLACES_V2_BASE_URL, ROUTES_BASE_URL, LEGACY_BASE_URL,
+                         SYNTHETIC_PHOTO_BASE_URL):
+            session.mount(base_url, adapter)
+        return session
+
+    def async_transport(self):
+        """Returns an httpx transport that is served by this backend."""
+        return _AsyncFakeTransport(self)
+
+
+class _FakeAdapter(BaseAdapter):
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def send(self, request, **kwargs):
+        delay, status, payload = self.backend.respond(
+            request.method, request.url, request.body, request.headers)
+        if delay:
+            time.sleep(delay)
+        response = requests.Response()
+        response.status_code = status
+        if isinstance(payload, bytes):
+            response._content = payload
+            response.headers['Content-Type'] = 'image/jpeg'
+        else:
+            response._content = json.dumps(payload).encode()
+            response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+
+class _AsyncFakeTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def handle_async_request(self, request):
+        delay, status, payload = self.backend.respond(
+            request.method, str(request.url), request.content,
+            request.headers)
+        if delay:
+            await asyncio.sleep(delay)
+        if isinstance(payload, bytes):
+            return httpx.Response(status, content=payload, request=request,
+                                  headers={'Content-Type': 'image/jpeg'})
+        return httpx.Response(status, json=payload, request=request)
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    A requests adapter that sends requests to the real API and records
+    the responses as fixtures for FakeMapsBackend. Mount it on the
+    session of a client, then call save() when done.
+
+    NOTE: recorded responses are stored as they are, so make sure they
+    can be shared (the API key is never part of the fixtures).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fixtures = {}
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        try:
+            payload = response.json()
+        except ValueError:
+            return response
+        key = get_request_key(request.method, request.url, request.body)
+        self.fixtures[key] = {'status': response.status_code, 'body': payload}
+        return response
+
+    def session(self):
+        session = requests.Session()
+        for base_url in (PLACES_V2_BASE_URL, ROUTES_BASE_URL, LEGACY_BASE_URL):
+            session.mount(base_url, self)
+        return session
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.fixtures, f, indent=2, sort_keys=True)
@@ -0,0 +1,209 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .instrumentation import record_hedge
+
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_MAX_HEDGE_RATE = 0.05
+DEFAULT_HEDGE_BURST = 5.0
+DEFAULT_LATENCY_WINDOW = 200
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_MIN_HEDGE_DELAY = 0.05
+# Hedged calls wait for their attempts in this pool, so it bounds the
+# number of hedged calls in flight in a process.
+MAX_HEDGE_WORKERS = 64
+
+
+class HedgePolicy:
+    """
+    Decides when to hedge a call to the Maps API, i.e. send a second,
+    identical attempt when the first one is slow, and use whichever
+    answers first.
+
+    The delay before hedging a call is the `percentile` of the latencies
+    of the last `window` attempts of the same operation (but at least
+    `min_delay` seconds), so that only the slowest calls are hedged and
+    the delay follows the current latency of the API. Calls are not
+    hedged until `min_samples` latencies were recorded.
+
+    Hedges are extra calls, so their rate is capped with a token bucket:
+    every call adds `max_rate` of a token (up to `burst` tokens) and
+    every hedge takes one, so at most about `max_rate` of the calls are
+    hedged in the long run, however slow the API gets.
+
+    NOTE: the policy is shared by the threads and event loops of a
+    process, so that all the calls learn from each other.
+    """
+
+    def __init__(
+        self,
+        percentile=DEFAULT_HEDGE_PERCENTILE,
+        max_rate=DEFAULT_MAX_HEDGE_RATE,
+        burst=DEFAULT_HEDGE_BURST,
+        window=DEFAULT_LATENCY_WINDOW,
+        min_samples=DEFAULT_MIN_SAMPLES,
+        min_delay=DEFAULT_MIN_HEDGE_DELAY,
+    ):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.burst = burst
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies = {}
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def get_delay(self, operation):
+        """
+        Returns the seconds to wait for an attempt of the operation
+        before hedging it, or None if it should not be hedged yet. Also
+        adds the share of a hedge token of the call.
+        """
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.max_rate)
+            latencies = self._latencies.get(operation)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        index = min(len(latencies) - 1,
+                    int(self.percentile * len(latencies)))
+        return max(self.min_delay, latencies[index])
+
+    def acquire(self):
+        """Takes a hedge token, and returns whether there was one."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def record(self, operation, latency):
+        """
+        Records the latency of a successful (or cancelled) attempt.
+        Failed attempts are not recorded, since errors often return
+        faster than responses.
+        """
+        with self._lock:
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = self._latencies[operation] = deque(
+                    maxlen=self.window)
+            latencies.append(latency)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=MAX_HEDGE_WORKERS,
+                    thread_name_prefix='maps-hedge',
+                )
+    return _executor
+
+
+def _measure(policy, operation, fn, *args, **kwargs):
+    started = time.monotonic()
+    result = fn(*args, **kwargs)
+    policy.record(operation, time.monotonic() - started)
+    return result
+
+
+def call_hedged(policy, endpoint, operation, fn, *args, **kwargs):
+    """
+    Calls `fn(*args, **kwargs)` from a thread, hedged according to the
+    policy: if the first attempt has not returned after the delay of
+    the policy, and the hedge rate allows it, a second attempt is made
+    from another thread, and the first result (or the error of both) is
+    returned. The attempts run in copies of the current context, so
+    they are charged to the call budget of the caller.
+
+    NOTE: threads cannot be interrupted, so the losing attempt keeps
+    running in the background, and its response is dropped.
+    """
+    delay = policy.get_delay(operation)
+    if delay is None:
+        return _measure(policy, operation, fn, *args, **kwargs)
+
+    def submit():
+        return _get_executor().submit(
+            contextvars.copy_context().run,
+            _measure, policy, operation, fn, *args, **kwargs)
+
+    primary = submit()
+    done, _ = wait([primary], timeout=delay)
+    if done or not policy.acquire():
+        return primary.result()
+
+    record_hedge(endpoint, operation, 'sent')
+    pending = {primary, submit()}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    record_hedge(endpoint, operation, 'won')
+                return future.result()
+            if future is primary or error is None:
+                error = future.exception()
+    raise error
+
+
+async def acall_hedged(policy, endpoint, operation, fn, *args, **kwargs):
+    """
+    Same as call_hedged, for coroutine functions. The losing attempt is
+    cancelled as soon as the other one returns.
+    """
+    async def attempt():
+        started = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # The attempt lost, and took at least this long, which keeps
+            # the slow attempts in the latencies.
+            policy.record(operation, time.monotonic() - started)
+            raise
+        policy.record(operation, time.monotonic() - started)
+        return result
+
+    delay = policy.get_delay(operation)
+    if delay is None:
+        return await attempt()
+
+    primary = asyncio.ensure_future(attempt())
+    try:
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not policy.acquire():
+            return await primary
+
+        record_hedge(endpoint, operation, 'sent')
+        hedge = asyncio.ensure_future(attempt())
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            record_hedge(endpoint, operation, 'won')
+                        return task.result()
+                    if task is primary or error is None:
+                        error = task.exception()
+            raise error
+        finally:
+            hedge.cancel()
+    finally:
+        primary.cancel()
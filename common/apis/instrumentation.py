@@ -0,0 +1,141 @@
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from common.metrics import Counter, Histogram
+
+UpstreamCall = namedtuple(
+    'UpstreamCall', ['endpoint', 'operation', 'tier', 'duration', 'error'])
+
+UPSTREAM_CALLS = Counter(
+    'maps_upstream_calls',
+    'Calls to the Maps API by endpoint, operation and field mask SKU tier.',
+    ['endpoint', 'operation', 'tier'],
+)
+UPSTREAM_RETRIES = Counter(
+    'maps_upstream_retries',
+    'Retried attempts of calls to the Maps API.',
+    ['endpoint', 'operation'],
+)
+UPSTREAM_ERRORS = Counter(
+    'maps_upstream_errors',
+    'Calls to the Maps API that failed, by error.',
+    ['endpoint', 'operation', 'error'],
+)
+UPSTREAM_COALESCED = Counter(
+    'maps_upstream_coalesced_calls',
+    'Calls to the Maps API that joined an identical call in flight '
+    'instead of being sent.',
+    ['endpoint', 'operation'],
+)
+UPSTREAM_HEDGES = Counter(
+    'maps_upstream_hedges',
+    'Hedged attempts of calls to the Maps API, by outcome (sent, or won '
+    'when the hedge answered first).',
+    ['endpoint', 'operation', 'outcome'],
+)
+UPSTREAM_LATENCY = Histogram(
+    'maps_upstream_duration_seconds',
+    'Latency of calls to the Maps API (including retries and rate '
+    'limiting), in seconds.',
+    ['endpoint', 'operation'],
+)
+
+_trace = ContextVar('maps_trace', default=None)
+
+
+def get_operation(url):
+    """
+    Returns the name of the operation of a Maps API path, without the
+    IDs in it, e.g. `places:get` or `distancematrix`.
+    """
+    path = url.split('?', 1)[0]
+    if path.startswith('/v1/places/') and path.endswith('/media'):
+        return 'places:media'
+    if path.startswith('/v1/places/'):
+        return 'places:get'
+    parts = [p for p in path.split('/') if p and p not in ('json', 'xml')]
+    return parts[-1] if parts else ''
+
+
+@contextmanager
+def trace_calls(calls=None):
+    """
+    Records the Maps API calls made inside the block (including the
+    ones made from tasks that copy the context) into the yielded list,
+    as UpstreamCall tuples. Pass the list of an earlier block to keep
+    adding to it.
+    """
+    if calls is None:
+        calls = []
+    token = _trace.set(calls)
+    try:
+        yield calls
+    finally:
+        _trace.reset(token)
+
+
+@contextmanager
+def instrument_call(endpoint, operation, tier):
+    """
+    Measures a call to the Maps API made inside the block, and adds it to
+    the trace of the current context (if any).
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        UPSTREAM_CALLS.inc(endpoint=endpoint, operation=operation, tier=tier)
+        UPSTREAM_LATENCY.observe(duration,
+                                 endpoint=endpoint, operation=operation)
+        if error is not None:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint, operation=operation,
+                                error=error)
+        calls = _trace.get()
+        if calls is not None:
+            calls.append(
+                UpstreamCall(endpoint, operation, tier, duration, error))
+
+
+def record_retry(endpoint, operation):
+    UPSTREAM_RETRIES.inc(endpoint=endpoint, operation=operation)
+
+
+def record_coalesced(endpoint, operation):
+    UPSTREAM_COALESCED.inc(endpoint=endpoint, operation=operation)
+
+
+def record_hedge(endpoint, operation, outcome):
+    UPSTREAM_HEDGES.inc(endpoint=endpoint, operation=operation,
+                        outcome=outcome)
+
+
+def format_trace(calls):
+    """
+    Summarizes traced calls for a response header, grouping the same
+    calls together with their count and total time, the most frequent
+    first, e.g. `places_v2 places:get BASIC x12 830ms`. Repeated calls
+    of the same operation usually point to an N+1 pattern.
+    """
+    groups = {}
+    for call in calls:
+        key = (call.endpoint, call.operation, call.tier, call.error)
+        count, duration = groups.get(key, (0, 0.0))
+        groups[key] = (count + 1, duration + call.duration)
+
+    entries = []
+    for (endpoint, operation, tier, error), (count, duration) in sorted(
+        groups.items(), key=lambda item: -item[1][0],
+    ):
+        entry = (f'{endpoint} {operation} {tier} x{count} '
+                 f'{duration * 1000:.0f}ms')
+        if error is not None:
+            entry += f' {error}'
+        entries.append(entry)
+    return ', '.join(entries)
@@ -1,4 +1,27 @@
+import asyncio
+import json
+import random
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
 from . import GOOGLE_MAPS_API_KEY as API_KEY
+from .budget import charge_call, refund_call
+from .hedging import acall_hedged, call_hedged
+from .instrumentation import (
+    get_operation,
+    instrument_call,
+    record_coalesced,
+    record_retry,
+)
+from .ratelimit import (
+    LEGACY,
+    PLACES_V2,
+    ROUTES,
+    QuotaExceeded,
+    default_scheduler,
+)
+from .singleflight import AsyncSingleFlight, SingleFlight
 from googlemaps import Client, exceptions
 
 PLACES_V2_BASE_URL = 'https://places.googleapis.com'
@@ -6,6 +29,15 @@ ROUTES_BASE_URL = 'https://routes.googleapis.com'
 
 MAX_RESTRICTION_RADIUS = 50000.0
 MAX_RESULT_COUNT = 20
+MAX_PHOTO_SIZE = 4800
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRY_TIMEOUT = 60.0
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# Same as the googlemaps client
+_RETRIABLE_STATUSES = {500, 503, 504}
 
 PLACES_V2_FIELDS_BASIC = {
     'accessibilityOptions',
@@ -83,24 +115,135 @@ def _extract_body(response):
     body = response.json()
     return body
 
-class MapsClient:
+def _get_endpoint(base_url):
+    """Returns the rate limited endpoint of a base URL."""
+    if base_url == PLACES_V2_BASE_URL:
+        return PLACES_V2
+    if base_url == ROUTES_BASE_URL:
+        return ROUTES
+    return LEGACY
+
+def get_sku_tier(headers):
     """
-    Wrapper for Google Maps API client and other utilities
+    Returns the SKU tier (BASIC, ADVANCED or PREFERRED) of a Places v2
+    request, which is the highest tier of the fields in its field mask,
+    or NONE for requests without a field mask.
+    """
+    field_mask = (headers or {}).get('X-Goog-FieldMask')
+    if not field_mask:
+        return 'NONE'
+    fields = {f.split('.')[-1] for f in field_mask.split(',')}
+    if not fields.isdisjoint(PLACES_V2_FIELDS_PREFERRED):
+        return 'PREFERRED'
+    if not fields.isdisjoint(PLACES_V2_FIELDS_ADVANCED):
+        return 'ADVANCED'
+    return 'BASIC'
 
-    The `googlemaps` package is community-supported and lacks some
-    of the newer endpoints offered by the Maps API. We have included
-    some of them in this wrapper, which we use for our services.
+def _count_elements(params):
+    """
+    Returns the number of elements of a Distance Matrix request, which
+    is what it is billed by (1 for other requests).
+    """
+    params = dict(params or {})
+    if 'origins' not in params or 'destinations' not in params:
+        return 1
+    return ((params['origins'].count('|') + 1)
+            * (params['destinations'].count('|') + 1))
 
-    We might move these to a separate package in the future.
+def _get_request_key(url, params, post_json, headers, base_url):
+    """
+    Returns the key of a Places v2 or Routes request for coalescing
+    identical requests: its endpoint, operation and arguments, and its
+    field mask (in the headers).
     """
+    return (
+        _get_endpoint(base_url),
+        get_operation(url),
+        base_url + url,
+        json.dumps([params, post_json, headers], sort_keys=True),
+    )
 
-    def __init__(self):
-        self.client = Client(key=API_KEY)
+def _record_coalesced(key):
+    record_coalesced(key[0], key[1])
+
+def _is_over_quota(e):
+    return (isinstance(e, exceptions._OverQueryLimit)
+            or isinstance(e, exceptions.HTTPError) and e.status_code == 429)
+
+class ScheduledClient(Client):
+    """
+    The `googlemaps` client, with every request (including retries)
+    admitted by a request scheduler first.
+
+    Quota errors from the API are not retried. They drain the bucket of
+    the endpoint, so that the following calls fail fast until it refills,
+    and are raised as QuotaExceeded like the ones of the scheduler.
+
+    Every call is also measured (see instrumentation), with its retries
+    counted separately, and every attempt that the scheduler admits is
+    charged to the call budget of the current request (see budget), if
+    any.
+    """
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        kwargs.setdefault('retry_over_query_limit', False)
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or default_scheduler
+
+    def _request(self, url, params, first_request_time=None, retry_counter=0,
+                 base_url=None, accepts_clientid=True, extract_body=None,
+                 requests_kwargs=None, post_json=None):
+        endpoint = _get_endpoint(base_url or self.base_url)
+        operation = get_operation(url)
+        tier = get_sku_tier((requests_kwargs or {}).get('headers'))
+        cost = (operation, tier, _count_elements(params))
+        args = (url, params, first_request_time, retry_counter, base_url,
+                accepts_clientid, extract_body, requests_kwargs, post_json)
+
+        # Retries call this method again, within the measured first call.
+        if retry_counter > 0:
+            record_retry(endpoint, operation)
+            return self._send(endpoint, cost, args)
+        with instrument_call(endpoint, operation, tier):
+            return self._send(endpoint, cost, args)
+
+    def _send(self, endpoint, cost, args):
+        max_wait = charge_call(*cost)
+        try:
+            self.scheduler.acquire(endpoint, max_wait=max_wait)
+        except BaseException:
+            # The call is not made, so it is not charged.
+            refund_call(*cost)
+            raise
+        try:
+            return super()._request(*args)
+        except (exceptions._OverQueryLimit, exceptions.HTTPError) as e:
+            if not _is_over_quota(e):
+                raise
+            self.scheduler.drain(endpoint)
+            raise QuotaExceeded(endpoint) from e
+
+class BaseMapsClient:
+    """
+    Endpoints of the Maps API that are missing from the `googlemaps`
+    package.
+
+    The methods only build the requests; sending them is left to the
+    subclasses through the _request_v2 method, which lets the same
+    endpoints be exposed by both the synchronous and the asynchronous
+    client.
+    """
+
+    def _request_v2(
+        self,
+        url,
+        params=None,
+        post_json=None,
+        headers=None,
+        base_url=PLACES_V2_BASE_URL,
+    ):
+        raise NotImplementedError
 
-    def __getattr__(self, name):
-        """Copies the methods of the client object."""
-        return getattr(self.client, name)
-    
     def place(
         self,
         place_id,
@@ -121,10 +264,24 @@ class MapsClient:
         if session_token:
             params['sessionToken'] = session_token
 
-        return self.client._request(f'/v1/places/{place_id}', {},  # No GET params
-                                    base_url=PLACES_V2_BASE_URL,
-                                    extract_body=_extract_body,
-                                    requests_kwargs={'headers': headers})
+        return self._request_v2(f'/v1/places/{place_id}',
+                                params=params,
+                                headers=headers)
+
+    def photo_media(self, name, max_width_px=None, max_height_px=None):
+        """
+        Returns the `photoUri` (in a dict with the photo `name`) of a
+        photo of a place, scaled down to fit in the given size (at least
+        one of them is required, up to MAX_PHOTO_SIZE). The photo is
+        then downloaded from that URI, which is not a billed call.
+        """
+        params = {'skipHttpRedirect': 'true'}
+        if max_width_px:
+            params['maxWidthPx'] = max_width_px
+        if max_height_px:
+            params['maxHeightPx'] = max_height_px
+
+        return self._request_v2(f'/v1/{name}/media', params=params)
 
     def places_nearby_v2(
         self,
@@ -152,8 +309,7 @@ class MapsClient:
             },
         }
         headers = {
-            'X-Goog-FieldMask': ','.join(
-                fields.map(lambda s: f'places.{s}')),
+            'X-Goog-FieldMask': ','.join(f'places.{s}' for s in fields),
         }
         
         if included_types:
@@ -173,8 +329,265 @@ class MapsClient:
         if region_code:
             params['regionCode'] = region_code
 
-        return self.client._request('/v1/places:searchNearby', {},  # No GET params
-                                    base_url=PLACES_V2_BASE_URL,
-                                    extract_body=_extract_body,
-                                    post_json=params,
-                                    requests_kwargs={'headers': headers})
+        return self._request_v2('/v1/places:searchNearby',
+                                post_json=params,
+                                headers=headers)
+
+
+class MapsClient(BaseMapsClient):
+    """
+    Wrapper for Google Maps API client and other utilities
+
+    The `googlemaps` package is community-supported and lacks some
+    of the newer endpoints offered by the Maps API. We have included
+    some of them in this wrapper, which we use for our services.
+
+    We might move these to a separate package in the future.
+
+    Every request goes through a request scheduler (the process-wide
+    one by default), which rate limits the calls per endpoint and
+    raises QuotaExceeded when the quota is used up for now.
+
+    Identical requests made by several threads at the same time (e.g.
+    for a trending place whose cache entry just expired) are coalesced
+    into one, whose response they all get (see SingleFlight).
+
+    If a HedgePolicy is given as `hedging`, the Places v2 requests (which
+    only read data, so they can safely be sent twice) are hedged: a slow
+    request gets a second attempt, and the first response wins (see
+    call_hedged).
+    """
+
+    def __init__(
+        self,
+        scheduler=None,
+        key=None,
+        requests_session=None,
+        hedging=None,
+    ):
+        self.client = ScheduledClient(key=key or API_KEY,
+                                      scheduler=scheduler,
+                                      requests_session=requests_session)
+        self.flights = SingleFlight(on_join=_record_coalesced)
+        self.hedging = hedging
+
+    def __getattr__(self, name):
+        """Copies the methods of the client object."""
+        return getattr(self.client, name)
+
+    def _request_v2(
+        self,
+        url,
+        params=None,
+        post_json=None,
+        headers=None,
+        base_url=PLACES_V2_BASE_URL,
+    ):
+        return self.flights.do(
+            _get_request_key(url, params, post_json, headers, base_url),
+            self._hedged_request,
+            url,
+            params or {},
+            base_url=base_url,
+            extract_body=_extract_body,
+            post_json=post_json,
+            requests_kwargs={'headers': headers or {}},
+        )
+
+    def _hedged_request(self, url, params, base_url, **kwargs):
+        if self.hedging is None:
+            return self.client._request(url, params, base_url=base_url,
+                                        **kwargs)
+        return call_hedged(
+            self.hedging,
+            _get_endpoint(base_url),
+            get_operation(url),
+            self.client._request,
+            url,
+            params,
+            base_url=base_url,
+            **kwargs,
+        )
+
+
+class AsyncMapsClient(BaseMapsClient):
+    """
+    Asynchronous counterpart of MapsClient, meant for serving requests
+    from the ASGI application.
+
+    Every request is sent through one shared connection pool that keeps
+    connections alive between requests, and at most `max_concurrency`
+    requests are in flight at once. The endpoint methods return
+    awaitables, and methods that are copied from the `googlemaps` client
+    run it in a worker thread so that they can be awaited as well.
+
+    Requests are rate limited by the same request scheduler as the
+    synchronous client, and identical requests made by several tasks at
+    the same time are coalesced (see AsyncSingleFlight).
+
+    Requests are hedged with the given HedgePolicy, if any, like the
+    ones of the synchronous client (see acall_hedged). Share the policy
+    of the synchronous client, so that they learn latencies together.
+
+    The client must be closed with aclose() (or used as an async context
+    manager) to release the pooled connections.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        timeout=DEFAULT_TIMEOUT,
+        retry_timeout=DEFAULT_RETRY_TIMEOUT,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+        scheduler=None,
+        transport=None,
+        hedging=None,
+    ):
+        self.scheduler = scheduler or default_scheduler
+        self.hedging = hedging
+        self.client = client or ScheduledClient(key=API_KEY,
+                                                scheduler=self.scheduler)
+        self.retry_timeout = retry_timeout
+        self.http = httpx.AsyncClient(
+            timeout=timeout,
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.flights = AsyncSingleFlight(on_join=_record_coalesced)
+
+    def __getattr__(self, name):
+        """
+        Copies the methods of the client object as coroutine functions.
+        """
+        attr = getattr(self.client, name)
+        if callable(attr):
+            return sync_to_async(attr, thread_sensitive=False)
+        return attr
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def download_media(self, url, max_bytes):
+        """
+        Downloads a media file, such as the `photoUri` of photo_media,
+        through the connection pool of the client. Returns a tuple of
+        its content and content type. Media files are not API calls, so
+        they are neither rate limited nor charged to the call budget.
+        Files larger than `max_bytes` raise TransportError.
+        """
+        try:
+            async with self._semaphore, self.http.stream(
+                'GET', url, follow_redirects=True,
+            ) as response:
+                if response.status_code != 200:
+                    raise exceptions.HTTPError(response.status_code)
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise exceptions.TransportError(
+                            'The media file is too large.')
+                    chunks.append(chunk)
+        except httpx.TimeoutException:
+            raise exceptions.Timeout()
+        except httpx.HTTPError as e:
+            raise exceptions.TransportError(e)
+        return b''.join(chunks), response.headers.get('Content-Type')
+
+    async def _request_v2(
+        self,
+        url,
+        params=None,
+        post_json=None,
+        headers=None,
+        base_url=PLACES_V2_BASE_URL,
+    ):
+        """
+        Sends a request with the API key, retrying server errors with the
+        same backoff as the `googlemaps` client until `retry_timeout`
+        seconds have passed since the first attempt.
+        """
+        return await self.flights.do(
+            _get_request_key(url, params, post_json, headers, base_url),
+            self._hedged_request_v2,
+            url, params, post_json, headers, base_url,
+        )
+
+    async def _hedged_request_v2(self, url, params, post_json, headers,
+                                 base_url):
+        args = (url, params, post_json, headers, base_url)
+        if self.hedging is None:
+            return await self._instrumented_request_v2(*args)
+        return await acall_hedged(
+            self.hedging,
+            _get_endpoint(base_url),
+            get_operation(url),
+            self._instrumented_request_v2,
+            *args,
+        )
+
+    async def _instrumented_request_v2(self, url, params, post_json, headers,
+                                       base_url):
+        endpoint = _get_endpoint(base_url)
+        operation = get_operation(url)
+        tier = get_sku_tier(headers)
+        with instrument_call(endpoint, operation, tier):
+            return await self._send_v2(endpoint, operation, tier, url,
+                                       params, post_json, headers, base_url)
+
+    async def _send_v2(self, endpoint, operation, tier, url, params,
+                       post_json, headers, base_url):
+        params = {**(params or {}), 'key': self.client.key}
+        method = 'GET' if post_json is None else 'POST'
+        first_request_time = time.monotonic()
+        retry_counter = 0
+
+        while True:
+            if retry_counter > 0:
+                record_retry(endpoint, operation)
+                if time.monotonic() - first_request_time > self.retry_timeout:
+                    raise exceptions.Timeout()
+                delay_seconds = 0.5 * 1.5 ** (retry_counter - 1)
+                await asyncio.sleep(delay_seconds * (random.random() + 0.5))
+
+            max_wait = charge_call(operation, tier)
+            try:
+                await self.scheduler.acquire_async(
+                    endpoint, max_wait=max_wait)
+            except BaseException:
+                # The call is not made (or cancelled while waiting), so
+                # it is not charged.
+                refund_call(operation, tier)
+                raise
+            try:
+                async with self._semaphore:
+                    response = await self.http.request(
+                        method,
+                        base_url + url,
+                        params=params,
+                        json=post_json,
+                        headers=headers,
+                    )
+            except httpx.TimeoutException:
+                raise exceptions.Timeout()
+            except httpx.HTTPError as e:
+                raise exceptions.TransportError(e)
+
+            if response.status_code == 429:
+                self.scheduler.drain(endpoint)
+                raise QuotaExceeded(endpoint)
+            if response.status_code not in _RETRIABLE_STATUSES:
+                return _extract_body(response)
+            retry_counter += 1
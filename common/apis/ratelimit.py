@@ -0,0 +1,282 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from googlemaps import exceptions
+
+# Endpoints (groups of upstream APIs) with separate quotas
+PLACES_V2 = 'places_v2'
+ROUTES = 'routes'
+LEGACY = 'legacy'
+
+# Priorities of outbound calls, from the most urgent
+INTERACTIVE = 0
+BACKGROUND = 1
+PREFETCH = 2
+
+# `(rate, capacity)` of the token bucket of every endpoint, where the
+# rate is in calls per second. These stay below the default per-minute
+# quotas of the APIs (e.g. 600 per minute for each Places v2 method).
+DEFAULT_RATE_LIMITS = {
+    PLACES_V2: (10.0, 20.0),
+    ROUTES: (50.0, 50.0),
+    LEGACY: (50.0, 50.0),
+}
+
+# How long a call of every priority may wait for a token. A call that
+# would have to wait longer fails right away instead.
+DEFAULT_MAX_WAITS = {
+    INTERACTIVE: 0.5,
+    BACKGROUND: 5.0,
+    PREFETCH: 30.0,
+}
+
+_priority = ContextVar('maps_priority', default=INTERACTIVE)
+
+
+class QuotaExceeded(exceptions.ApiError):
+    """
+    Raised when an outbound call is refused by the scheduler because the
+    quota of its endpoint is used up for now. Callers may fall back to
+    cached data.
+    """
+
+    def __init__(self, endpoint, message=None):
+        super().__init__(
+            'OVER_QUERY_LIMIT',
+            message or f'The {endpoint} quota is used up for now.')
+        self.endpoint = endpoint
+
+
+def get_priority():
+    """Returns the priority of the outbound calls of the current context."""
+    return _priority.get()
+
+
+@contextmanager
+def priority(level):
+    """
+    Runs the outbound calls made inside the block with the given
+    priority. The priority is stored in a context variable, so it also
+    applies to calls made from tasks that copy the context (such as
+    sync_to_async and the geodata thread pool).
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket that is refilled at `rate` tokens per second, up to
+    `capacity` tokens. It is not thread-safe on its own.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def get_wait(self, count=1):
+        """Returns how many seconds it takes to have `count` tokens."""
+        return max(0.0, (count - self.tokens) / self.rate)
+
+
+class _Endpoint:
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.waiters = []
+        self.condition = threading.Condition()
+        # Wake up the coroutines waiting in the queue, which cannot wait
+        # on the condition.
+        self.wakers = set()
+
+    def notify_all(self):
+        """Wakes up every waiter. Must be called with the lock."""
+        self.condition.notify_all()
+        for wake in self.wakers:
+            wake()
+
+
+class RequestScheduler:
+    """
+    Admits outbound Maps API calls according to a token bucket per
+    endpoint, so that traffic spikes are smoothed out in the process
+    instead of being rejected upstream (where the client would retry
+    with a backoff of several seconds).
+
+    Calls that cannot be admitted right away wait in a priority queue,
+    so interactive calls go ahead of background and prefetch work. A
+    call never waits longer than the maximum wait of its priority: if
+    the tokens it would need will not be available in time, it fails
+    right away with QuotaExceeded.
+
+    NOTE: the buckets are per process, so the limits should be divided
+    by the number of worker processes.
+    """
+
+    def __init__(self, rate_limits=None, max_waits=None):
+        self.max_waits = {**DEFAULT_MAX_WAITS, **(max_waits or {})}
+        self._endpoints = {
+            endpoint: _Endpoint(rate, capacity)
+            for endpoint, (rate, capacity)
+            in {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}.items()
+        }
+        self._counter = itertools.count()
+
+    def try_acquire(self, endpoint, priority=None):
+        """
+        Takes a token of the endpoint if one is available and no call of
+        the same or higher priority is waiting. Returns whether it did.
+        """
+        if priority is None:
+            priority = get_priority()
+        state = self._endpoints[endpoint]
+        with state.condition:
+            state.bucket.refill(time.monotonic())
+            if (state.bucket.tokens >= 1
+                    and not any(w[0] <= priority for w in state.waiters)):
+                state.bucket.tokens -= 1
+                return True
+        return False
+
+    def _get_max_wait(self, priority, max_wait):
+        if max_wait is None or max_wait > self.max_waits[priority]:
+            return self.max_waits[priority]
+        return max_wait
+
+    def _enqueue(self, endpoint, state, priority, max_wait):
+        """
+        Takes a token right away if the call may have one, and returns
+        None. Otherwise, adds the call to the queue and returns its
+        waiter, or raises QuotaExceeded if the call would wait too long.
+        Must be called with the lock.
+        """
+        bucket = state.bucket
+        bucket.refill(time.monotonic())
+        ahead = sum(1 for w in state.waiters if w[0] <= priority)
+        if not ahead and bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return None
+        if bucket.get_wait(ahead + 1) > max_wait:
+            raise QuotaExceeded(endpoint)
+        waiter = (priority, next(self._counter))
+        heapq.heappush(state.waiters, waiter)
+        return waiter
+
+    def _dequeue(self, endpoint, state, waiter, deadline):
+        """
+        Takes a token if the waiter is next in the queue and one is
+        available, and returns None. Otherwise, returns how many seconds
+        to wait before trying again (unless woken up), or raises
+        QuotaExceeded past the deadline. Must be called with the lock.
+        """
+        now = time.monotonic()
+        bucket = state.bucket
+        bucket.refill(now)
+        is_next = state.waiters[0] == waiter
+        if is_next and bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return None
+        if now >= deadline:
+            raise QuotaExceeded(endpoint)
+        timeout = deadline - now
+        if is_next:
+            timeout = min(timeout, bucket.get_wait())
+        return timeout
+
+    def _leave(self, state, waiter):
+        """Removes a waiter from the queue. Must be called with the lock."""
+        state.waiters.remove(waiter)
+        heapq.heapify(state.waiters)
+        state.notify_all()
+
+    def acquire(self, endpoint, priority=None, max_wait=None):
+        """
+        Waits for a token of the endpoint, or raises QuotaExceeded if it
+        cannot be given one within the maximum wait of the priority (the
+        priority of the current context by default), or within `max_wait`
+        seconds if that is shorter.
+        """
+        if priority is None:
+            priority = get_priority()
+        max_wait = self._get_max_wait(priority, max_wait)
+        state = self._endpoints[endpoint]
+
+        with state.condition:
+            deadline = time.monotonic() + max_wait
+            waiter = self._enqueue(endpoint, state, priority, max_wait)
+            if waiter is None:
+                return
+            try:
+                while True:
+                    timeout = self._dequeue(endpoint, state, waiter, deadline)
+                    if timeout is None:
+                        return
+                    state.condition.wait(timeout)
+            finally:
+                self._leave(state, waiter)
+
+    async def acquire_async(self, endpoint, priority=None, max_wait=None):
+        """
+        Same as acquire, for coroutines. The call waits in the same queue
+        as the synchronous calls, but on the event loop: it sleeps until
+        its token should be available, or until the queue changes.
+        """
+        if priority is None:
+            priority = get_priority()
+        max_wait = self._get_max_wait(priority, max_wait)
+        state = self._endpoints[endpoint]
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(woken.set)
+
+        with state.condition:
+            deadline = time.monotonic() + max_wait
+            waiter = self._enqueue(endpoint, state, priority, max_wait)
+            if waiter is None:
+                return
+            state.wakers.add(wake)
+        try:
+            while True:
+                with state.condition:
+                    timeout = self._dequeue(endpoint, state, waiter, deadline)
+                    if timeout is None:
+                        return
+                    woken.clear()
+                try:
+                    await asyncio.wait_for(woken.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with state.condition:
+                state.wakers.discard(wake)
+                self._leave(state, waiter)
+
+    def drain(self, endpoint):
+        """
+        Empties the bucket of an endpoint, e.g. after the upstream API
+        reported that the quota is exceeded anyway.
+        """
+        state = self._endpoints[endpoint]
+        with state.condition:
+            state.bucket.refill(time.monotonic())
+            state.bucket.tokens = min(state.bucket.tokens, 0.0)
+
+
+default_scheduler = RequestScheduler()
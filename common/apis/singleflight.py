@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+from .budget import BudgetExceeded
+
+
+def _is_shared(error):
+    # A call refused by the budget of the leader might be allowed by the
+    # budget of a follower, so followers make such calls themselves.
+    return not isinstance(error, BudgetExceeded)
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls made concurrently from several threads:
+    the first caller of a key (the leader) makes the call, and the
+    callers that arrive while it is in flight wait for it and get the
+    same result, or the same exception. The key is forgotten as soon as
+    the call is done, so nothing is cached.
+
+    If given, `on_join(key)` is called whenever a caller joins a call in
+    flight instead of making its own, e.g. to count coalesced calls.
+
+    NOTE: every caller gets the same result object, which must not be
+    modified.
+    """
+
+    def __init__(self, on_join=None):
+        self.on_join = on_join
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Calls `fn(*args, **kwargs)`, unless a call with the same key is
+        already in flight, in which case its result is returned.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader and self.on_join is not None:
+            self.on_join(key)
+        if is_leader:
+            try:
+                call.result = fn(*args, **kwargs)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        call.done.wait()
+        if call.error is not None:
+            if not _is_shared(call.error):
+                return fn(*args, **kwargs)
+            raise call.error
+        return call.result
+
+
+class _AsyncCall:
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Same as SingleFlight, for coroutines of one event loop. The call
+    runs as a task of its own, in the context of the leader, so that
+    callers can give up on it (e.g. on a timeout) without cancelling it
+    for the others. It is only cancelled once all of them have.
+    """
+
+    def __init__(self, on_join=None):
+        self.on_join = on_join
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Awaits `fn(*args, **kwargs)`, unless a call with the same key is
+        already in flight, in which case its result is returned.
+        """
+        call = self._calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = self._calls[key] = _AsyncCall(
+                asyncio.ensure_future(fn(*args, **kwargs)))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        elif self.on_join is not None:
+            self.on_join(key)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except Exception as e:
+            if is_leader or _is_shared(e):
+                raise
+            return await fn(*args, **kwargs)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,177 @@
+import threading
+from bisect import bisect_left
+from math import inf
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, inf,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + labels + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f'{self.name} takes the labels {self.labelnames}.')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+
+class Counter(_Metric):
+    """A counter with labels, e.g. the number of calls per endpoint."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def items(self):
+        """Returns a list of `(label values, value)` tuples."""
+        with self._lock:
+            return list(self._values.items())
+
+    def _render_samples(self, items):
+        for key, value in items:
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_total{labels} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    """
+    A histogram with labels and fixed buckets, e.g. of call latencies in
+    seconds. The last bucket must be infinite.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_samples(self, items):
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    self.labelnames, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+class Gauge(_Metric):
+    """
+    A gauge whose values are computed when the metrics are exported, by
+    a callback returning a dict that maps label value tuples to values.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None,
+                 registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def render(self):
+        with self._lock:
+            self._values = {
+                tuple(map(str, key)): value
+                for key, value in self.callback().items()
+            }
+        return super().render()
+
+    def _render_samples(self, items):
+        for key, value in items:
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Registry:
+    """
+    A set of metrics that are exported together in the Prometheus text
+    format.
+
+    NOTE: metrics are kept in the memory of each process, so every
+    worker process exports its own values (which Prometheus sums up
+    when they are scraped as separate targets or instances).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'{metric.name} is already registered.')
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = Registry()
@@ -52,6 +52,48 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.CallBudgetMiddleware',
+    'core.middleware.UpstreamTraceMiddleware',
+]
+
+# Budget of Maps API calls of every request (see common.apis.budget):
+# the maximum number of calls, the deadline in seconds and the maximum
+# cost in USD. Services return partial results when it runs out.
+#
+# The endpoints also cap their own calls (`max_api_calls`), and the
+# budget is only a backstop, so it has to cover the largest request of
+# every endpoint or their caps are never reached: MAX_DETAILS_BATCH
+# (100) place details, i.e. 100 calls and 2.5 USD at the PREFERRED tier,
+# DEFAULT_MAX_TILING_CALLS (32) nearby searches for 1.28 USD, or the
+# travel times between 20 places (400 matrix elements) for 2 USD. Lower
+# it to make the caps stricter for every endpoint at once.
+UPSTREAM_BUDGET = {
+    'max_calls': int(env.get('DJ_UPSTREAM_MAX_CALLS', 128)),
+    'deadline': float(env.get('DJ_UPSTREAM_DEADLINE', 8.0)),
+    'max_cost': float(env.get('DJ_UPSTREAM_MAX_COST', 3.0)),
+}
+
+# Hedging of the Places API calls (see common.apis.hedging): a call that
+# is slower than the given percentile of the recent ones gets a second
+# attempt, for at most `max_rate` of the calls. Disabled by default.
+UPSTREAM_HEDGING = None
+if env.get('DJ_UPSTREAM_HEDGING') == 'True':
+    UPSTREAM_HEDGING = {
+        'percentile': float(env.get('DJ_UPSTREAM_HEDGE_PERCENTILE', 0.95)),
+        'max_rate': float(env.get('DJ_UPSTREAM_HEDGE_RATE', 0.05)),
+    }
+
+# Lists the Maps API calls made by each request in the response headers,
+# or in the `core.upstream` log for streaming responses (see
+# core.middleware.UpstreamTraceMiddleware).
+UPSTREAM_TRACE = (env.get('DJ_UPSTREAM_TRACE') == 'True')
+
+# Addresses that may scrape the metrics of the process (see
+# core.views.metrics), as a comma-separated list.
+METRICS_ALLOWED_IPS = [
+    ip.strip()
+    for ip in env.get('DJ_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+    if ip.strip()
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -90,6 +132,68 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+# The `geodata` cache is shared between workers and holds responses from
+# the Maps API. Run `python manage.py createcachetable` to create it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'geodata': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'geodata_cache',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        },
+    },
+}
+
+# Place photos are cached on disk (see geodata.services.photos), up to
+# the given size in bytes.
+GEODATA_PHOTO_CACHE_DIR = (env.get('DJ_PHOTO_CACHE_DIR')
+                           or str(BASE_DIR / 'photo_cache'))
+GEODATA_PHOTO_CACHE_MAX_BYTES = int(
+    env.get('DJ_PHOTO_CACHE_MAX_BYTES', 1024 ** 3))
+
+
+# Geodata cache warming
+
+# The nearby queries of the geodata endpoints are logged to this file (if
+# set), which the warm_cache command reads to find the hot regions.
+QUERY_LOG = env.get('DJ_QUERY_LOG')
+
+if QUERY_LOG:
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'query': {'format': '%(asctime)s %(message)s'},
+        },
+        'handlers': {
+            'query_log': {
+                'class': 'logging.handlers.WatchedFileHandler',
+                'filename': QUERY_LOG,
+                'formatter': 'query',
+            },
+        },
+        'loggers': {
+            'geodata.queries': {
+                'handlers': ['query_log'],
+                'level': 'INFO',
+                'propagate': False,
+            },
+        },
+    }
+
+# Regions that the warm_cache command always keeps warm, as
+# `(latitude, longitude)` or `(latitude, longitude, radius)` tuples.
+GEODATA_HOT_LOCATIONS = []
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
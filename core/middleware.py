@@ -0,0 +1,154 @@
+import logging
+from contextlib import aclosing
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse
+
+from common.apis.budget import call_budget, use_budget
+from common.apis.instrumentation import format_trace, trace_calls
+
+UPSTREAM_CALLS_HEADER = 'X-Upstream-Calls'
+UPSTREAM_TRACE_HEADER = 'X-Upstream-Trace'
+PARTIAL_RESULTS_HEADER = 'X-Partial-Results'
+
+trace_logger = logging.getLogger('core.upstream')
+
+
+def _wrap_stream(response, get_context, on_close=None):
+    """
+    Makes the body of a streaming response run inside the context
+    manager returned by `get_context()`, since it is only consumed after
+    the middleware has returned, and calls `on_close()` once it is sent.
+    Returns whether the body was wrapped.
+
+    NOTE: file responses are left alone, so that they can still be sent
+    with sendfile; their bodies are read from disk and never call the
+    Maps API.
+    """
+    if not response.streaming or isinstance(response, FileResponse):
+        return False
+    content = response.streaming_content
+
+    if response.is_async:
+        async def wrapped():
+            try:
+                with get_context():
+                    async with aclosing(content):
+                        async for chunk in content:
+                            yield chunk
+            finally:
+                if on_close is not None:
+                    on_close()
+    else:
+        def wrapped():
+            try:
+                with get_context():
+                    yield from content
+            finally:
+                if on_close is not None:
+                    on_close()
+
+    response.streaming_content = wrapped()
+    return True
+
+
+class CallBudgetMiddleware:
+    """
+    Gives every request a budget of Maps API calls (see CallBudget),
+    from the UPSTREAM_BUDGET setting, so that a single expensive request
+    cannot hold a worker for long. When the budget runs out, services
+    return partial results, and the response gets a header saying so.
+
+    The budget also covers the body of streaming responses. Their
+    headers are sent before the body, so they never get the header;
+    streams say whether they are partial in their last line instead.
+
+    The budget is available to views as `request.call_budget`.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.budget = getattr(settings, 'UPSTREAM_BUDGET', None)
+        if not self.budget:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with call_budget(**self.budget) as budget:
+            request.call_budget = budget
+            response = self.get_response(request)
+        return self.process_response(response, budget)
+
+    async def __acall__(self, request):
+        with call_budget(**self.budget) as budget:
+            request.call_budget = budget
+            response = await self.get_response(request)
+        return self.process_response(response, budget)
+
+    def process_response(self, response, budget):
+        if _wrap_stream(response, lambda: use_budget(budget)):
+            return response
+        if budget.degraded:
+            response[PARTIAL_RESULTS_HEADER] = 'true'
+        return response
+
+
+class UpstreamTraceMiddleware:
+    """
+    Adds headers listing the Maps API calls made while handling each
+    request: their number, and a summary grouped by endpoint, operation
+    and SKU tier (see format_trace). This makes N+1 patterns easy to
+    spot, since they show up as one operation repeated many times.
+
+    The calls of a streaming response are only known once its body is
+    sent, after its headers, so they are logged to the `core.upstream`
+    logger (at the INFO level) instead.
+
+    Only enabled when the UPSTREAM_TRACE setting is True.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'UPSTREAM_TRACE', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with trace_calls() as calls:
+            response = self.get_response(request)
+        return self.process_response(request, response, calls)
+
+    async def __acall__(self, request):
+        with trace_calls() as calls:
+            response = await self.get_response(request)
+        return self.process_response(request, response, calls)
+
+    def process_response(self, request, response, calls):
+        def log_trace():
+            trace_logger.info(
+                '%s %s: %d upstream calls%s', request.method,
+                request.path, len(calls),
+                f' ({format_trace(calls)})' if calls else '')
+
+        if _wrap_stream(response, lambda: trace_calls(calls), log_trace):
+            return response
+        response[UPSTREAM_CALLS_HEADER] = str(len(calls))
+        if calls:
+            response[UPSTREAM_TRACE_HEADER] = format_trace(calls)
+        return response
@@ -3,4 +3,5 @@ from . import views
   
 urlpatterns = [ 
     path('ping/', views.pong),
+    path('metrics/', views.metrics),
 ]
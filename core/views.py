@@ -1,6 +1,28 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from common.metrics import CONTENT_TYPE, default_registry
+
+# Imported for the metrics they register.
+import common.apis.instrumentation  # noqa: F401
+import geodata.services.metrics  # noqa: F401
+
 @api_view()
 def pong(request):
     return Response({"message": "pong"})
+
+@require_GET
+def metrics(request):
+    """
+    Exports the metrics of this process in the Prometheus text format,
+    only to the addresses in the METRICS_ALLOWED_IPS setting.
+
+    NOTE: behind a reverse proxy, the address is the one of the proxy,
+    so the proxy should not forward this route.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(default_registry.render(), content_type=CONTENT_TYPE)
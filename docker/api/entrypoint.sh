@@ -2,5 +2,6 @@
 
 python manage.py makemigrations
 python manage.py migrate
+python manage.py createcachetable
 
 exec "$@"
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import time
+from math import floor
+
+from django.core.cache import caches
+
+from .services.cache import GEODATA_CACHE_ALIAS, NEARBY_SHARED_TTL
+from .services.scoring import get_compiled_preferences
+
+RESPONSE_CACHE_TTL = 10 * 60
+# Cached nearby searches expire within this time, so responses computed
+# from them are not reused past the end of the window either.
+DATA_EPOCH_WINDOW = NEARBY_SHARED_TTL
+DATA_EPOCH_KEY = 'geodata:epoch'
+
+
+class ResponseCache():
+    """
+    Shared cache of the responses of the geodata endpoints, which change
+    slowly while mobile clients poll them often.
+
+    A response is keyed by the endpoint, its quantized query (see the
+    views), the digest of the compiled preferences of the user and the
+    data epoch, so users with the same preferences share responses and
+    users with different ones never do. The key doubles as the ETag of
+    the response, so a client that already has the response gets a 304
+    without anything being computed.
+
+    The data epoch is the start of the current window of
+    DATA_EPOCH_WINDOW seconds, or the last time it was bumped (e.g.
+    after a bulk import of places), whichever is later.
+
+    NOTE: only complete responses are stored, so a request whose
+    response was partial is computed again next time.
+    """
+
+    def __init__(
+        self,
+        ttl=RESPONSE_CACHE_TTL,
+        epoch_window=DATA_EPOCH_WINDOW,
+        cache_alias=GEODATA_CACHE_ALIAS,
+    ):
+        self.ttl = ttl
+        self.epoch_window = epoch_window
+        self.cache_alias = cache_alias
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def get_data_epoch(self):
+        """Returns the start of the data epoch as a Unix timestamp."""
+        window = floor(time.time() / self.epoch_window) * self.epoch_window
+        return max(window, self.shared.get(DATA_EPOCH_KEY, 0))
+
+    def bump_data_epoch(self):
+        """
+        Starts a new data epoch, so that every cached response becomes
+        stale.
+        """
+        self.shared.set(DATA_EPOCH_KEY, floor(time.time()), timeout=None)
+
+    def get_validators(self, name, query, user):
+        """
+        Returns the `(etag, last_modified)` of the response of an
+        endpoint to a quantized query (a JSON-serializable dict) for the
+        given user, where `last_modified` is a Unix timestamp.
+        """
+        epoch = self.get_data_epoch()
+        preferences = get_compiled_preferences(user).digest
+        key = json.dumps([name, query, preferences, epoch], sort_keys=True)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        # Preferences only change when the user is updated.
+        updated_at = 0
+        if user.pk is not None:
+            updated_at = floor(user.updated_at.timestamp())
+        return f'"{digest}"', max(epoch, updated_at)
+
+    def _key(self, etag):
+        return 'response:' + etag.strip('"')
+
+    def lookup(self, name, query, user):
+        """
+        Returns the ETag and Last-Modified (see get_validators) of a
+        response, and its stored body (or None if it is not stored).
+        """
+        etag, last_modified = self.get_validators(name, query, user)
+        return etag, last_modified, self.shared.get(self._key(etag))
+
+    def set(self, etag, body):
+        self.shared.set(self._key(etag), body, timeout=self.ttl)
+
+
+response_cache = ResponseCache()
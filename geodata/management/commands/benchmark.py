@@ -0,0 +1,333 @@
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from statistics import median
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from common.apis.fake import FakeMapsBackend, SyntheticMaps
+from common.apis.maps import MapsClient
+from common.apis.ratelimit import LEGACY, PLACES_V2, ROUTES, RequestScheduler
+from geodata.services.cache import NearbySearchCache, PlaceDetailsCache
+from geodata.services.matrix import TravelTimeMatrixService
+from geodata.services.places import PlacesService
+from geodata.services.planning import plan_routes
+from geodata.services.routes import RoutesService
+from users.models import User
+
+BENCHMARK_CACHE_ALIAS = 'geodata_benchmark'
+DEFAULT_LOCATION = (-6.2, 106.816666)
+DEFAULT_REPEAT = 5
+DEFAULT_OUTPUT = 'benchmarks.json'
+
+# Same for every run, so that results are comparable between commits.
+BENCHMARK_PREFERENCES = {
+    'cafe': True,
+    'museum': True,
+    'park': True,
+    'bar': False,
+    'shopping_mall': False,
+}
+
+_UNLIMITED = (1e9, 1e9)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. A benchmark is a function that takes the
+    environment, sets up a fresh state and returns the callable to
+    measure, so that setting up is never measured.
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class _NullPlaceStore:
+    """Keeps benchmarks from writing fake places into the database."""
+
+    def ingest(self, places):
+        pass
+
+
+class BenchmarkEnvironment:
+    """
+    Builds services that talk to the fake Maps backend and use caches
+    of their own, so that every benchmark run starts cold.
+    """
+
+    def __init__(self, backend, location):
+        self.backend = backend
+        self.location = location
+        self.maps_client = MapsClient(
+            scheduler=RequestScheduler(rate_limits={
+                PLACES_V2: _UNLIMITED,
+                ROUTES: _UNLIMITED,
+                LEGACY: _UNLIMITED,
+            }),
+            key='AIzaBenchmarkKey',
+            requests_session=backend.session(),
+        )
+        self.synthetic = SyntheticMaps()
+
+    def get_session(self):
+        return {'user': User(preferences=BENCHMARK_PREFERENCES)}
+
+    def get_places_service(self):
+        return PlacesService(
+            self.maps_client,
+            self.get_session(),
+            place_cache=PlaceDetailsCache(cache_alias=BENCHMARK_CACHE_ALIAS),
+            nearby_cache=NearbySearchCache(cache_alias=BENCHMARK_CACHE_ALIAS),
+            place_store=_NullPlaceStore(),
+        )
+
+    def get_routes_service(self):
+        return RoutesService(
+            self.maps_client,
+            self.get_session(),
+            matrix_service=TravelTimeMatrixService(
+                cache_alias=BENCHMARK_CACHE_ALIAS),
+            places_service=self.get_places_service(),
+        )
+
+    def get_places(self, radius, count):
+        """Returns synthetic place dicts around the location."""
+        center = {'latitude': self.location[0], 'longitude': self.location[1]}
+        body = {
+            'locationRestriction': {
+                'circle': {'center': center, 'radius': radius},
+            },
+            'maxResultCount': count,
+            'rankPreference': 'DISTANCE',
+        }
+        return self.synthetic.search_nearby(body, {'id', 'location', 'types'})[
+            'places']
+
+    def get_travel_times(self, places):
+        points = np.array([(p['location']['latitude'],
+                            p['location']['longitude']) for p in places])
+        meters = np.linalg.norm(points[:, None] - points[None, :], axis=2)
+        return meters * 111320.0 * 1.3 / 8.0
+
+
+@benchmark('nearby_places_sorted_cold')
+def bench_nearby_places_sorted_cold(env):
+    service = env.get_places_service()
+    return lambda: service.get_nearby_places_sorted(env.location, 1000.0)
+
+
+@benchmark('nearby_places_sorted_warm')
+def bench_nearby_places_sorted_warm(env):
+    service = env.get_places_service()
+    service.get_nearby_places_sorted(env.location, 1000.0)
+    return lambda: service.get_nearby_places_sorted(env.location, 1000.0)
+
+
+@benchmark('sort_places_by_preference')
+def bench_sort_places_by_preference(env):
+    places = env.get_places(5000.0, 5000)
+    service = env.get_places_service()
+    return lambda: service.sort_places_by_preference(places)
+
+
+@benchmark('plan_routes_held_karp')
+def bench_plan_routes_held_karp(env):
+    costs = env.get_travel_times(env.get_places(3000.0, 10))
+    return lambda: plan_routes(costs, [0, 1], list(range(2, 10)), 3)
+
+
+@benchmark('plan_routes_local_search')
+def bench_plan_routes_local_search(env):
+    costs = env.get_travel_times(env.get_places(5000.0, 30))
+    return lambda: plan_routes(costs, [0, 1], list(range(2, 30)), 3)
+
+
+@benchmark('best_planned_routes_cold')
+def bench_best_planned_routes_cold(env):
+    place_ids = [p['id'] for p in env.get_places(3000.0, 12)]
+    service = env.get_routes_service()
+    return lambda: service.get_best_planned_routes(
+        place_ids[:2], place_ids[2:])
+
+
+@benchmark('add_places_into_planned_route')
+def bench_add_places_into_planned_route(env):
+    place_ids = [p['id'] for p in env.get_places(3000.0, 30)]
+    service = env.get_routes_service()
+    route = service.get_best_planned_routes(place_ids[:2], place_ids[2:8])[0]
+    return lambda: service.add_places_into_planned_route(place_ids[8:], route)
+
+
+def run_benchmark(env, setup, repeat):
+    """
+    Runs a benchmark `repeat` times and returns its results: the wall
+    times, the upstream calls per run by endpoint and the allocations of
+    one more run. Allocations are traced in a separate run, since
+    tracing slows everything down. The benchmark cache is cleared before
+    every run.
+    """
+    times = []
+    calls = Counter()
+    for _ in range(repeat):
+        caches[BENCHMARK_CACHE_ALIAS].clear()
+        run = setup(env)
+        env.backend.reset()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        calls.update(env.backend.calls)
+
+    caches[BENCHMARK_CACHE_ALIAS].clear()
+    run = setup(env)
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_time': {
+            'min': min(times),
+            'median': median(times),
+            'max': max(times),
+        },
+        'upstream_calls': {k: v / repeat for k, v in sorted(calls.items())},
+        'allocations': {
+            'peak_bytes': peak,
+            'retained_bytes': current,
+        },
+    }
+
+
+def _get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the geodata services against a fake Maps backend, '
+        'which replays recorded responses (or synthetic ones), and '
+        'writes the results to a JSON file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help='Benchmarks to run (all by default).')
+        parser.add_argument('--fixtures',
+                            help='JSON file of recorded responses.')
+        parser.add_argument('--no-synthetic', action='store_true',
+                            help='Answer requests without a fixture '
+                                 'with a 404.')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Latency of the fake backend in seconds.')
+        parser.add_argument('--jitter', type=float, default=0.0,
+                            help='Jitter of the latency, as a ratio.')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Share of responses replaced by errors.')
+        parser.add_argument('--error-status', type=int, default=503)
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                            help='File to write the results to.')
+        parser.add_argument('--compare',
+                            help='Results file of a previous run to '
+                                 'compare with.')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        unknown = [n for n in names if n not in BENCHMARKS]
+        if unknown:
+            raise CommandError(f'Unknown benchmarks: {", ".join(unknown)}')
+
+        backend_kwargs = {
+            'synthetic': not options['no_synthetic'],
+            'latency': options['latency'],
+            'jitter': options['jitter'],
+            'error_rate': options['error_rate'],
+            'error_status': options['error_status'],
+            'seed': options['seed'],
+        }
+        if options['fixtures']:
+            backend = FakeMapsBackend.from_file(
+                options['fixtures'], **backend_kwargs)
+        else:
+            backend = FakeMapsBackend(**backend_kwargs)
+
+        caches_setting = {
+            **settings.CACHES,
+            BENCHMARK_CACHE_ALIAS: {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': BENCHMARK_CACHE_ALIAS,
+                'OPTIONS': {'MAX_ENTRIES': 1000000},
+            },
+        }
+
+        results = {}
+        with override_settings(CACHES=caches_setting):
+            env = BenchmarkEnvironment(backend, DEFAULT_LOCATION)
+            for name in names:
+                results[name] = run_benchmark(
+                    env, BENCHMARKS[name], options['repeat'])
+                self._print_result(name, results[name])
+
+        report = {
+            'commit': _get_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'options': {'repeat': options['repeat'], **backend_kwargs},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f'Results written to {options["output"]}.')
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self._print_comparison(json.load(f), report)
+
+    def _print_result(self, name, result):
+        calls = sum(result['upstream_calls'].values())
+        self.stdout.write(
+            f'{name:32} '
+            f'{result["wall_time"]["median"] * 1000:10.2f} ms '
+            f'{calls:8.1f} calls '
+            f'{result["allocations"]["peak_bytes"] / 1024:10.1f} KiB peak'
+        )
+
+    def _print_comparison(self, old, new):
+        self.stdout.write(f'Compared with {old.get("commit") or "baseline"}:')
+        for name, result in new['results'].items():
+            previous = old['results'].get(name)
+            if previous is None:
+                continue
+            old_time = previous['wall_time']['median']
+            new_time = result['wall_time']['median']
+            old_calls = sum(previous['upstream_calls'].values())
+            new_calls = sum(result['upstream_calls'].values())
+            self.stdout.write(
+                f'{name:32} '
+                f'{(new_time / old_time - 1) * 100 if old_time else 0:+8.1f}% '
+                f'time {new_calls - old_calls:+8.1f} calls'
+            )
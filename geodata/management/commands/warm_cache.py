@@ -0,0 +1,223 @@
+import contextvars
+import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from common.apis.budget import call_budget
+from common.apis.maps import MAX_RESTRICTION_RADIUS
+from common.apis.ratelimit import PREFETCH, priority
+from geodata.services import get_maps_client
+from geodata.serializers import quantize_circle
+from geodata.services.cache import (
+    NEARBY_SHARED_TTL,
+    NearbySearchCache,
+    PlaceDetailsCache,
+)
+from geodata.services.places import INITIAL_DISTANCE_THRESHOLD, PlacesService
+from geodata.services.store import place_store
+from geodata.services.tiling import DEFAULT_MAX_TILING_CALLS
+from users.models import User
+
+DEFAULT_MAX_CALLS = 500
+DEFAULT_MAX_COST = 10.0
+DEFAULT_TOP = 100
+DEFAULT_WORKERS = 4
+DEFAULT_LOG_TAIL = 100000
+DEFAULT_DETAIL_FIELDS = [
+    'displayName', 'formattedAddress', 'location', 'types']
+
+# Cached searches expire after NEARBY_SHARED_TTL, so warming every half
+# of it refreshes them well before they do.
+DEFAULT_INTERVAL = NEARBY_SHARED_TTL // 2
+
+# A `latitude,longitude` or `latitude,longitude,radius` at the end of a
+# line, after the timestamp of the query log.
+_LOCATION_PATTERN = re.compile(
+    r'(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)(?:,(\d+(?:\.\d+)?))?\s*$')
+
+
+def parse_hot_location(line, default_radius):
+    """
+    Returns the `((latitude, longitude), radius)` circle of a line of a
+    hot locations file or of the query log, or None if it has none.
+    """
+    match = _LOCATION_PATTERN.search(line)
+    if match is None:
+        return None
+    lat, lng, radius = match.groups()
+    radius = float(radius) if radius else default_radius
+    return (float(lat), float(lng)), min(radius, MAX_RESTRICTION_RADIUS)
+
+
+def read_hot_regions(paths, default_radius, tail=DEFAULT_LOG_TAIL):
+    """
+    Reads the hot locations from the given files (the last `tail` lines
+    of each) and the GEODATA_HOT_LOCATIONS setting. Locations are
+    quantized like the queries of the views (see quantize_circle), so
+    that the same searches are counted together.
+    Returns a Counter of `(location, radius)` circles.
+
+    Configured locations are counted as often as the hottest logged one,
+    so that they always come first.
+    """
+    regions = Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in deque(f, maxlen=tail):
+                circle = parse_hot_location(line, default_radius)
+                if circle is not None:
+                    regions[quantize_circle(*circle)] += 1
+
+    hottest = max(regions.values(), default=1)
+    for entry in getattr(settings, 'GEODATA_HOT_LOCATIONS', []):
+        lat, lng, *rest = entry
+        radius = rest[0] if rest else default_radius
+        regions[quantize_circle((lat, lng), radius)] += hottest
+    return regions
+
+
+class Command(BaseCommand):
+    help = (
+        'Refreshes the cached nearby searches and place details of the '
+        'hottest regions, read from the query log and the '
+        'GEODATA_HOT_LOCATIONS setting, before they expire.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', action='append', default=[],
+                            help='File of hot locations, one '
+                                 '"latitude,longitude[,radius]" per line. '
+                                 'Defaults to the query log.')
+        parser.add_argument('--radius', type=float,
+                            default=INITIAL_DISTANCE_THRESHOLD,
+                            help='Radius of locations without one.')
+        parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                            help='Number of hottest regions to warm.')
+        parser.add_argument('--tail', type=int, default=DEFAULT_LOG_TAIL,
+                            help='Number of recent lines of every file '
+                                 'to read.')
+        parser.add_argument('--max-calls', type=int,
+                            default=DEFAULT_MAX_CALLS,
+                            help='Maximum number of Maps API calls.')
+        parser.add_argument('--max-cost', type=float,
+                            default=DEFAULT_MAX_COST,
+                            help='Maximum cost of the calls in USD.')
+        parser.add_argument('--tiling-calls', type=int,
+                            default=DEFAULT_MAX_TILING_CALLS,
+                            help='Calls of the tiled search of every '
+                                 'region (0 to skip it).')
+        parser.add_argument('--fields', nargs='*',
+                            default=DEFAULT_DETAIL_FIELDS,
+                            help='Place details fields to warm.')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of regions warmed at once.')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep warming every this many seconds '
+                                 f'(e.g. {DEFAULT_INTERVAL}) instead of '
+                                 'once.')
+
+    def handle(self, *args, **options):
+        paths = options['locations']
+        if not paths and getattr(settings, 'QUERY_LOG', None):
+            paths = [settings.QUERY_LOG]
+        if not paths and not getattr(settings, 'GEODATA_HOT_LOCATIONS', []):
+            raise CommandError(
+                'No hot locations: pass --locations, or set QUERY_LOG or '
+                'GEODATA_HOT_LOCATIONS.')
+
+        while True:
+            started = time.monotonic()
+            try:
+                regions = read_hot_regions(
+                    paths, options['radius'], options['tail'])
+            except OSError as e:
+                raise CommandError(f'Cannot read the hot locations: {e}')
+            self.warm(
+                [circle for circle, _ in regions.most_common(options['top'])],
+                options,
+            )
+            if not options['interval']:
+                break
+            time.sleep(max(0.0, options['interval']
+                           - (time.monotonic() - started)))
+
+    def warm(self, regions, options):
+        """
+        Warms the given regions, the hottest first, on a thread pool.
+        All the calls share one budget and are made with the PREFETCH
+        priority, so they never hold back interactive requests.
+        """
+        started = time.monotonic()
+        service = PlacesService(
+            get_maps_client(),
+            {'user': User()},
+            place_cache=PlaceDetailsCache(refresh=True),
+            nearby_cache=NearbySearchCache(
+                place_store=place_store, refresh=True),
+        )
+
+        warmed = 0
+        # Places found in several regions are only refreshed once.
+        seen = set()
+        seen_lock = threading.Lock()
+        with priority(PREFETCH), call_budget(
+            max_calls=options['max_calls'], max_cost=options['max_cost'],
+        ) as budget:
+            with ThreadPoolExecutor(options['workers']) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self.warm_region, service, budget, circle, options,
+                        seen, seen_lock,
+                    )
+                    for circle in regions
+                ]
+                for future in as_completed(futures):
+                    warmed += future.result()
+
+        self.stdout.write(
+            f'Warmed {warmed} of {len(regions)} regions with '
+            f'{budget.calls} calls (${budget.cost:.2f}) in '
+            f'{time.monotonic() - started:.1f}s.')
+        if budget.exhausted:
+            self.stdout.write(self.style.WARNING(
+                'The budget ran out; the coldest regions were skipped.'))
+
+    def warm_region(self, service, budget, circle, options, seen,
+                    seen_lock):
+        """
+        Refreshes the nearby searches of a region (both the ones of
+        get_nearby_places_sorted and the tiled ones of the nearby
+        endpoint), and the details of the places found that are not in
+        `seen` yet (which is shared by the regions warmed at once, under
+        `seen_lock`), concurrently. Returns whether the region was warmed
+        completely.
+        """
+        if budget.exhausted:
+            return False
+        location, radius = circle
+        try:
+            with call_budget() as region_budget:
+                place_ids = list(service.get_nearby_places_sorted(
+                    location, min(radius, MAX_RESTRICTION_RADIUS)))
+                if options['tiling_calls']:
+                    for batch in service.iter_all_nearby_places(
+                        location, radius,
+                        max_api_calls=options['tiling_calls'],
+                    ):
+                        place_ids.extend(place['id'] for place in batch)
+                with seen_lock:
+                    place_ids = [
+                        p for p in dict.fromkeys(place_ids) if p not in seen]
+                    seen.update(place_ids)
+                if options['fields'] and place_ids:
+                    service.get_places_details(place_ids, options['fields'])
+        finally:
+            connections.close_all()
+        return not region_budget.degraded
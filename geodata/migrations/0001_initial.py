@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AreaCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geohash', models.CharField(max_length=12, unique=True)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('place_id', models.CharField(max_length=255, unique=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('geohash', models.CharField(max_length=12)),
+                ('types', models.JSONField(default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['latitude', 'longitude'], name='geodata_pla_latitud_30d408_idx'), models.Index(fields=['geohash'], name='geodata_pla_geohash_ebd261_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+def fill_types_key(apps, schema_editor):
+    Place = apps.get_model('geodata', 'Place')
+    places = Place.objects.only('id', 'types')
+    batch = []
+    for place in places.iterator(chunk_size=2000):
+        place.types_key = ''.join(f',{t}' for t in place.types) + ','
+        batch.append(place)
+        if len(batch) >= 2000:
+            Place.objects.bulk_update(batch, ['types_key'])
+            batch = []
+    Place.objects.bulk_update(batch, ['types_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='types_key',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(fill_types_key, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,40 @@
 from django.db import models
 
-# Create your models here.
+class Place(models.Model):
+    """
+    Represents a place that was returned by the Places API. Places are
+    stored with their location so that area queries can be answered
+    without calling the API.
+    """
+
+    place_id = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    geohash = models.CharField(max_length=12)
+    types = models.JSONField(default=list)
+    # The types joined as `,type_a,type_b,`, so that the database can
+    # find where a type comes in them (see PlaceStore.query_area).
+    types_key = models.TextField(default='')
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude']),
+            models.Index(fields=['geohash']),
+        ]
+
+    def __str__(self):
+        return self.place_id
+
+class AreaCell(models.Model):
+    """
+    Represents a geohash cell whose places have been fetched from the
+    Places API and stored as Place objects.
+    """
+
+    geohash = models.CharField(max_length=12, unique=True)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.geohash
@@ -0,0 +1,296 @@
+from django.core import signing
+from rest_framework import serializers
+
+from common.apis.maps import (
+    MAX_PHOTO_SIZE,
+    MAX_RESTRICTION_RADIUS,
+    PLACES_V2_FIELDS_ADVANCED,
+    PLACES_V2_FIELDS_BASIC,
+    PLACES_V2_FIELDS_PREFERRED,
+)
+
+from .services.cache import get_circle_bucket
+from .services.geo import geohash_center
+from .services.photos import round_photo_size
+from .services.places import (
+    DEFAULT_RESULT_PER_PAGE,
+    INITIAL_DISTANCE_THRESHOLD,
+)
+from .services.routes import DEFAULT_ROUTE_CORRIDOR_WIDTH, get_route_points
+from .services.tiling import (
+    DEFAULT_MAX_CORRIDOR_CALLS,
+    DEFAULT_MAX_TILING_CALLS,
+)
+
+MAX_RESULT_PER_PAGE = 100
+MAX_SUGGESTION_COUNT = 100
+MAX_CORRIDOR_WIDTH = 5000.0
+MAX_DETAILS_BATCH = 100
+DEFAULT_PHOTO_SIZE = 400
+PLACE_FIELDS = sorted(
+    PLACES_V2_FIELDS_BASIC
+    | PLACES_V2_FIELDS_ADVANCED
+    | PLACES_V2_FIELDS_PREFERRED
+)
+# Decimal places that the corners of rectangles are rounded to (about
+# ten meters), so that nearly the same queries share cached responses.
+RECTANGLE_PRECISION = 4
+
+
+def quantize_circle(location, radius):
+    """
+    Rounds a circle to its bucket (see get_circle_bucket), so that nearly
+    the same queries share cached responses. The center moves by at
+    most a tenth of the radius, which is rounded up.
+    """
+    geohash, radius = get_circle_bucket(location, radius)
+    return geohash_center(geohash), radius
+
+
+class LocationField(serializers.Field):
+    """
+    A location given as a `latitude,longitude` string (as in query
+    strings) or a list of two numbers, as a `(latitude, longitude)` tuple.
+    """
+
+    default_error_messages = {
+        'invalid': 'Expected a location as "latitude,longitude".',
+        'out_of_range': 'The location is out of range.',
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = data.split(',')
+        try:
+            lat, lng = (float(x) for x in data)
+        except (TypeError, ValueError):
+            self.fail('invalid')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            self.fail('out_of_range')
+        return lat, lng
+
+    def to_representation(self, value):
+        return f'{value[0]},{value[1]}'
+
+
+class CursorField(serializers.CharField):
+    """
+    An opaque cursor holding the state needed to continue a search. It
+    is signed, so that clients cannot make us run searches of their own
+    choosing by tampering with it.
+    """
+
+    default_error_messages = {
+        'invalid_cursor': 'The cursor is invalid.',
+    }
+
+    def __init__(self, salt, **kwargs):
+        self.salt = salt
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        data = super().to_internal_value(data)
+        try:
+            return signing.loads(data, salt=self.salt)
+        except signing.BadSignature:
+            self.fail('invalid_cursor')
+
+    def to_representation(self, value):
+        return signing.dumps(value, salt=self.salt, compress=True)
+
+
+class NearbySearchSerializer(serializers.Serializer):
+    """
+    Query of the nearby places stream. A search either starts from a
+    location and radius (which are quantized), or continues from the
+    cursor of a previous page.
+    """
+
+    location = LocationField(required=False)
+    radius = serializers.FloatField(
+        min_value=1.0,
+        max_value=MAX_RESTRICTION_RADIUS,
+        default=INITIAL_DISTANCE_THRESHOLD,
+    )
+    max_api_calls = serializers.IntegerField(
+        min_value=1,
+        max_value=DEFAULT_MAX_TILING_CALLS,
+        default=DEFAULT_MAX_TILING_CALLS,
+    )
+    cursor = CursorField(salt='geodata.nearby', required=False)
+
+    def validate(self, attrs):
+        cursor = attrs.pop('cursor', None)
+        if cursor is not None:
+            location, radius, circles = cursor
+            attrs['location'] = tuple(location)
+            attrs['radius'] = radius
+            attrs['circles'] = [(tuple(c), r) for c, r in circles]
+        elif 'location' in attrs:
+            attrs['location'], attrs['radius'] = quantize_circle(
+                attrs['location'], attrs['radius'])
+        else:
+            raise serializers.ValidationError(
+                'Either a location or a cursor is required.')
+        return attrs
+
+    def get_cursor(self, location, radius, circles):
+        if not circles:
+            return None
+        return self.fields['cursor'].to_representation(
+            [location, radius, circles])
+
+
+class AreaSearchSerializer(serializers.Serializer):
+    """
+    Query of the area places stream. The area is either a circle (a
+    location and radius) or a rectangle (its low and high corners), or
+    is taken from the cursor of a previous page. Areas are quantized.
+    """
+
+    location = LocationField(required=False)
+    radius = serializers.FloatField(
+        min_value=1.0,
+        max_value=MAX_RESTRICTION_RADIUS,
+        default=INITIAL_DISTANCE_THRESHOLD,
+    )
+    low = LocationField(required=False)
+    high = LocationField(required=False)
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=MAX_RESULT_PER_PAGE,
+        default=DEFAULT_RESULT_PER_PAGE,
+    )
+    max_api_calls = serializers.IntegerField(
+        min_value=1,
+        max_value=DEFAULT_MAX_TILING_CALLS,
+        default=DEFAULT_MAX_TILING_CALLS,
+    )
+    cursor = CursorField(salt='geodata.area', required=False)
+
+    def validate(self, attrs):
+        cursor = attrs.pop('cursor', None)
+        if cursor is not None:
+            attrs['location_restriction'], attrs['key'] = cursor
+            return attrs
+
+        attrs['key'] = None
+        if 'location' in attrs:
+            (lat, lng), radius = quantize_circle(
+                attrs['location'], attrs['radius'])
+            attrs['location_restriction'] = {'circle': {
+                'center': {'latitude': lat, 'longitude': lng},
+                'radius': radius,
+            }}
+        elif 'low' in attrs and 'high' in attrs:
+            low, high = (
+                tuple(round(x, RECTANGLE_PRECISION) for x in corner)
+                for corner in (attrs['low'], attrs['high'])
+            )
+            if low[0] > high[0] or low[1] > high[1]:
+                raise serializers.ValidationError(
+                    'The low corner must be south-west of the high corner.')
+            attrs['location_restriction'] = {'rectangle': {
+                'low': {'latitude': low[0], 'longitude': low[1]},
+                'high': {'latitude': high[0], 'longitude': high[1]},
+            }}
+        else:
+            raise serializers.ValidationError(
+                'Either a location, both corners or a cursor is required.')
+        return attrs
+
+    def get_cursor(self, location_restriction, key):
+        if key is None:
+            return None
+        return self.fields['cursor'].to_representation(
+            [location_restriction, key])
+
+
+class RouteSuggestionsSerializer(serializers.Serializer):
+    """
+    Body of a route suggestions request. The route is an encoded
+    polyline, a route from the Routes API or a list of points (see
+    get_route_points).
+    """
+
+    route = serializers.JSONField()
+    max_distance = serializers.FloatField(
+        min_value=1.0,
+        max_value=MAX_CORRIDOR_WIDTH,
+        default=DEFAULT_ROUTE_CORRIDOR_WIDTH,
+    )
+    max_count = serializers.IntegerField(
+        min_value=1,
+        max_value=MAX_SUGGESTION_COUNT,
+        default=20,
+    )
+    max_api_calls = serializers.IntegerField(
+        min_value=1,
+        max_value=DEFAULT_MAX_CORRIDOR_CALLS,
+        default=DEFAULT_MAX_CORRIDOR_CALLS,
+    )
+
+    def validate_route(self, value):
+        try:
+            points = get_route_points(value)
+        except (KeyError, TypeError, ValueError, IndexError):
+            raise serializers.ValidationError('The route is invalid.')
+        if not points:
+            raise serializers.ValidationError('The route is invalid.')
+        # Every point is checked like a location, so that the services
+        # only ever get numbers within range.
+        field = LocationField()
+        locations = []
+        for i, point in enumerate(points):
+            try:
+                locations.append(field.to_internal_value(point))
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError(
+                    f'Point {i} of the route: {e.detail[0]}')
+        return locations
+
+
+class PlaceDetailsSerializer(serializers.Serializer):
+    """
+    Body of a place details request: the IDs of the places, and the
+    (top-level) fields to return for every one of them. Place IDs are
+    part of the URL of the API calls, so they are restricted to the
+    characters that place IDs are made of.
+    """
+
+    ids = serializers.ListField(
+        child=serializers.RegexField(r'^[\w-]+$', max_length=1000),
+        min_length=1,
+        max_length=MAX_DETAILS_BATCH,
+    )
+    fields = serializers.ListField(
+        child=serializers.ChoiceField(choices=PLACE_FIELDS),
+        min_length=1,
+    )
+    stream = serializers.BooleanField(default=False)
+
+    def validate_fields(self, value):
+        return list(dict.fromkeys(value))
+
+
+class PlacePhotoSerializer(serializers.Serializer):
+    """
+    Query of a place photo: the photo `name` (as in the `photos` field of
+    a place) and the size it is scaled down to fit in, which is rounded
+    up (see round_photo_size) so that photos are shared. The width
+    defaults to DEFAULT_PHOTO_SIZE when neither size is given.
+    """
+
+    name = serializers.RegexField(
+        r'^places/[\w-]+/photos/[\w-]+$', max_length=2000)
+    max_width = serializers.IntegerField(
+        min_value=1, max_value=MAX_PHOTO_SIZE, required=False)
+    max_height = serializers.IntegerField(
+        min_value=1, max_value=MAX_PHOTO_SIZE, required=False)
+
+    def validate(self, attrs):
+        if 'max_width' not in attrs and 'max_height' not in attrs:
+            attrs['max_width'] = DEFAULT_PHOTO_SIZE
+        attrs['max_width'] = round_photo_size(attrs.get('max_width'))
+        attrs['max_height'] = round_photo_size(attrs.get('max_height'))
+        return attrs
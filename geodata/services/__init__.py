@@ -1,7 +1,130 @@
-from common.apis.maps import MapsClient
-from django.contrib.sessions.backends.db import SessionStore
+import asyncio
+import threading
+import weakref
+from functools import cached_property
 
-maps_client = MapsClient()
+from asgiref.sync import sync_to_async
+from common.apis.hedging import HedgePolicy
+from common.apis.maps import AsyncMapsClient, MapsClient
+from django.conf import settings
+from users.models import User
 
-session_store = SessionStore()
-session = session_store.load()
+from .places import PlacesService
+from .routes import RoutesService
+
+_maps_client = None
+_maps_client_lock = threading.Lock()
+_async_maps_clients = weakref.WeakKeyDictionary()
+
+
+def get_maps_client():
+    """
+    Returns the Maps client of this process, which is created the first
+    time it is needed rather than when the module is imported. Its
+    requests are hedged if the UPSTREAM_HEDGING setting is set.
+    """
+    global _maps_client
+    if _maps_client is None:
+        with _maps_client_lock:
+            if _maps_client is None:
+                hedging = getattr(settings, 'UPSTREAM_HEDGING', None)
+                _maps_client = MapsClient(
+                    hedging=HedgePolicy(**hedging) if hedging else None)
+    return _maps_client
+
+
+def get_async_maps_client():
+    """
+    Returns the async Maps client of the running event loop, creating it
+    the first time it is needed.
+
+    The pooled connections of a client are bound to the event loop, so
+    there is one client per loop. Under ASGI that is one per process;
+    async views served by WSGI run in a new loop every time, whose
+    client is dropped (without reusing its connections) with the loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_maps_clients.get(loop)
+    if client is None:
+        maps_client = get_maps_client()
+        client = _async_maps_clients[loop] = AsyncMapsClient(
+            client=maps_client.client, hedging=maps_client.hedging)
+    return client
+
+
+class ServiceSession:
+    """
+    Session data of a request, as seen by the services.
+
+    Keys are read from the request session, except for `user`, which is
+    the User of the `user_id` stored in the session. It is loaded from
+    the database the first time it is needed, and is an unsaved User
+    with no preferences for anonymous requests.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def __getitem__(self, key):
+        if key == 'user':
+            return self.user
+        return self.request.session[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @cached_property
+    def user(self):
+        user_id = self.request.session.get('user_id')
+        if user_id is not None:
+            user = User.objects.filter(pk=user_id).first()
+            if user is not None:
+                return user
+        return User()
+
+    async def aload(self):
+        """
+        Loads the user from a coroutine, where the session and the
+        database cannot be accessed lazily.
+        """
+        await sync_to_async(getattr)(self, 'user')
+
+
+def get_places_service(request):
+    """
+    Returns the PlacesService of a request, creating it the first time
+    it is needed. Services are scoped to the request, so they never
+    share session data (or remembered scores) between requests.
+    """
+    service = getattr(request, '_places_service', None)
+    if service is None:
+        service = PlacesService(get_maps_client(), _get_session(request))
+        request._places_service = service
+    return service
+
+
+def get_routes_service(request):
+    """
+    Returns the RoutesService of a request, creating it the first time
+    it is needed.
+    """
+    service = getattr(request, '_routes_service', None)
+    if service is None:
+        service = RoutesService(
+            get_maps_client(),
+            _get_session(request),
+            places_service=get_places_service(request),
+        )
+        request._routes_service = service
+    return service
+
+
+def _get_session(request):
+    session = getattr(request, '_service_session', None)
+    if session is None:
+        session = ServiceSession(request)
+        request._service_session = session
+    return session
@@ -0,0 +1,445 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from math import ceil, log
+
+from common.apis.budget import mark_degraded
+from common.apis.maps import MAX_RESTRICTION_RADIUS, MAX_RESULT_COUNT
+from common.apis.ratelimit import QuotaExceeded
+from django.core.cache import caches
+
+from .concurrency import run_in_thread
+from .geo import (
+    geohash_bounds,
+    geohash_center,
+    geohash_encode,
+    haversine_distance,
+)
+from .metrics import record_cache_lookups
+from .store import place_store
+
+GEODATA_CACHE_ALIAS = 'geodata'
+
+PLACE_DETAILS_LOCAL_MAX_ENTRIES = 50000
+PLACE_DETAILS_LOCAL_TTL = 5 * 60
+PLACE_DETAILS_SHARED_TTL = 24 * 60 * 60
+
+NEARBY_LOCAL_MAX_ENTRIES = 5000
+NEARBY_LOCAL_TTL = 5 * 60
+NEARBY_SHARED_TTL = 60 * 60
+NEARBY_MIN_RADIUS = 50.0
+NEARBY_RADIUS_BUCKET_RATIO = 1.15
+NEARBY_CELL_SIZE_RATIO = 0.1
+NEARBY_MAX_GEOHASH_PRECISION = 9
+
+# Marks a field that was requested from the API but not returned, which
+# happens when the place simply has no value for it (e.g. no rating).
+# Caching the absence keeps us from asking for the same field again. API
+# responses are decoded from JSON, so a tuple can never be a real value.
+_ABSENT = ('absent',)
+
+_NOT_FOUND = object()
+
+
+class LRUCache:
+    """
+    A thread-safe, in-process LRU cache where every entry expires after
+    a fixed time-to-live.
+
+    This is the first (fastest) tier of our caches. It is private to
+    each worker process, so it should only hold data that is fine to be
+    slightly stale.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_circle_bucket(location, radius):
+    """
+    Rounds a circle to the bucket shared by nearly the same circles.
+    Returns a tuple of the geohash of the cell that the center is rounded
+    to, whose size is small compared to the radius, and the radius
+    rounded up to a bucket.
+    """
+    steps = ceil(log(max(radius, NEARBY_MIN_RADIUS) / NEARBY_MIN_RADIUS)
+                 / log(NEARBY_RADIUS_BUCKET_RATIO) - 1e-9)
+    bucket_radius = round(
+        NEARBY_MIN_RADIUS * NEARBY_RADIUS_BUCKET_RATIO ** steps, 1)
+
+    for precision in range(1, NEARBY_MAX_GEOHASH_PRECISION + 1):
+        geohash = geohash_encode(location, precision)
+        min_lat, min_lng, _, _ = geohash_bounds(geohash)
+        half_diagonal = haversine_distance(
+            geohash_center(geohash), (min_lat, min_lng))
+        if half_diagonal <= NEARBY_CELL_SIZE_RATIO * bucket_radius:
+            break
+    return geohash, bucket_radius
+
+
+class PlaceDetailsCache:
+    """
+    Two-tier cache for place details, keyed by place ID.
+
+    Details are stored field by field rather than as whole responses, so
+    that a request for a set of fields only needs to fetch the ones that
+    are not cached yet. The first tier is an in-process LRU cache and
+    the second is the shared `geodata` Django cache (backed by Postgres
+    by default), which lets workers reuse each other's responses.
+
+    A cache created with `refresh=True` never reads cached fields, so
+    that every requested field is fetched again and stored, which is
+    how the details of hot places are refreshed before they expire (see
+    the warm_cache command).
+
+    NOTE: only top-level field names are supported (e.g. `displayName`
+    but not `displayName.text`).
+    """
+
+    def __init__(
+        self,
+        local_max_entries=PLACE_DETAILS_LOCAL_MAX_ENTRIES,
+        local_ttl=PLACE_DETAILS_LOCAL_TTL,
+        shared_ttl=PLACE_DETAILS_SHARED_TTL,
+        cache_alias=GEODATA_CACHE_ALIAS,
+        refresh=False,
+    ):
+        self.local = LRUCache(local_max_entries, local_ttl)
+        self.shared_ttl = shared_ttl
+        self.cache_alias = cache_alias
+        self.refresh = refresh
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _shared_key(self, place_id, field):
+        return f'place:{place_id}:{field}'
+
+    def get_fields(self, place_id, fields):
+        """
+        Looks up the given fields of a place in both tiers. Returns a
+        tuple of the place dict built from cached fields and the list of
+        fields that were not found in either tier.
+        """
+        return self.get_many_fields([place_id], fields)[place_id]
+
+    def get_many_fields(self, place_ids, fields):
+        """
+        Same as get_fields, for several places at once. Returns a dict
+        mapping every place ID to its `(place, missing)` tuple. The
+        fields missing from the first tier are looked up in the second
+        one with a single query for all the places.
+        """
+        if self.refresh:
+            return {place_id: ({}, list(fields)) for place_id in place_ids}
+        results = {}
+        keys = {}
+        local_hits = 0
+        for place_id in place_ids:
+            place = {}
+            missing = []
+            for field in fields:
+                value = self.local.get((place_id, field), _NOT_FOUND)
+                if value is _NOT_FOUND:
+                    missing.append(field)
+                    keys[self._shared_key(place_id, field)] = place_id, field
+                else:
+                    local_hits += 1
+                    if value != _ABSENT:
+                        place[field] = value
+            results[place_id] = place, missing
+
+        shared_hits = 0
+        if keys:
+            found = self.shared.get_many(keys.keys())
+            for key, value in found.items():
+                place_id, field = keys[key]
+                place, missing = results[place_id]
+                missing.remove(field)
+                self.local.set((place_id, field), value)
+                if value != _ABSENT:
+                    place[field] = value
+            shared_hits = len(found)
+
+        record_cache_lookups(
+            'place_details',
+            local=local_hits,
+            shared=shared_hits,
+            miss=len(keys) - shared_hits,
+        )
+        return results
+
+    def set_fields(self, place_id, fields, place):
+        """
+        Stores the given fields of a place response in both tiers. Any
+        field in the list that the response lacks is cached as absent.
+        """
+        values = {}
+        for field in fields:
+            value = place.get(field, _ABSENT)
+            self.local.set((place_id, field), value)
+            values[self._shared_key(place_id, field)] = value
+        self.shared.set_many(values, timeout=self.shared_ttl)
+
+    def invalidate(self, place_id, fields):
+        for field in fields:
+            self.local.delete((place_id, field))
+        self.shared.delete_many(
+            [self._shared_key(place_id, f) for f in fields])
+
+
+
+class NearbySearchCache:
+    """
+    Two-tier cache for nearby search results, shared by searches with
+    nearly the same center and radius.
+
+    The radius is rounded up to a bucket and the center is rounded to
+    a geohash cell whose size is small compared to the radius. The
+    cached search is centered on the cell and its radius is enlarged
+    by half the cell diagonal, so that it covers the requested circle
+    of any center inside the cell. Cached results are then filtered
+    down to the requested circle (and re-sorted by distance for
+    DISTANCE-ranked searches).
+
+    Places fetched from the API are also added to the place store, if
+    one is given. When the quota of the API is used up, searches that
+    are not cached are answered from the place store instead, with the
+    `id`, `location` and `types` of the stored places only.
+
+    A cache created with `refresh=True` never reads cached searches,
+    but fetches them again and stores them, which is how hot searches
+    are refreshed before they expire (see the warm_cache command).
+
+    NOTE: since a search returns at most 20 places, the filtered
+    results may contain fewer places than an exact search would.
+    """
+
+    def __init__(
+        self,
+        local_max_entries=NEARBY_LOCAL_MAX_ENTRIES,
+        local_ttl=NEARBY_LOCAL_TTL,
+        shared_ttl=NEARBY_SHARED_TTL,
+        cache_alias=GEODATA_CACHE_ALIAS,
+        place_store=None,
+        refresh=False,
+    ):
+        self.local = LRUCache(local_max_entries, local_ttl)
+        self.shared_ttl = shared_ttl
+        self.cache_alias = cache_alias
+        self.place_store = place_store
+        self.refresh = refresh
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _fetch(self, maps_client, location, radius, fields, **kwargs):
+        places = maps_client.places_nearby_v2(
+            location, radius, fields=fields, **kwargs,
+        ).get('places', [])
+        if self.place_store is not None:
+            self.place_store.ingest(places)
+        return places
+
+    def get_tile(self, location, radius):
+        """
+        Returns the `(geohash, tile_radius)` of the cached search that
+        covers the circle with the given center and radius.
+        """
+        geohash, bucket_radius = get_circle_bucket(location, radius)
+        min_lat, min_lng, _, _ = geohash_bounds(geohash)
+        half_diagonal = haversine_distance(
+            geohash_center(geohash), (min_lat, min_lng))
+        return geohash, round(bucket_radius + half_diagonal, 1)
+
+    def _key(self, geohash, tile_radius, fields, kwargs):
+        params = json.dumps([sorted(fields), kwargs], sort_keys=True)
+        digest = hashlib.sha1(params.encode()).hexdigest()[:20]
+        return f'nearby:{geohash}:{tile_radius}:{digest}'
+
+    def search(self, maps_client, location, radius, fields, **kwargs):
+        """
+        Returns the response of a nearby search through the given maps
+        client, answering it from the cache when possible. The keyword
+        arguments (rank preference, type filters, etc.) are passed to
+        places_nearby_v2 and are part of the cache key.
+        """
+        places, _ = self.search_places(
+            maps_client, location, radius, fields, **kwargs)
+        return {'places': places}
+
+    def search_places(self, maps_client, location, radius, fields, **kwargs):
+        """
+        Same as search, but returns a tuple of the list of place dicts
+        and whether the underlying search was saturated, i.e. returned
+        the maximum number of results. If so, there may be more places in
+        the requested circle than the ones returned.
+        """
+        geohash, tile_radius = self.get_tile(location, radius)
+        if tile_radius > MAX_RESTRICTION_RADIUS:
+            try:
+                places = self._fetch(
+                    maps_client, location, radius, fields, **kwargs)
+            except QuotaExceeded:
+                if self.place_store is None:
+                    raise
+                return self._search_store(location, radius), False
+            return places, len(places) >= MAX_RESULT_COUNT
+
+        tile_fields = sorted({'id', 'location', *fields})
+        key = self._key(geohash, tile_radius, tile_fields, kwargs)
+        places = self._get_cached(key)
+        if places is None:
+            try:
+                places = self._fetch(
+                    maps_client,
+                    geohash_center(geohash),
+                    tile_radius,
+                    tile_fields,
+                    **kwargs,
+                )
+            except QuotaExceeded:
+                if self.place_store is None:
+                    raise
+                return self._search_store(location, radius), False
+            self._set_cached(key, places)
+        return self._filter(places, location, radius, kwargs)
+
+    async def asearch_places(
+        self, maps_client, location, radius, fields, **kwargs,
+    ):
+        """
+        Same as search_places, for coroutines and an AsyncMapsClient.
+        Cache and store lookups run in worker threads, while the API call
+        itself is awaited, so many searches can be in flight at once
+        without holding a thread each.
+        """
+        geohash, tile_radius = self.get_tile(location, radius)
+        if tile_radius > MAX_RESTRICTION_RADIUS:
+            try:
+                places = await self._afetch(
+                    maps_client, location, radius, fields, **kwargs)
+            except QuotaExceeded:
+                if self.place_store is None:
+                    raise
+                places = await run_in_thread(
+                    self._search_store, location, radius)
+                return places, False
+            return places, len(places) >= MAX_RESULT_COUNT
+
+        tile_fields = sorted({'id', 'location', *fields})
+        key = self._key(geohash, tile_radius, tile_fields, kwargs)
+        places = await run_in_thread(self._get_cached, key)
+        if places is None:
+            try:
+                places = await self._afetch(
+                    maps_client,
+                    geohash_center(geohash),
+                    tile_radius,
+                    tile_fields,
+                    **kwargs,
+                )
+            except QuotaExceeded:
+                if self.place_store is None:
+                    raise
+                places = await run_in_thread(
+                    self._search_store, location, radius)
+                return places, False
+            await run_in_thread(self._set_cached, key, places)
+        return self._filter(places, location, radius, kwargs)
+
+    async def _afetch(self, maps_client, location, radius, fields, **kwargs):
+        response = await maps_client.places_nearby_v2(
+            location, radius, fields=fields, **kwargs)
+        places = response.get('places', [])
+        if self.place_store is not None:
+            await run_in_thread(self.place_store.ingest, places)
+        return places
+
+    def _get_cached(self, key):
+        if self.refresh:
+            return None
+        places = self.local.get(key)
+        if places is not None:
+            record_cache_lookups('nearby_search', local=1)
+            return places
+        places = self.shared.get(key)
+        if places is None:
+            record_cache_lookups('nearby_search', miss=1)
+            return None
+        record_cache_lookups('nearby_search', shared=1)
+        self.local.set(key, places)
+        return places
+
+    def _set_cached(self, key, places):
+        self.shared.set(key, places, timeout=self.shared_ttl)
+        self.local.set(key, places)
+
+    def _filter(self, places, location, radius, kwargs):
+        """
+        Filters the places of a cached search down to the requested
+        circle. Returns the same tuple as search_places.
+        """
+        saturated = len(places) >= MAX_RESULT_COUNT
+
+        distances = {}
+        for place in places:
+            point = place['location']
+            distances[place['id']] = haversine_distance(
+                location, (point['latitude'], point['longitude']))
+        places = [p for p in places if distances[p['id']] <= radius]
+        if kwargs.get('rank_preference') == 'DISTANCE':
+            places.sort(key=lambda p: distances[p['id']])
+
+        return places, saturated
+
+    def _search_store(self, location, radius):
+        """
+        Answers a search from the place store, without caching it. The
+        places are ranked by distance, whatever the rank preference.
+        """
+        mark_degraded()
+        return self.place_store.get_places_in_circle(
+            location, radius, limit=MAX_RESULT_COUNT)
+
+
+place_details_cache = PlaceDetailsCache()
+nearby_search_cache = NearbySearchCache(place_store=place_store)
@@ -0,0 +1,132 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from asgiref.sync import sync_to_async
+from common.apis.budget import get_budget, mark_degraded
+from django.db import connections
+
+MAX_WORKERS = 16
+# Tasks that wait for calls of the shared pool (such as tiled searches)
+# run in a pool of their own, so that they can never take all the
+# threads that the calls they wait for need.
+MAX_COORDINATOR_WORKERS = 8
+DEFAULT_CALL_TIMEOUT = 10.0
+
+_executor = None
+_coordinator_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the thread pool shared by the services of this process for
+    running outbound API calls concurrently.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS,
+                    thread_name_prefix='geodata',
+                )
+    return _executor
+
+
+def get_coordinator_executor():
+    """
+    Returns the thread pool for the tasks that run calls on the shared
+    pool and wait for them (see MAX_COORDINATOR_WORKERS).
+    """
+    global _coordinator_executor
+    if _coordinator_executor is None:
+        with _executor_lock:
+            if _coordinator_executor is None:
+                _coordinator_executor = ThreadPoolExecutor(
+                    max_workers=MAX_COORDINATOR_WORKERS,
+                    thread_name_prefix='geodata-coordinator',
+                )
+    return _coordinator_executor
+
+
+def _run_task(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        # Pool threads are not request threads, so Django would never
+        # close the database connections that the task opened.
+        connections.close_all()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Schedules a call on the shared thread pool and returns its future.
+    The call runs in a copy of the current context, so context variables
+    (such as the priority of Maps API calls) carry over to it.
+    """
+    return _submit(get_executor(), fn, *args, **kwargs)
+
+
+def _submit(executor, fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    return executor.submit(context.run, _run_task, fn, *args, **kwargs)
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """
+    Awaits a blocking call (such as a cache or database lookup) run in a
+    worker thread, from a coroutine. Like submit, the call runs in a copy
+    of the current context and closes its database connections.
+    """
+    return await sync_to_async(_run_task, thread_sensitive=False)(
+        fn, *args, **kwargs)
+
+
+def get_call_timeout(timeout=DEFAULT_CALL_TIMEOUT):
+    """
+    Returns the given call timeout, shortened to the time left until the
+    deadline of the call budget of the current request, if any.
+    """
+    budget = get_budget()
+    if budget is None:
+        return timeout
+    return budget.get_timeout(timeout)
+
+
+def run_concurrently(calls, timeout=DEFAULT_CALL_TIMEOUT, executor=None):
+    """
+    Runs a list of zero-argument callables concurrently (on the shared
+    thread pool, or the given executor) and yields `(index, result)`
+    tuples in the order the calls complete, where the index is the
+    position of the call in the list.
+
+    Every call is given `timeout` seconds (they all start at the same
+    time), or less if the deadline of the call budget comes first; a
+    timeout of None only waits until that deadline, if any. Calls that
+    have not finished by then are skipped, so the caller may receive
+    fewer results than calls, and the budget is marked as degraded. If
+    none of them finished, TimeoutError is raised, unless it was the
+    budget deadline that cut them short. Exceptions raised by a call are
+    propagated to the caller.
+
+    NOTE: threads cannot be interrupted, so a timed out call keeps
+    running in the background until the HTTP client gives up on it.
+    """
+    call_timeout = get_call_timeout(timeout)
+    executor = executor or get_executor()
+    futures = {_submit(executor, call): i for i, call in enumerate(calls)}
+    completed = 0
+    try:
+        for future in as_completed(futures, timeout=call_timeout):
+            completed += 1
+            yield futures[future], future.result()
+    except FuturesTimeoutError:
+        mark_degraded()
+        if (not completed and timeout is not None
+                and call_timeout >= timeout):
+            raise TimeoutError('None of the calls finished in time.')
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,212 @@
+from math import asin, cos, degrees, radians, sin, sqrt
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+_MAX_POLYLINE_ELEMENTS = 1000000
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_GEOHASH_BITS = {c: i for i, c in enumerate(_GEOHASH_BASE32)}
+
+
+def haversine_distance(a, b):
+    """
+    Returns the great-circle distance in meters between two
+    `(latitude, longitude)` points.
+    """
+    lat1, lng1 = map(radians, a)
+    lat2, lng2 = map(radians, b)
+    h = (sin((lat2 - lat1) / 2) ** 2
+         + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(h)))
+
+
+def geohash_encode(location, precision):
+    """
+    Returns the geohash of the cell with the given precision (number of
+    characters) that contains the `(latitude, longitude)` point.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            value, value_range = location[1], lng_range
+        else:
+            value, value_range = location[0], lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits = bits << 1
+            value_range[1] = mid
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def geohash_bounds(geohash):
+    """
+    Returns the `(min_lat, min_lng, max_lat, max_lng)` bounds of the
+    cell with the given geohash.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+
+    for c in geohash:
+        bits = _GEOHASH_BITS[c]
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def geohash_center(geohash):
+    """
+    Returns the `(latitude, longitude)` center of the cell with the
+    given geohash.
+    """
+    min_lat, min_lng, max_lat, max_lng = geohash_bounds(geohash)
+    return (min_lat + max_lat) / 2, (min_lng + max_lng) / 2
+
+
+def offset_location(location, north, east):
+    """
+    Returns the `(latitude, longitude)` point that is `north` meters to
+    the north and `east` meters to the east of the given point, using
+    a local flat-earth approximation.
+    """
+    lat, lng = location
+    dlat = degrees(north / EARTH_RADIUS)
+    dlng = degrees(east / (EARTH_RADIUS * cos(radians(lat))))
+    return lat + dlat, lng + dlng
+
+
+def geohash_cell_size(precision):
+    """
+    Returns the `(lat_size, lng_size)` in degrees of the cells with the
+    given geohash precision.
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_cover(bounds, max_cells):
+    """
+    Returns the geohashes of the cells that cover the given
+    `(min_lat, min_lng, max_lat, max_lng)` bounds, using the finest
+    precision for which at most `max_cells` cells are needed.
+    """
+    min_lat, min_lng, max_lat, max_lng = bounds
+    cells = [geohash_encode((min_lat, min_lng), 1)]
+
+    for precision in range(1, 13):
+        lat_size, lng_size = geohash_cell_size(precision)
+        lat_start = (min_lat + 90.0) // lat_size * lat_size - 90.0
+        lng_start = (min_lng + 180.0) // lng_size * lng_size - 180.0
+        rows = int((max_lat - lat_start) // lat_size) + 1
+        cols = int((max_lng - lng_start) // lng_size) + 1
+        if rows * cols > max_cells:
+            break
+
+        cells = [
+            geohash_encode((
+                min(lat_start + (i + 0.5) * lat_size, 90.0),
+                min(lng_start + (j + 0.5) * lng_size, 180.0),
+            ), precision)
+            for i in range(rows)
+            for j in range(cols)
+        ]
+
+    return cells
+
+
+def haversine_distances(lat1, lng1, lat2, lng2):
+    """
+    Vectorized version of haversine_distance, which takes NumPy arrays
+    (or scalars) of latitudes and longitudes in degrees and returns the
+    broadcast array of distances in meters.
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def distances_to_polyline(points, polyline):
+    """
+    Returns the distance in meters from each point to the nearest point
+    of a polyline, as a NumPy array. Both are arrays of `(latitude,
+    longitude)` rows.
+
+    Every point is projected onto every segment at once, using a local
+    flat-earth approximation around the start of each segment, and the
+    distance to the projection is then computed with the haversine
+    formula.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    polyline = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    if len(polyline) == 1:
+        return haversine_distances(
+            points[:, 0], points[:, 1], polyline[0, 0], polyline[0, 1])
+
+    # Bound the size of the points by segments arrays.
+    chunk = max(1, _MAX_POLYLINE_ELEMENTS // (len(polyline) - 1))
+    return np.concatenate([
+        _distances_to_segments(points[i:i + chunk], polyline)
+        for i in range(0, len(points), chunk)
+    ] or [np.empty(0)])
+
+
+def _distances_to_segments(points, polyline):
+    start = polyline[:-1][None, :, :]
+    end = polyline[1:][None, :, :]
+    p = points[:, None, :]
+
+    scale = np.cos(np.radians(start[..., 0]))
+    seg_y = end[..., 0] - start[..., 0]
+    seg_x = (end[..., 1] - start[..., 1]) * scale
+    rel_y = p[..., 0] - start[..., 0]
+    rel_x = (p[..., 1] - start[..., 1]) * scale
+
+    length = seg_x ** 2 + seg_y ** 2
+    safe_length = np.where(length > 0, length, 1.0)
+    t = np.where(
+        length > 0, (rel_x * seg_x + rel_y * seg_y) / safe_length, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    nearest_lat = start[..., 0] + t * seg_y
+    nearest_lng = start[..., 1] + t * (end[..., 1] - start[..., 1])
+
+    distances = haversine_distances(
+        p[..., 0], p[..., 1], nearest_lat, nearest_lng)
+    return distances.min(axis=1)
+
+
+def polyline_lengths(polyline):
+    """
+    Returns the cumulative distance in meters along a polyline at each
+    of its points, as a NumPy array starting at 0.
+    """
+    polyline = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    legs = haversine_distances(
+        polyline[:-1, 0], polyline[:-1, 1], polyline[1:, 0], polyline[1:, 1])
+    return np.concatenate(([0.0], np.cumsum(legs)))
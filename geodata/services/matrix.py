@@ -0,0 +1,350 @@
+from math import ceil
+
+import numpy as np
+from common.apis.budget import mark_degraded
+from common.apis.ratelimit import QuotaExceeded
+from django.core.cache import caches
+
+from .cache import GEODATA_CACHE_ALIAS, LRUCache
+from .geo import haversine_distance
+from .metrics import record_cache_lookups
+from .store import place_store as default_place_store
+
+DEFAULT_TRAVEL_MODE = 'driving'
+
+# Element limits of the Distance Matrix API
+MAX_MATRIX_ORIGINS = 25
+MAX_MATRIX_DESTINATIONS = 25
+MAX_MATRIX_ELEMENTS = 100
+
+TRAVEL_TIME_LOCAL_MAX_ENTRIES = 200000
+TRAVEL_TIME_LOCAL_TTL = 30 * 60
+TRAVEL_TIME_SHARED_TTL = 7 * 24 * 60 * 60
+
+# Used to estimate travel times when they cannot be fetched, from the
+# straight-line distance (in meters per second, and as a ratio of the
+# actual distance to the straight-line one).
+ESTIMATED_SPEEDS = {
+    'driving': 8.0,
+    'walking': 1.3,
+    'bicycling': 4.0,
+    'transit': 6.0,
+}
+ESTIMATED_DETOUR_RATIO = 1.3
+
+# Marks a pair of places that cannot be traveled between, since the
+# cache cannot tell a missing key from a stored None.
+_UNREACHABLE = -1.0
+
+
+def _place_waypoint(place_id):
+    return f'place_id:{place_id}'
+
+
+def get_time_bucket(departure_time):
+    """
+    Returns the time bucket of a departure time, which is its hour of
+    the week, or `any` if no departure time is given. Travel times in
+    traffic are assumed to repeat every week.
+    """
+    if departure_time is None:
+        return 'any'
+    return str(departure_time.weekday() * 24 + departure_time.hour)
+
+
+def get_block_size(origin_count, destination_count):
+    """
+    Returns the `(origins, destinations)` block size that covers an
+    origins by destinations matrix in the fewest calls within the
+    element limits of the Distance Matrix API.
+    """
+    best = None
+    for destinations in range(1, min(destination_count,
+                                     MAX_MATRIX_DESTINATIONS) + 1):
+        origins = min(origin_count, MAX_MATRIX_ORIGINS,
+                      MAX_MATRIX_ELEMENTS // destinations)
+        calls = (ceil(origin_count / origins)
+                 * ceil(destination_count / destinations))
+        if best is None or calls < best[0]:
+            best = (calls, origins, destinations)
+    return best[1], best[2]
+
+
+def plan_matrix_calls(pairs):
+    """
+    Returns a list of `(origins, destinations)` calls that together
+    cover the given `(origin, destination)` pairs, trying to make as few
+    calls as possible.
+
+    Two plans are compared. In the first one, origins that are missing
+    the same set of destinations are grouped, so every group is a full
+    origins by destinations matrix that is split into blocks; no
+    element outside the pairs is requested. In the second one, the
+    matrix of all origins by all destinations is split into blocks,
+    skipping the blocks without any of the pairs and trimming the
+    others to the origins and destinations they need. The plan with
+    fewer calls is returned.
+    """
+    destinations_by_origin = {}
+    for origin, destination in pairs:
+        destinations_by_origin.setdefault(origin, set()).add(destination)
+
+    grouped = {}
+    for origin, destinations in destinations_by_origin.items():
+        key = tuple(sorted(destinations))
+        grouped.setdefault(key, []).append(origin)
+    grouped_calls = []
+    for destinations, origins in grouped.items():
+        grouped_calls.extend(_split_block(origins, list(destinations)))
+
+    pairs = set(pairs)
+    all_origins = sorted(destinations_by_origin)
+    all_destinations = sorted({d for _, d in pairs})
+    block_calls = []
+    for origins, destinations in _split_block(all_origins, all_destinations):
+        origins = [o for o in origins
+                   if any((o, d) in pairs for d in destinations)]
+        destinations = [d for d in destinations
+                        if any((o, d) in pairs for o in origins)]
+        if origins:
+            block_calls.append((origins, destinations))
+
+    return min(grouped_calls, block_calls, key=len)
+
+
+def _split_block(origins, destinations):
+    origin_step, destination_step = get_block_size(
+        len(origins), len(destinations))
+    return [
+        (origins[i:i + origin_step], destinations[j:j + destination_step])
+        for i in range(0, len(origins), origin_step)
+        for j in range(0, len(destinations), destination_step)
+    ]
+
+
+class TravelTimeMatrixService:
+    """
+    Fetches and caches travel times (in seconds) between places,
+    identified by their place IDs.
+
+    Travel times are cached per pair of places, travel mode and time
+    bucket, in both the in-process cache and the shared `geodata` cache
+    (which is persistent). When a matrix is requested, only the pairs
+    that are not cached are fetched from the Distance Matrix API, in as
+    few calls as the element limits allow. This way overlapping
+    matrices (e.g. the same route with one more place) reuse each
+    other's travel times.
+
+    In symmetric mode (the default), the travel time from A to B is
+    assumed to be the same as from B to A, so only one direction of
+    every pair is fetched. This halves the API usage at the cost of
+    ignoring one-way streets and the like.
+
+    When a call is refused because the quota or the call budget is used
+    up, the travel times it would have fetched are estimated from the
+    locations in the place store instead (and are not cached).
+    """
+
+    def __init__(
+        self,
+        symmetric=True,
+        local_max_entries=TRAVEL_TIME_LOCAL_MAX_ENTRIES,
+        local_ttl=TRAVEL_TIME_LOCAL_TTL,
+        shared_ttl=TRAVEL_TIME_SHARED_TTL,
+        cache_alias=GEODATA_CACHE_ALIAS,
+        place_store=None,
+    ):
+        self.symmetric = symmetric
+        self.place_store = place_store or default_place_store
+        self.local = LRUCache(local_max_entries, local_ttl)
+        self.shared_ttl = shared_ttl
+        self.cache_alias = cache_alias
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _pair(self, origin, destination):
+        if self.symmetric and destination < origin:
+            return destination, origin
+        return origin, destination
+
+    def _key(self, pair, mode, bucket):
+        return f'tt:{mode}:{bucket}:{pair[0]}:{pair[1]}'
+
+    def get_matrix(
+        self,
+        maps_client,
+        place_ids,
+        mode=DEFAULT_TRAVEL_MODE,
+        departure_time=None,
+    ):
+        """
+        Returns the travel time matrix between the given places as a
+        NumPy array, where the element `[i, j]` is the travel time from
+        the i-th place to the j-th place. Pairs that cannot be traveled
+        between have an infinite travel time.
+        """
+        return self.get_travel_times(
+            maps_client, place_ids, place_ids, mode, departure_time)
+
+    def get_travel_times(
+        self,
+        maps_client,
+        origins,
+        destinations,
+        mode=DEFAULT_TRAVEL_MODE,
+        departure_time=None,
+    ):
+        """
+        Same as get_matrix, but for travel times from a list of origins
+        to a list of destinations, so that only the pairs that are
+        actually needed are fetched.
+        """
+        origins = list(origins)
+        destinations = list(destinations)
+        times = self._get_times(maps_client, [
+            (origin, destination)
+            for origin in origins
+            for destination in destinations
+        ], mode, departure_time)
+
+        matrix = np.zeros((len(origins), len(destinations)))
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                if origin != destination:
+                    value = times[self._pair(origin, destination)]
+                    matrix[i, j] = np.inf if value == _UNREACHABLE else value
+        return matrix
+
+    def get_pair_travel_times(
+        self,
+        maps_client,
+        pairs,
+        mode=DEFAULT_TRAVEL_MODE,
+        departure_time=None,
+    ):
+        """
+        Same as get_travel_times, but for a list of `(origin,
+        destination)` pairs, such as the legs of a route, whose travel
+        times are returned as a NumPy array in the same order.
+        """
+        pairs = list(pairs)
+        times = self._get_times(maps_client, pairs, mode, departure_time)
+
+        values = np.zeros(len(pairs))
+        for i, (origin, destination) in enumerate(pairs):
+            if origin != destination:
+                value = times[self._pair(origin, destination)]
+                values[i] = np.inf if value == _UNREACHABLE else value
+        return values
+
+    def _get_times(self, maps_client, pairs, mode, departure_time):
+        """
+        Returns the travel times of the given `(origin, destination)`
+        pairs (but those from a place to itself), by pair as returned by
+        _pair, from the caches or else fetched.
+        """
+        bucket = get_time_bucket(departure_time)
+        pairs = {
+            self._pair(origin, destination)
+            for origin, destination in pairs
+            if origin != destination
+        }
+
+        times = {}
+        missing = []
+        for pair in pairs:
+            value = self.local.get(self._key(pair, mode, bucket))
+            if value is None:
+                missing.append(pair)
+            else:
+                times[pair] = value
+        local_hits = len(pairs) - len(missing)
+
+        if missing:
+            keys = {self._key(pair, mode, bucket): pair for pair in missing}
+            found = self.shared.get_many(keys.keys())
+            for key, value in found.items():
+                self.local.set(key, value)
+                times[keys[key]] = value
+            missing = [keys[k] for k in keys if k not in found]
+
+        record_cache_lookups(
+            'travel_time',
+            local=local_hits,
+            shared=len(pairs) - local_hits - len(missing),
+            miss=len(missing),
+        )
+        if missing:
+            fetched, refused = self._fetch(
+                maps_client, missing, mode, departure_time)
+            values = {
+                self._key(p, mode, bucket): v for p, v in fetched.items()}
+            for key, value in values.items():
+                self.local.set(key, value)
+            if values:
+                self.shared.set_many(values, timeout=self.shared_ttl)
+            times.update(fetched)
+            if refused:
+                times.update(self._estimate(refused, mode))
+        return times
+
+    def _fetch(self, maps_client, pairs, mode, departure_time):
+        """
+        Fetches the travel times of the given pairs. Returns a tuple of
+        the dict of travel times by pair, and the list of pairs whose
+        calls were refused.
+        """
+        kwargs = {'mode': mode}
+        if departure_time is not None:
+            kwargs['departure_time'] = departure_time
+
+        pairs = set(pairs)
+        times = {}
+        refused = []
+        for origins, destinations in plan_matrix_calls(pairs):
+            try:
+                response = maps_client.distance_matrix(
+                    [_place_waypoint(p) for p in origins],
+                    [_place_waypoint(p) for p in destinations],
+                    **kwargs,
+                )
+            except QuotaExceeded:
+                refused.extend(
+                    (o, d) for o in origins for d in destinations
+                    if (o, d) in pairs)
+                continue
+            for origin, row in zip(origins, response['rows']):
+                for destination, element in zip(destinations, row['elements']):
+                    value = _UNREACHABLE
+                    if element['status'] == 'OK':
+                        duration = element.get('duration_in_traffic',
+                                               element['duration'])
+                        value = float(duration['value'])
+                    times[(origin, destination)] = value
+        return times, refused
+
+    def _estimate(self, pairs, mode):
+        """
+        Estimates the travel times of the given pairs from the stored
+        locations of the places. Pairs with a place that is not in the
+        store are unreachable.
+        """
+        mark_degraded()
+        locations = self.place_store.get_locations(
+            {place_id for pair in pairs for place_id in pair})
+        speed = ESTIMATED_SPEEDS.get(mode, ESTIMATED_SPEEDS['driving'])
+        times = {}
+        for origin, destination in pairs:
+            if origin in locations and destination in locations:
+                distance = haversine_distance(
+                    locations[origin], locations[destination])
+                times[(origin, destination)] = (
+                    distance * ESTIMATED_DETOUR_RATIO / speed)
+            else:
+                times[(origin, destination)] = _UNREACHABLE
+        return times
+
+
+travel_time_matrix_service = TravelTimeMatrixService()
@@ -0,0 +1,77 @@
+import time
+from functools import wraps
+
+from common.metrics import Counter, Gauge, Histogram
+
+CACHE_RESULTS = ('local', 'shared', 'miss')
+
+SERVICE_LATENCY = Histogram(
+    'geodata_service_duration_seconds',
+    'Latency of the geodata service methods, in seconds.',
+    ['service', 'method'],
+)
+SERVICE_ERRORS = Counter(
+    'geodata_service_errors',
+    'Calls of the geodata service methods that failed, by error.',
+    ['service', 'method', 'error'],
+)
+CACHE_LOOKUPS = Counter(
+    'geodata_cache_lookups',
+    'Lookups in the geodata caches, by result: a hit in the local tier, '
+    'a hit in the shared tier, or a miss.',
+    ['cache', 'result'],
+)
+
+
+def get_cache_hit_ratios():
+    """
+    Returns the share of lookups of every cache that were hits (in
+    either tier), by cache name.
+    """
+    totals = {}
+    for (cache, result), count in CACHE_LOOKUPS.items():
+        hits, lookups = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (result != 'miss') * count, lookups + count)
+    return {
+        (cache,): hits / lookups
+        for cache, (hits, lookups) in totals.items()
+        if lookups
+    }
+
+
+CACHE_HIT_RATIO = Gauge(
+    'geodata_cache_hit_ratio',
+    'Share of the lookups in the geodata caches that were hits, since '
+    'the process started.',
+    ['cache'],
+    callback=get_cache_hit_ratios,
+)
+
+
+def record_cache_lookups(cache, local=0, shared=0, miss=0):
+    for result, count in zip(CACHE_RESULTS, (local, shared, miss)):
+        if count:
+            CACHE_LOOKUPS.inc(count, cache=cache, result=result)
+
+
+def instrumented(method):
+    """
+    Decorates a service method to measure its latency and count its
+    errors, labeled by the class and method names.
+    """
+    service, name = method.__qualname__.split('.')[-2:]
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            SERVICE_ERRORS.inc(service=service, method=name,
+                               error=type(e).__name__)
+            raise
+        finally:
+            SERVICE_LATENCY.observe(time.perf_counter() - started,
+                                    service=service, method=name)
+
+    return wrapper
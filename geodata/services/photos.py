@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import weakref
+from collections import namedtuple
+
+from common.apis.maps import MAX_PHOTO_SIZE
+from common.apis.singleflight import AsyncSingleFlight
+from django.conf import settings
+from googlemaps import exceptions
+
+from .concurrency import run_in_thread
+from .metrics import record_cache_lookups
+
+PHOTO_CACHE_MAX_BYTES = 1024 ** 3
+# When the cache overflows, it is trimmed down to this share of its
+# maximum size, so that evictions (which scan the whole cache) are not
+# run on every write.
+PHOTO_CACHE_LOW_WATER = 0.9
+# Served photos are touched at most this often (in seconds), which keeps
+# their LRU order without a write on every hit.
+PHOTO_TOUCH_INTERVAL = 60 * 60
+# Contents can be evicted (by any worker) between finding and opening
+# them, in which case they are fetched again, at most this many times.
+PHOTO_OPEN_ATTEMPTS = 3
+MAX_PHOTO_BYTES = 10 * 1024 ** 2
+# Sizes (in pixels) that requested photo sizes are rounded up to, so that
+# nearly the same requests share cached photos.
+PHOTO_SIZES = (100, 200, 400, 800, 1600, 3200, MAX_PHOTO_SIZE)
+
+CachedPhoto = namedtuple('CachedPhoto', ['path', 'digest', 'size',
+                                         'content_type'])
+
+
+def round_photo_size(size):
+    """
+    Rounds a photo size up to one of PHOTO_SIZES, or returns None if the
+    size is None.
+    """
+    if size is None:
+        return None
+    return next((s for s in PHOTO_SIZES if s >= size), PHOTO_SIZES[-1])
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _scan(directory):
+    """Yields the entries in the subdirectories of a directory."""
+    try:
+        subdirs = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for subdir in subdirs:
+        if subdir.is_dir(follow_symlinks=False):
+            yield from os.scandir(subdir.path)
+
+
+class PhotoCache:
+    """
+    On-disk cache of place photos, shared by the workers of a host.
+
+    Photos are content-addressed: every content is stored once, under
+    the SHA-256 of its bytes (`blobs/ab/abcd….jpg`), and every photo
+    request (a photo name and size) is a symlink to its content, named
+    after the SHA-1 of the request (`refs/…`). Files are written to a
+    temporary file and then renamed, so readers never see a partial
+    file, and photos can be served straight from disk.
+
+    The size of the contents is kept under `max_bytes` by evicting the
+    least recently used ones, by modification time, which is refreshed
+    when a photo is served (see PHOTO_TOUCH_INTERVAL). Symlinks to
+    evicted contents are removed along with them.
+
+    NOTE: the size of the cache is tracked per process and only counted
+    again on eviction, so with several workers the cache may grow past
+    `max_bytes` by the photos written since each worker last evicted.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        self._flights = weakref.WeakKeyDictionary()
+
+    @property
+    def directory(self):
+        return str(self._directory or settings.GEODATA_PHOTO_CACHE_DIR)
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes or getattr(
+            settings, 'GEODATA_PHOTO_CACHE_MAX_BYTES', PHOTO_CACHE_MAX_BYTES)
+
+    def _ref_path(self, name, width, height):
+        key = hashlib.sha1(f'{name}:{width}x{height}'.encode()).hexdigest()
+        return os.path.join(self.directory, 'refs', key[:2], key)
+
+    def _blob_path(self, digest, content_type):
+        extension = mimetypes.guess_extension(content_type or '') or ''
+        return os.path.join(
+            self.directory, 'blobs', digest[:2], digest + extension)
+
+    def lookup(self, name, width=None, height=None):
+        """
+        Returns the CachedPhoto of a photo request, or None if it is not
+        cached (or its content was evicted).
+        """
+        ref_path = self._ref_path(name, width, height)
+        try:
+            stat = os.stat(ref_path)
+            blob_path = os.path.realpath(ref_path)
+        except FileNotFoundError:
+            if os.path.lexists(ref_path):
+                _unlink(ref_path)
+            record_cache_lookups('photos', miss=1)
+            return None
+
+        if time.time() - stat.st_mtime > PHOTO_TOUCH_INTERVAL:
+            try:
+                os.utime(blob_path)
+            except FileNotFoundError:
+                pass
+        record_cache_lookups('photos', shared=1)
+        return self._get_photo(blob_path, stat.st_size)
+
+    def _get_photo(self, blob_path, size):
+        filename = os.path.basename(blob_path)
+        content_type, _ = mimetypes.guess_type(filename)
+        return CachedPhoto(
+            path=blob_path,
+            digest=filename.split('.', 1)[0],
+            size=size,
+            content_type=content_type or 'application/octet-stream',
+        )
+
+    def store(self, name, width, height, content, content_type):
+        """
+        Stores the content of a photo request (unless the same content
+        is already stored) and returns its CachedPhoto. Evicts the least
+        recently used contents if the cache overflows.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(digest, content_type)
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            self._write_atomic(blob_path, content)
+            self._add_size(len(content))
+
+        ref_path = self._ref_path(name, width, height)
+        target = os.path.relpath(blob_path, os.path.dirname(ref_path))
+        self._write_atomic(ref_path, target, symlink=True)
+        return self._get_photo(blob_path, len(content))
+
+    def _write_atomic(self, path, data, symlink=False):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        if symlink:
+            tmp_path = os.path.join(
+                tmp_dir, f'{os.getpid()}.{threading.get_ident()}.link')
+            _unlink(tmp_path)
+            os.symlink(data, tmp_path)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            _unlink(tmp_path)
+            raise
+
+    def _add_size(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(
+                    entry.stat().st_size
+                    for entry in _scan(os.path.join(self.directory, 'blobs')))
+            else:
+                self._size += size
+            overflows = self._size > self.max_bytes
+        if overflows:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Evicts the least recently used contents until they take at most
+        `max_bytes` (by default, PHOTO_CACHE_LOW_WATER of the maximum
+        size of the cache), then removes the symlinks to evicted
+        contents. Returns the number of evicted contents.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes * PHOTO_CACHE_LOW_WATER
+        with self._lock:
+            blobs = []
+            for entry in _scan(os.path.join(self.directory, 'blobs')):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+            blobs.sort()
+
+            size = sum(blob_size for _, blob_size, _ in blobs)
+            evicted = 0
+            for _, blob_size, path in blobs:
+                if size <= max_bytes:
+                    break
+                _unlink(path)
+                size -= blob_size
+                evicted += 1
+            if evicted:
+                for entry in _scan(os.path.join(self.directory, 'refs')):
+                    if not os.path.exists(entry.path):
+                        _unlink(entry.path)
+            self._size = size
+        return evicted
+
+    async def aget(self, maps_client, name, width=None, height=None):
+        """
+        Returns the CachedPhoto of a photo of a place, scaled down to fit
+        in the given size, fetching it through the given AsyncMapsClient
+        if it is not cached. Concurrent requests for the same photo are
+        coalesced into one fetch.
+        """
+        photo = await run_in_thread(self.lookup, name, width, height)
+        if photo is not None:
+            return photo
+        return await self._get_flights().do(
+            (name, width, height),
+            self._afetch, maps_client, name, width, height,
+        )
+
+    async def aopen(self, maps_client, name, width=None, height=None):
+        """
+        Returns the CachedPhoto of a photo of a place (see aget) along
+        with its content, opened for reading, which stays readable even
+        if the content is evicted afterwards. Contents evicted before
+        they could be opened are fetched again (see PHOTO_OPEN_ATTEMPTS),
+        after which FileNotFoundError is raised.
+        """
+        for attempt in range(PHOTO_OPEN_ATTEMPTS):
+            photo = await self.aget(maps_client, name, width, height)
+            try:
+                return photo, open(photo.path, 'rb')
+            except FileNotFoundError:
+                if attempt == PHOTO_OPEN_ATTEMPTS - 1:
+                    raise
+
+    def _get_flights(self):
+        # Calls can only be shared by the tasks of one event loop.
+        loop = asyncio.get_running_loop()
+        flights = self._flights.get(loop)
+        if flights is None:
+            flights = self._flights[loop] = AsyncSingleFlight()
+        return flights
+
+    async def _afetch(self, maps_client, name, width, height):
+        media = await maps_client.photo_media(name, width, height)
+        content, content_type = await maps_client.download_media(
+            media['photoUri'], MAX_PHOTO_BYTES)
+        content_type = (content_type or '').split(';', 1)[0].strip()
+        if not content_type.startswith('image/'):
+            raise exceptions.TransportError('The photo is not an image.')
+        return await run_in_thread(
+            self.store, name, width, height, content, content_type)
+
+
+photo_cache = PhotoCache()
@@ -1,8 +1,54 @@
-from ...common.apis.maps import MAX_RESTRICTION_RADIUS
+import asyncio
+from functools import partial
+
+import numpy as np
+from common.apis.budget import call_budget, mark_degraded
+from common.apis.maps import MAX_RESTRICTION_RADIUS
+from common.apis.ratelimit import QuotaExceeded
+from googlemaps import exceptions
+
+from .cache import nearby_search_cache, place_details_cache
+from .concurrency import (
+    DEFAULT_CALL_TIMEOUT,
+    get_call_timeout,
+    get_coordinator_executor,
+    run_concurrently,
+    run_in_thread,
+)
+from .metrics import instrumented
+from .ranking import fuse_scores, merge_rankings, select_top
+from .scoring import PreferenceScorer, get_compiled_preferences
+from .store import place_store as default_place_store
+from .tiling import (
+    DEFAULT_MAX_TILING_CALLS,
+    aiter_tiled_search,
+    iter_tiled_search,
+)
 
 INITIAL_DISTANCE_THRESHOLD = 1000.0
 DEFAULT_RESULT_PER_PAGE = 20
 DEFAULT_PLACE_FIELDS = tuple()
+# Maximum number of details calls of one batch that are in flight at once
+# (see aiter_places_details), so that a large batch cannot take all the
+# connections of the Maps client.
+MAX_DETAILS_CONCURRENCY = 8
+
+# Errors of a details call that only lose the place of the call, rather
+# than the whole batch (see get_places_details).
+_DETAILS_ERRORS = (
+    exceptions.HTTPError,
+    exceptions.Timeout,
+    exceptions.TransportError,
+)
+
+
+def _note_details_error(error):
+    # Invalid or removed place IDs are answered with client errors, which
+    # do not make the results partial, unlike any other error.
+    if not (isinstance(error, exceptions.HTTPError)
+            and error.status_code < 500):
+        mark_degraded()
+
 
 class PlacesService():
     """
@@ -10,9 +56,35 @@ class PlacesService():
     using the Places API and session data for personalized results.
     """
 
-    def __init__(self, maps_client, session):
+    def __init__(
+        self,
+        maps_client,
+        session,
+        place_cache=None,
+        nearby_cache=None,
+        place_store=None,
+        concurrent=True,
+        call_timeout=DEFAULT_CALL_TIMEOUT,
+    ):
         self.maps_client = maps_client
         self.session = session
+        self.place_cache = place_cache or place_details_cache
+        self.nearby_cache = nearby_cache or nearby_search_cache
+        self.place_store = place_store or default_place_store
+        self.concurrent = concurrent
+        self.call_timeout = call_timeout
+        self._scorer = None
+
+    @property
+    def scorer(self):
+        """
+        The preference scorer of the session user, which remembers the
+        scores of places scored during the lifetime of this service.
+        """
+        if self._scorer is None:
+            self._scorer = PreferenceScorer(
+                get_compiled_preferences(self.session['user']))
+        return self._scorer
 
     def _get_preference_score(
         self,
@@ -36,65 +108,289 @@ class PlacesService():
         (the function returns immediately). Otherwise if False then it
         fixes the score to -1. If no such keys are found, return 0.
 
-        We might implement a caching solution if the score is not so
-        fast to compute.
+        If the ranks of the place in the results ranked by distance and
+        by popularity are given, they are fused into the score (see
+        fuse_scores), which then goes slightly beyond that scale.
+
+        Scores are remembered by the scorer, so the place details are
+        only looked up the first time a place ID is scored. Prefer
+        scoring place dicts directly through sort_places_by_preference
+        when they are already available.
         """
-        place = self.get_place_details(place_id, fields=['types'])
-        for type_str in place['types']:
-            v = self.session['user'].preferences.get(type_str, None)
-            if v is not None:
-                return 1 if v else -1
-        return 0
+        score = self.scorer.get_cached_score(place_id)
+        if score is None:
+            place = self.get_place_details(
+                place_id, fields=self._get_relevant_fields_for_preference())
+            score = self.scorer.score({'id': place_id, **place})
+        ranks = [r for r in (distance_rank, popularity_rank) if r is not None]
+        if ranks:
+            ranks = np.array(ranks).reshape(-1, 1)
+            score = float(fuse_scores(ranks, [score])[0])
+        return score
+
+    def _get_preference_scores(self, place_ids):
+        """
+        Batch version of _get_preference_score (without ranks), which
+        returns a dict mapping the given place IDs to their scores. The
+        details of the places that were not scored yet are looked up at
+        once with get_places_details.
+        """
+        scores = {}
+        unscored = []
+        for place_id in dict.fromkeys(place_ids):
+            score = self.scorer.get_cached_score(place_id)
+            if score is None:
+                unscored.append(place_id)
+            else:
+                scores[place_id] = score
+        if unscored:
+            places = self.get_places_details(
+                unscored, fields=self._get_relevant_fields_for_preference())
+            for place_id in unscored:
+                scores[place_id] = self.scorer.score(
+                    {'id': place_id, **places.get(place_id, {})})
+        return scores
 
     def _get_relevant_fields_for_preference(self):
         """
         Returns a list of fields that are needed to calculate a place's
         preference score.
 
-        NOTE: see the _assign_preference_scores function.
+        NOTE: see the _get_preference_score function.
         """
         return ['types']
 
+    @instrumented
     def get_place_details(self, place_id, fields=DEFAULT_PLACE_FIELDS):
         """
         Returns information corresponding to the fields list about a
         place given its ID.
 
-        NOTE: currently this function calls the API directly; we will
-        use a caching/temporary storage solution later.
+        Fields are looked up in the place details cache first, and only
+        the fields that are missing from it are requested from the API.
+        The fetched fields are then merged with the cached ones. If the
+        quota of the API is used up, only the cached fields are returned.
         """
-        return self.maps_client.place(place_id, fields)
+        place, missing = self.place_cache.get_fields(place_id, fields)
+        if missing:
+            try:
+                self._fetch_place_details(place_id, place, missing)
+            except QuotaExceeded:
+                mark_degraded()
+        return place
 
-    def sort_places_by_preference(
+    def _fetch_place_details(self, place_id, place, missing):
+        """
+        Requests the missing fields of a place from the API, and merges
+        them into the place dict of its cached fields.
+        """
+        response = self.maps_client.place(place_id, missing)
+        self._store_place_details(place_id, place, missing, response)
+        return place
+
+    def _store_place_details(self, place_id, place, missing, response):
+        self.place_cache.set_fields(place_id, missing, response)
+        if 'location' in response:
+            self.place_store.ingest([{'id': place_id, **response}])
+        place.update((f, response[f]) for f in missing if f in response)
+
+    @instrumented
+    def get_places_details(self, place_ids, fields=DEFAULT_PLACE_FIELDS):
+        """
+        Batch version of get_place_details, which returns a dict mapping
+        the given place IDs (once each, in order) to their information.
+
+        The fields of all the places are looked up in the cache at once,
+        and the places with missing fields are then requested from the
+        API concurrently (unless the service was created with
+        `concurrent=False`). Places whose call is refused, fails or times
+        out, such as places with an invalid ID, are left out of the
+        results.
+        """
+        cached = self.place_cache.get_many_fields(
+            list(dict.fromkeys(place_ids)), fields)
+        places = {}
+        misses = []
+        for place_id, (place, missing) in cached.items():
+            if missing:
+                misses.append((place_id, place, missing))
+            else:
+                places[place_id] = place
+
+        fetches = [
+            partial(self._try_fetch_place_details, *miss) for miss in misses]
+        for i, place in self._run_searches(fetches):
+            if place is not None:
+                places[misses[i][0]] = place
+        return {
+            place_id: places[place_id]
+            for place_id in cached if place_id in places
+        }
+
+    def _try_fetch_place_details(self, place_id, place, missing):
+        try:
+            return self._fetch_place_details(place_id, place, missing)
+        except QuotaExceeded:
+            mark_degraded()
+            return None
+        except _DETAILS_ERRORS as e:
+            _note_details_error(e)
+            return None
+
+    async def aiter_places_details(
         self,
+        maps_client,
         place_ids,
-        filter_by_preference=True
+        fields=DEFAULT_PLACE_FIELDS,
+        max_concurrency=MAX_DETAILS_CONCURRENCY,
+    ):
+        """
+        Streaming version of get_places_details, which requests the
+        missing fields through the given AsyncMapsClient and yields lists
+        of place dicts (with their `id`): first the places answered by
+        the cache, then every fetched place as soon as it arrives. At
+        most `max_concurrency` calls are in flight at once, and the
+        places that are not fetched within the call timeout are left
+        out.
+        """
+        cached = await run_in_thread(
+            self.place_cache.get_many_fields,
+            list(dict.fromkeys(place_ids)),
+            fields,
+        )
+        places = [
+            {'id': place_id, **place}
+            for place_id, (place, missing) in cached.items() if not missing
+        ]
+        if places:
+            yield places
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(place_id, place, missing):
+            async with semaphore:
+                try:
+                    response = await maps_client.place(place_id, missing)
+                except QuotaExceeded:
+                    mark_degraded()
+                    return place_id, None
+                except _DETAILS_ERRORS as e:
+                    _note_details_error(e)
+                    return place_id, None
+            await run_in_thread(self._store_place_details,
+                                place_id, place, missing, response)
+            return place_id, place
+
+        tasks = [
+            asyncio.ensure_future(fetch(place_id, place, missing))
+            for place_id, (place, missing) in cached.items() if missing
+        ]
+        try:
+            for next_done in asyncio.as_completed(
+                tasks, timeout=get_call_timeout(self.call_timeout),
+            ):
+                place_id, place = await next_done
+                if place is not None:
+                    yield [{'id': place_id, **place}]
+        except asyncio.TimeoutError:
+            mark_degraded()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @instrumented
+    def sort_places_by_preference(
+        self,
+        places,
+        filter_by_preference=True,
+        max_count=None,
     ):
         """
         Sorts (and optionally filters) a list of places by preference,
         then returns a dictionary mapping the sorted places to their
         respective scores.
+
+        The places can be given either as place dicts containing the
+        `id` and `types` fields (as returned by a nearby search), which
+        are scored without any further requests, or as place IDs, whose
+        details are looked up first (all at once). Duplicate places are
+        only kept once, and places with equal scores keep their original
+        order.
+        Only the best `max_count` places are returned, if given.
         """
-        sorted_places = sorted(place_ids, key=self._get_preference_score)
+        id_scores = self._get_preference_scores(
+            [place for place in places if isinstance(place, str)])
+        scores = {}
+        for place in places:
+            if isinstance(place, str):
+                scores.setdefault(place, id_scores[place])
+            elif place['id'] not in scores:
+                scores[place['id']] = self.scorer.score(place)
+
+        place_ids = list(scores)
+        values = list(scores.values())
+        eligible = None
         if filter_by_preference:
-            return filter(lambda p: p >= 0, sorted_places)
-        else:
-            return sorted_places
+            eligible = [i for i, score in enumerate(values) if score >= 0]
+        return {
+            place_ids[i]: values[i]
+            for i in select_top(values, max_count, eligible)
+        }
+
+    @instrumented
+    def rank_places(
+        self,
+        rankings,
+        filter_by_preference=True,
+        max_count=None,
+    ):
+        """
+        Merges ranked lists of place dicts (with the `id` and `types`
+        fields), such as the results of nearby searches ranked by
+        distance and by popularity, and ranks the places by their fused
+        score: the reciprocal rank fusion of their ranks in the lists
+        plus their preference score (see fuse_scores). Returns a
+        dictionary mapping the best `max_count` place IDs (or all of
+        them) to their fused scores, from the best.
 
+        Scores are computed over arrays of all the places, but only the
+        best ones are selected and sorted, so ranking costs little more
+        than scoring when there are many candidates.
+        """
+        candidates, ranks = merge_rankings(rankings)
+        if not candidates:
+            return {}
+
+        preference_scores = np.array(
+            [self.scorer.score(place) for place in candidates], dtype=float)
+        scores = fuse_scores(ranks, preference_scores)
+        eligible = None
+        if filter_by_preference:
+            eligible = np.flatnonzero(preference_scores >= 0).tolist()
+        return {
+            candidates[i]['id']: float(scores[i])
+            for i in select_top(scores, max_count, eligible)
+        }
+
+    @instrumented
     def get_nearby_places_sorted(
         self,
         location,
         max_distance=INITIAL_DISTANCE_THRESHOLD,
         location_restriction=None,
         additional_preferences=None,
+        max_count=None,
     ):
         """
         Returns a list of places near the given location, sorted by
         user preferences.
         
         The results are combined from two API responses: one is ranked
-        by distance and the other by popularity. They are then filtered
-        and sorted by preference score.
+        by distance and the other by popularity. Both requests are sent
+        concurrently unless the service was created with
+        `concurrent=False`. They are then merged, filtered and ranked by
+        their preference score and their ranks in both responses (see
+        rank_places), and the best `max_count` of them are returned.
 
         Since the Places v2 API can only output at most 20 results per
         request, the function will likewise return a limited number of
@@ -105,45 +401,153 @@ class PlacesService():
         if max_distance > MAX_RESTRICTION_RADIUS:
             raise ValueError('The max_distance value is too large.')
 
-        relevant_fields = self._get_relevant_fields_for_preference()
-        places_sorted_by_distance = self.maps_client.places_nearby_v2(
-            location,
-            max_distance,
-            fields=relevant_fields,
-            rank_preference='DISTANCE',
-        )['places']
-        places_sorted_by_popularity = self.maps_client.places_nearby_v2(
-            location,
-            max_distance,
-            fields=relevant_fields,
-            rank_preference='POPULARITY',
-        )['places']
+        relevant_fields = ['id', *self._get_relevant_fields_for_preference()]
+        searches = [
+            partial(
+                self._search_nearby,
+                location,
+                max_distance,
+                relevant_fields,
+                rank_preference=rank_preference,
+            )
+            for rank_preference in ('DISTANCE', 'POPULARITY')
+        ]
+
+        results = [[] for _ in searches]
+        for i, places in self._run_searches(searches):
+            # Score each response as soon as it arrives; the scores are
+            # remembered, so sorting below does not recompute them.
+            for place in places:
+                self.scorer.score(place)
+            results[i] = places
+
+        return self.rank_places(results, max_count=max_count)
+
+    def _search_nearby(self, location, radius, fields, **kwargs):
+        """
+        Returns the list of place dicts from a single nearby search,
+        which may be answered by the nearby search cache.
+        """
+        return self.nearby_cache.search(
+            self.maps_client, location, radius, fields, **kwargs,
+        ).get('places', [])
 
-        place_ids = [p['place_id'] for p in places_sorted_by_distance]
-        place_ids.extend(p['place_id'] for p in places_sorted_by_popularity)
-        return self.sort_places_by_preference(place_ids)
+    def _run_searches(self, searches):
+        """
+        Runs a list of search (or other API call) callables and yields
+        `(index, result)` tuples. In concurrent mode (the default) the
+        calls are sent together and yielded as they complete; calls that
+        exceed the call timeout are left out of the results.
+        """
+        if not self.concurrent:
+            return enumerate(search() for search in searches)
+        return run_concurrently(searches, timeout=self.call_timeout)
 
+    @instrumented
     def get_all_nearby_places_sorted(
         self,
         location,
+        max_distance=INITIAL_DISTANCE_THRESHOLD,
         location_restriction=None,
         additional_preferences=None,
+        max_api_calls=DEFAULT_MAX_TILING_CALLS,
+        max_count=None,
     ):
         """
         Returns a list of places near the given location, sorted by
         user preferences.
 
-        It works the same way as the get_nearby_places function, but
-        uses the old API to obtain more results. As such, the API
-        costs are significantly higher and it should be used sparingly.
+        It works the same way as the get_nearby_places_sorted function,
+        but splits the search circle into smaller ones whenever a search
+        returns the maximum number of results, to obtain more results.
+        As such, the API costs are significantly higher and it should be
+        used sparingly; at most `max_api_calls` searches are made. The
+        places of every search are ranked by popularity within it.
+
+        NOTE: we are currently ignoring location_restriction.
+        """
+        batches = list(self.iter_all_nearby_places(
+            location, max_distance, max_api_calls=max_api_calls,
+        ))
+        return self.rank_places(batches, max_count=max_count)
+
+    def iter_all_nearby_places(
+        self,
+        location,
+        max_distance=INITIAL_DISTANCE_THRESHOLD,
+        max_api_calls=DEFAULT_MAX_TILING_CALLS,
+    ):
         """
-        pass
+        Streaming version of get_all_nearby_places_sorted, which yields
+        lists of newly found place dicts (with their `id`, `location` and
+        the fields needed for preference scoring) while the remaining
+        searches are still running. Each place is only yielded once.
+        """
+        fields = [
+            'id', 'location', *self._get_relevant_fields_for_preference()]
+
+        def search(tile_location, tile_radius):
+            return self.nearby_cache.search_places(
+                self.maps_client,
+                tile_location,
+                tile_radius,
+                fields,
+                rank_preference='POPULARITY',
+            )
+
+        return iter_tiled_search(
+            search,
+            location,
+            max_distance,
+            max_calls=max_api_calls,
+            call_timeout=self.call_timeout,
+        )
 
+    def aiter_all_nearby_places(
+        self,
+        maps_client,
+        location,
+        max_distance=INITIAL_DISTANCE_THRESHOLD,
+        max_api_calls=DEFAULT_MAX_TILING_CALLS,
+        circles=None,
+        leftover=None,
+    ):
+        """
+        Async version of iter_all_nearby_places, which searches through
+        the given AsyncMapsClient. The search can be resumed from the
+        `circles` that were left over by a previous one (see
+        aiter_tiled_search).
+        """
+        fields = [
+            'id', 'location', *self._get_relevant_fields_for_preference()]
+
+        async def search(tile_location, tile_radius):
+            return await self.nearby_cache.asearch_places(
+                maps_client,
+                tile_location,
+                tile_radius,
+                fields,
+                rank_preference='POPULARITY',
+            )
+
+        return aiter_tiled_search(
+            search,
+            location,
+            max_distance,
+            max_calls=max_api_calls,
+            call_timeout=self.call_timeout,
+            circles=circles,
+            leftover=leftover,
+        )
+
+    @instrumented
     def get_places_in_area_sorted(
         self,
         location_restriction=None,
         page=1,
         result_per_page=DEFAULT_RESULT_PER_PAGE,
+        cursor=None,
+        max_api_calls=DEFAULT_MAX_TILING_CALLS,
     ):
         """
         Returns a paginated list of places in the given area and
@@ -153,5 +557,77 @@ class PlacesService():
         the distance to a particular center is no longer a factor in
         the ranking. This is useful for exploring places in a specific
         area, such as a city or a country.
+
+        Places are read from the local place store. When the first page
+        is requested, the cells of the area that were never fetched (or
+        were fetched too long ago) are fetched from the API with tiled
+        searches first, using at most `max_api_calls` searches.
+
+        Returns a tuple of the dictionary mapping the place IDs of the
+        page to their scores, and the cursor of the next page (or None).
+        Pass the cursor to get the next page; `page` is only used when
+        no cursor is given.
+        """
+        if location_restriction is None:
+            raise ValueError('A location restriction is required.')
+
+        if cursor is None and page == 1:
+            self._refresh_area(location_restriction, max_api_calls)
+
+        return self.place_store.query_area(
+            location_restriction,
+            self.scorer.preferences,
+            cursor=cursor,
+            offset=(page - 1) * result_per_page,
+            limit=result_per_page,
+        )
+
+    def _refresh_area(self, location_restriction, max_api_calls):
+        """
+        Fetches the places of the stale cells of an area into the place
+        store, splitting the API call budget between the cells, which
+        are refreshed concurrently. If there are more stale cells than
+        calls, the cells that are left over are not fetched and the call
+        budget is marked degraded.
+
+        A cell is only marked as fetched if its tiled search covered it
+        completely, i.e. none of its searches were refused, dropped or
+        left out, so that it is fetched again next time otherwise.
+        """
+        cells = self.place_store.get_area_cells(location_restriction)
+        stale_cells = self.place_store.get_stale_cells(cells)
+        if not stale_cells:
+            return
+
+        calls_per_cell = max(1, max_api_calls // len(stale_cells))
+        if len(stale_cells) > max_api_calls:
+            mark_degraded()
+            stale_cells = stale_cells[:max_api_calls]
+        refreshes = [
+            partial(self._refresh_cell, cell, calls_per_cell)
+            for cell in stale_cells
+        ]
+        if self.concurrent:
+            # The refreshes wait for their searches on the shared pool, so
+            # they run on the coordinator pool. They end with their
+            # searches, which have timeouts of their own.
+            results = run_concurrently(
+                refreshes, timeout=None, executor=get_coordinator_executor())
+        else:
+            results = enumerate(refresh() for refresh in refreshes)
+        self.place_store.mark_fetched(
+            [stale_cells[i] for i, complete in results if complete])
+
+    def _refresh_cell(self, cell, max_api_calls):
+        """
+        Fetches the places of a cell of an area into the place store (by
+        way of the nearby cache), and returns whether the cell was fully
+        covered.
         """
-        pass
+        center, radius = self.place_store.get_cell_circle(cell)
+        with call_budget() as budget:
+            for _ in self.iter_all_nearby_places(
+                center, radius, max_api_calls=max_api_calls,
+            ):
+                pass
+        return not budget.degraded
@@ -0,0 +1,250 @@
+import heapq
+
+import numpy as np
+
+HELD_KARP_MAX_PLACES = 8
+LOCAL_SEARCH_RESTARTS = 8
+MAX_OR_OPT_SEGMENT = 3
+
+# Travel times are in seconds, so this is far beyond any real route. It
+# replaces infinite costs so that NumPy arithmetic never produces NaN.
+UNREACHABLE_COST = 1e12
+
+_EPSILON = 1e-9
+
+
+def get_route_cost(costs, route):
+    """Returns the total cost of a route (a sequence of node indices)."""
+    route = np.asarray(route)
+    return float(costs[route[:-1], route[1:]].sum())
+
+
+def plan_routes(costs, anchors, free, max_count, seed=0):
+    """
+    Returns up to `max_count` of the cheapest routes that visit the
+    anchor nodes in the given order (the first being the start and the
+    last being the end) and every free node somewhere in between.
+
+    `costs` is a square matrix where `costs[i, j]` is the cost of going
+    from node i to node j. The routes are returned as `(cost, route)`
+    tuples from the cheapest, where each route is a list of node
+    indices. Routes that use an unreachable leg are left out.
+
+    Small problems are solved exactly with the Held-Karp dynamic
+    programming algorithm (keeping the best routes of every state
+    rather than only the best one). Larger problems are solved with
+    cheapest insertion followed by 2-opt and Or-opt local search, from
+    several starting orders.
+    """
+    if len(anchors) < 2:
+        raise ValueError('At least two anchors are required.')
+
+    costs = np.where(np.isfinite(costs), costs, UNREACHABLE_COST)
+    if len(free) <= HELD_KARP_MAX_PLACES:
+        routes = _held_karp(costs, anchors, free, max_count)
+    else:
+        routes = _local_search(costs, anchors, free, max_count, seed)
+    return [(c, r) for c, r in routes if c < UNREACHABLE_COST]
+
+
+def _held_karp(costs, anchors, free, max_count):
+    """
+    Exact k-best Held-Karp. A state is the set of visited free nodes, the
+    index of the last visited anchor and the last visited node (-1 if it
+    is the anchor itself), and holds the cheapest partial routes to it.
+    """
+    n = len(free)
+    last_anchor = len(anchors) - 1
+    full = (1 << n) - 1
+    states = {(0, 0, -1): [(0.0, (anchors[0],))]}
+
+    def push(state, cost, route):
+        states.setdefault(state, []).append((cost, route))
+
+    for j in range(last_anchor + 1):
+        for mask in range(full + 1):
+            for last in range(-1, n):
+                entries = states.pop((mask, j, last), None)
+                if not entries:
+                    continue
+                entries = heapq.nsmallest(max_count, entries)
+                if j == last_anchor:
+                    if mask == full and last < 0:
+                        return [(c, list(r)) for c, r in entries]
+                    continue
+
+                node = anchors[j] if last < 0 else free[last]
+                for u in range(n):
+                    if not mask & (1 << u):
+                        step = costs[node, free[u]]
+                        for cost, route in entries:
+                            push((mask | (1 << u), j, u),
+                                 cost + step, route + (free[u],))
+
+                if j + 1 < last_anchor or mask == full:
+                    step = costs[node, anchors[j + 1]]
+                    for cost, route in entries:
+                        push((mask, j + 1, -1),
+                             cost + step, route + (anchors[j + 1],))
+
+    return []
+
+
+def _local_search(costs, anchors, free, max_count, seed):
+    rng = np.random.default_rng(seed)
+    is_free = np.zeros(len(costs), dtype=bool)
+    is_free[free] = True
+
+    routes = {}
+    for restart in range(LOCAL_SEARCH_RESTARTS):
+        order = list(free) if restart == 0 else list(rng.permutation(free))
+        route = _cheapest_insertion(costs, list(anchors), order)
+        route = _improve(costs, route, is_free)
+        routes[tuple(route)] = get_route_cost(costs, route)
+
+    best = heapq.nsmallest(max_count, routes.items(), key=lambda r: r[1])
+    return [(cost, list(route)) for route, cost in best]
+
+
+def _insertion_deltas(costs, route, segment):
+    """
+    Returns the added cost of inserting a segment of nodes into every
+    edge of a route, as an array indexed by edge.
+    """
+    route = np.asarray(route)
+    return (costs[route[:-1], segment[0]]
+            + costs[segment[-1], route[1:]]
+            - costs[route[:-1], route[1:]])
+
+
+def _cheapest_insertion(costs, route, order):
+    for node in order:
+        deltas = _insertion_deltas(costs, route, [node])
+        route.insert(int(np.argmin(deltas)) + 1, node)
+    return route
+
+
+def _improve(costs, route, is_free):
+    """
+    Improves a route with 2-opt and Or-opt moves until neither finds an
+    improvement. Moves only ever reorder free nodes, so the anchors keep
+    their order.
+    """
+    improved = True
+    while improved:
+        improved = _two_opt(costs, route, is_free)
+        improved = _or_opt(costs, route, is_free) or improved
+    return route
+
+
+def _two_opt(costs, route, is_free):
+    """
+    Applies the best segment reversal of the route, if it reduces the
+    cost. Only segments made of free nodes are reversed. Since costs may
+    be asymmetric, the cost of the reversed segment is computed from the
+    prefix sums of the backward legs.
+    """
+    r = np.asarray(route)
+    size = len(r)
+    if size < 4:
+        return False
+
+    forward = np.concatenate(([0.0], np.cumsum(costs[r[:-1], r[1:]])))
+    backward = np.concatenate(([0.0], np.cumsum(costs[r[1:], r[:-1]])))
+    anchors_before = np.concatenate(([0], np.cumsum(~is_free[r])))
+
+    i = np.arange(1, size - 1)[:, None]
+    j = np.arange(1, size - 1)[None, :]
+    valid = (j > i) & (anchors_before[j + 1] == anchors_before[i])
+    jj = np.minimum(j + 1, size - 1)
+    delta = (costs[r[i - 1], r[j]] + costs[r[i], r[jj]]
+             + backward[j] - backward[i]
+             - costs[r[i - 1], r[i]] - costs[r[j], r[jj]]
+             - (forward[j] - forward[i]))
+    delta = np.where(valid, delta, np.inf)
+
+    best = np.unravel_index(np.argmin(delta), delta.shape)
+    if delta[best] >= -_EPSILON:
+        return False
+    start, end = best[0] + 1, best[1] + 1
+    route[start:end + 1] = route[start:end + 1][::-1]
+    return True
+
+
+def _or_opt(costs, route, is_free):
+    """
+    Applies the best move of a segment of up to MAX_OR_OPT_SEGMENT free
+    nodes to another position of the route, if it reduces the cost.
+    """
+    best_delta = -_EPSILON
+    best_move = None
+    for length in range(1, MAX_OR_OPT_SEGMENT + 1):
+        for start in range(1, len(route) - length):
+            segment = route[start:start + length]
+            if not is_free[segment].all():
+                continue
+            prev, next_ = route[start - 1], route[start + length]
+            removal_gain = (costs[prev, segment[0]]
+                            + costs[segment[-1], next_]
+                            - costs[prev, next_])
+            rest = route[:start] + route[start + length:]
+            deltas = _insertion_deltas(costs, rest, segment)
+            # Inserting back into the same edge is not a move.
+            deltas[start - 1] = np.inf
+            position = int(np.argmin(deltas))
+            delta = deltas[position] - removal_gain
+            if delta < best_delta:
+                best_delta = delta
+                best_move = (rest, position, segment)
+
+    if best_move is None:
+        return False
+    rest, position, segment = best_move
+    route[:] = rest[:position + 1] + segment + rest[position + 1:]
+    return True
+
+
+def find_best_insertions(
+    leg_costs,
+    to_candidates,
+    from_candidates,
+    penalties,
+    max_count,
+):
+    """
+    Evaluates inserting every candidate node into every leg of an
+    existing route, and returns the best `max_count` insertions.
+
+    `leg_costs` holds the costs of the L - 1 legs of a route with L
+    nodes, `to_candidates` is the L by K matrix of costs from the route
+    nodes to the K candidates, and `from_candidates` is the K by L
+    matrix of costs back. The score of an insertion is its detour cost
+    plus the penalty of the candidate (which may be negative for
+    candidates that are worth a detour).
+
+    Only the legs around the inserted node change, so all detours are
+    computed at once from the given costs without replanning the route.
+    Returns `(score, detour, candidate, leg)` tuples from the best.
+    Insertions that use an unreachable leg are left out.
+    """
+    if max_count <= 0:
+        return []
+    detours = (to_candidates[:-1].T
+               + from_candidates[:, 1:]
+               - np.asarray(leg_costs)[None, :])
+    scores = detours + np.asarray(penalties)[:, None]
+
+    heap = []
+    for (candidate, leg), score in np.ndenumerate(scores):
+        if not np.isfinite(score):
+            continue
+        item = (-score, -detours[candidate, leg], candidate, leg)
+        if len(heap) < max_count:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    return [
+        (-score, -detour, candidate, leg)
+        for score, detour, candidate, leg in sorted(heap, reverse=True)
+    ]
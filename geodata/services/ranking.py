@@ -0,0 +1,77 @@
+import heapq
+
+import numpy as np
+
+# Constant of reciprocal rank fusion, where a place ranked r-th (from 1)
+# in a list gets 1 / (RRF_K + r) from it. The usual value of 60 keeps the
+# top few ranks from dominating the fused score.
+RRF_K = 60
+
+# Weight of the preference score (from -1 to 1) in the fused score. The
+# rank fusion terms add up to at most 2 / (RRF_K + 1) for two lists, so
+# the preference decides between places it scores differently and the
+# ranks break the ties.
+PREFERENCE_WEIGHT = 1.0
+
+
+def merge_rankings(rankings):
+    """
+    Merges ranked lists of place dicts into one deduplicated list of
+    candidates, in the order they first appear. Returns a tuple of the
+    candidates and an integer array of shape `(len(rankings), n)` with
+    the rank (from 1) of every candidate in every list, or 0 where the
+    candidate is missing from the list.
+    """
+    index = {}
+    candidates = []
+    for ranking in rankings:
+        for place in ranking:
+            if place['id'] not in index:
+                index[place['id']] = len(candidates)
+                candidates.append(place)
+
+    ranks = np.zeros((len(rankings), len(candidates)), dtype=np.int64)
+    for row, ranking in enumerate(rankings):
+        first_ranks = {}
+        for rank, place in enumerate(ranking, 1):
+            first_ranks.setdefault(index[place['id']], rank)
+        ranks[row, list(first_ranks)] = list(first_ranks.values())
+    return candidates, ranks
+
+
+def get_rank_fusion_scores(ranks, k=RRF_K):
+    """
+    Returns the reciprocal rank fusion score of every column of a rank
+    array (see merge_rankings), where missing ranks add nothing.
+    """
+    ranks = np.asarray(ranks, dtype=float)
+    terms = np.divide(1.0, k + ranks, out=np.zeros_like(ranks),
+                      where=ranks > 0)
+    return terms.sum(axis=0)
+
+
+def fuse_scores(ranks, preference_scores, k=RRF_K, weight=PREFERENCE_WEIGHT):
+    """
+    Returns the fused scores of candidates: their reciprocal rank fusion
+    score plus their preference score times `weight`.
+    """
+    return (get_rank_fusion_scores(ranks, k)
+            + weight * np.asarray(preference_scores, dtype=float))
+
+
+def select_top(scores, count=None, candidates=None):
+    """
+    Returns the indices of the `count` highest scores (all of them if
+    None), highest first and in index order for equal scores. Only the
+    given `candidates` indices are considered, if any.
+
+    A heap of `count` entries is used, so this takes O(n log count) time
+    rather than the O(n log n) of sorting all the scores.
+    """
+    if candidates is None:
+        candidates = range(len(scores))
+    if count is None:
+        count = len(candidates)
+    # Python floats are compared much faster than numpy scalars.
+    scores = np.asarray(scores, dtype=float).tolist()
+    return heapq.nlargest(count, candidates, key=scores.__getitem__)
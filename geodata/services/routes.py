@@ -1,26 +1,196 @@
+import asyncio
+from functools import partial
+
+from common.apis.budget import mark_degraded
+from googlemaps.convert import decode_polyline
+
+from .concurrency import get_call_timeout, run_concurrently
+from .geo import distances_to_polyline
+from .matrix import travel_time_matrix_service
+from .metrics import instrumented
+from .places import PlacesService
+from .planning import find_best_insertions, plan_routes
+from .tiling import DEFAULT_MAX_CORRIDOR_CALLS, SEARCH_ERRORS, cover_polyline
+
+DEFAULT_ROUTE_CORRIDOR_WIDTH = 1000.0
+
+# How many seconds of detour a place is worth per point of preference
+# score, when adding places into a planned route.
+PREFERENCE_DETOUR_SECONDS = 600.0
+
+def get_route_points(route):
+    """
+    Returns the points of a route as a list of `(latitude, longitude)`
+    tuples. The route can be given as an encoded polyline, a route from
+    the Routes API (with a `polyline.encodedPolyline`), or a list of
+    points.
+    """
+    if isinstance(route, dict):
+        route = route['polyline']['encodedPolyline']
+    if isinstance(route, str):
+        return [(p['lat'], p['lng']) for p in decode_polyline(route)]
+    return [tuple(p) for p in route]
+
+def _search_or_skip(search, *args, **kwargs):
+    """
+    Runs one search of a corridor. If it fails, its places are left out
+    and the call budget is marked degraded, so that the other searches
+    still count.
+    """
+    try:
+        return search(*args, **kwargs)
+    except SEARCH_ERRORS:
+        mark_degraded()
+        return []
+
 class RoutesService():
     """
     A collection of services for handling routes-related operations,
     using the Routes API and session data for personalized results.
     """
 
-    def __init__(self, maps_client, session):
+    def __init__(
+        self,
+        maps_client,
+        session,
+        matrix_service=None,
+        places_service=None,
+    ):
         self.maps_client = maps_client
         self.session = session
+        self.matrix_service = matrix_service or travel_time_matrix_service
+        self.places_service = (
+            places_service or PlacesService(maps_client, session))
 
+    @instrumented
     def get_places_near_route_sorted(
         self,
         route,
         additional_preferences=None,
         max_count=20,
+        max_distance=DEFAULT_ROUTE_CORRIDOR_WIDTH,
+        max_api_calls=DEFAULT_MAX_CORRIDOR_CALLS,
     ):
         """
         Returns a list of places near the given route sorted by preferences.
         This is used to give suggestions for new locations to visit along
         the route. 
+
+        The corridor of points within `max_distance` meters of the route
+        is covered with as few nearby searches as possible (at most
+        `max_api_calls`), which are sent concurrently (searches that fail
+        are left out, see _search_or_skip). The places found are then
+        filtered by their distance to the route, and the best `max_count`
+        of them are returned as a dictionary mapping the place IDs to
+        their scores.
+
+        NOTE: we are currently ignoring additional_preferences.
         """
-        pass
+        points = get_route_points(route)
+        if not points:
+            return {}
+
+        places_service = self.places_service
+        fields = ['id', 'location',
+                  *places_service._get_relevant_fields_for_preference()]
+        searches = [
+            partial(
+                _search_or_skip,
+                places_service._search_nearby,
+                center,
+                radius,
+                fields,
+                rank_preference='POPULARITY',
+            )
+            for center, radius in cover_polyline(
+                points, max_distance, max_circles=max_api_calls)
+        ]
 
+        candidates = {}
+        for _, places in run_concurrently(
+            searches, timeout=places_service.call_timeout,
+        ):
+            for place in places:
+                candidates.setdefault(place['id'], place)
+        if not candidates:
+            return {}
+
+        places = list(candidates.values())
+        distances = distances_to_polyline(
+            [(p['location']['latitude'], p['location']['longitude'])
+             for p in places],
+            points,
+        )
+        near_places = [
+            p for p, d in zip(places, distances) if d <= max_distance]
+
+        return places_service.sort_places_by_preference(
+            near_places, max_count=max_count)
+
+    async def aiter_places_near_route(
+        self,
+        maps_client,
+        route,
+        max_distance=DEFAULT_ROUTE_CORRIDOR_WIDTH,
+        max_api_calls=DEFAULT_MAX_CORRIDOR_CALLS,
+    ):
+        """
+        Streaming version of get_places_near_route_sorted, which searches
+        the corridor through the given AsyncMapsClient and yields lists
+        of newly found place dicts within `max_distance` meters of the
+        route as the searches complete. The places are not sorted; score
+        them with the scorer of the places service. Like in the tiled
+        search, searches that fail are left out.
+        """
+        points = get_route_points(route)
+        if not points:
+            return
+
+        places_service = self.places_service
+        fields = ['id', 'location',
+                  *places_service._get_relevant_fields_for_preference()]
+        tasks = [
+            asyncio.ensure_future(places_service.nearby_cache.asearch_places(
+                maps_client,
+                center,
+                radius,
+                fields,
+                rank_preference='POPULARITY',
+            ))
+            for center, radius in cover_polyline(
+                points, max_distance, max_circles=max_api_calls)
+        ]
+
+        seen = set()
+        try:
+            for next_done in asyncio.as_completed(
+                tasks, timeout=get_call_timeout(places_service.call_timeout),
+            ):
+                try:
+                    places, _ = await next_done
+                except SEARCH_ERRORS:
+                    mark_degraded()
+                    continue
+                places = [p for p in places if p['id'] not in seen]
+                seen.update(p['id'] for p in places)
+                if not places:
+                    continue
+                distances = distances_to_polyline(
+                    [(p['location']['latitude'], p['location']['longitude'])
+                     for p in places],
+                    points,
+                )
+                near_places = [
+                    p for p, d in zip(places, distances) if d <= max_distance]
+                if near_places:
+                    yield near_places
+        except asyncio.TimeoutError:
+            mark_degraded()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @instrumented
     def get_best_planned_routes(
         self,
         places_ordered,
@@ -32,10 +202,42 @@ class RoutesService():
         Returns the best planned routes for the given places according to
         preferences. The ordered places must keep the same order in the
         planned route, with the first place becoming the start of the
-        route, and the last place becoming the end.
+        route, and the last place becoming the end. If only one ordered
+        place is given, the route starts and ends there.
+
+        Places are given as place IDs. Each route is returned as a dict
+        with the list of place IDs in visiting order (`places`) and the
+        total travel time in seconds (`duration`), from the fastest.
+
+        The travel times between all places are fetched in bulk and
+        cached, then the routes are planned on that matrix: exactly for
+        a few unordered places, and with local search for many of them.
+
+        NOTE: we are currently ignoring additional_preferences, since
+        every given place has to be visited anyway.
         """
-        pass
+        if not places_ordered:
+            raise ValueError('At least one ordered place is required.')
+
+        place_ids = list(dict.fromkeys([*places_ordered, *places_unordered]))
+        index = {place_id: i for i, place_id in enumerate(place_ids)}
+        matrix = self.matrix_service.get_matrix(self.maps_client, place_ids)
 
+        anchors = [index[p] for p in places_ordered]
+        if len(anchors) == 1:
+            anchors.append(anchors[0])
+        free = [i for i in range(len(place_ids)) if i not in set(anchors)]
+
+        return [
+            {
+                'places': [place_ids[i] for i in route],
+                'duration': float(duration),
+            }
+            for duration, route in plan_routes(
+                matrix, anchors, free, max_count)
+        ]
+
+    @instrumented
     def add_places_into_planned_route(
         self,
         places,
@@ -47,5 +249,59 @@ class RoutesService():
         Returns a new route that closely resembles the given planned route
         but with additional places, while taking into account other
         factors such as additional time taken.
+
+        Each returned variant is the planned route (a list of place IDs,
+        or a route returned by get_best_planned_routes) with one of the
+        given places inserted into it. Every place is tried at every
+        position, scored by the added travel time minus the worth of the
+        place by preference (PREFERENCE_DETOUR_SECONDS per point), and
+        the best `max_count` variants are returned in the same format
+        as get_best_planned_routes, with the `added_duration` as well.
+
+        Only the travel times of the legs of the route and those between
+        the route and the new places are needed, and they are cached, so
+        the rest of the route is never planned again.
+
+        NOTE: we are currently ignoring additional_preferences.
         """
-        pass
+        if isinstance(planned_route, dict):
+            planned_route = planned_route['places']
+        route = list(planned_route)
+        if len(route) < 2:
+            raise ValueError('The planned route needs at least two places.')
+
+        candidates = [p for p in dict.fromkeys(places) if p not in route]
+        if not candidates:
+            return []
+
+        stops = list(dict.fromkeys(route))
+        index = {place_id: i for i, place_id in enumerate(stops)}
+        nodes = [index[p] for p in route]
+
+        leg_costs = self.matrix_service.get_pair_travel_times(
+            self.maps_client, zip(route[:-1], route[1:]))
+        to_candidates = self.matrix_service.get_travel_times(
+            self.maps_client, stops, candidates)
+        from_candidates = self.matrix_service.get_travel_times(
+            self.maps_client, candidates, stops)
+
+        duration = float(leg_costs.sum())
+        scores = self.places_service._get_preference_scores(candidates)
+        penalties = [
+            -PREFERENCE_DETOUR_SECONDS * scores[p] for p in candidates]
+
+        insertions = find_best_insertions(
+            leg_costs,
+            to_candidates[nodes],
+            from_candidates[:, nodes],
+            penalties,
+            max_count,
+        )
+        return [
+            {
+                'places': [*route[:leg + 1], candidates[c], *route[leg + 1:]],
+                'duration': duration + float(detour),
+                'added_duration': float(detour),
+            }
+            for _, detour, c, leg in insertions
+        ]
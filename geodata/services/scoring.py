@@ -0,0 +1,95 @@
+import hashlib
+import json
+
+from .cache import LRUCache
+
+COMPILED_PREFERENCES_MAX_ENTRIES = 10000
+COMPILED_PREFERENCES_TTL = 60 * 60
+
+
+class CompiledPreferences:
+    """
+    User preferences compiled into a lookup table for fast scoring.
+
+    Each key in the preferences dict is a place type and the value is a
+    boolean, which is compiled into a weight of 1 or -1. The first type
+    of a place that has a weight fixes the score of the place; if none
+    of its types have one, the score is 0.
+
+    Most places match none of the preferred types, so the set of
+    weighted types is checked first with a single (C-level) disjointness
+    test, and the types are only walked in order when there is a match.
+
+    The digest identifies the weights, so that results computed with
+    them can be shared by every user with the same preferences.
+    """
+
+    def __init__(self, preferences):
+        self.weights = {
+            type_str: 1 if v else -1
+            for type_str, v in preferences.items()
+            if v is not None
+        }
+        self.types = frozenset(self.weights)
+        weights = json.dumps(sorted(self.weights.items()))
+        self.digest = hashlib.sha1(weights.encode()).hexdigest()
+
+    def score(self, types):
+        """Returns the preference score of a place given its types."""
+        if self.types.isdisjoint(types):
+            return 0
+        weights = self.weights
+        for type_str in types:
+            weight = weights.get(type_str)
+            if weight is not None:
+                return weight
+        return 0
+
+
+_compiled_preferences = LRUCache(
+    COMPILED_PREFERENCES_MAX_ENTRIES, COMPILED_PREFERENCES_TTL)
+
+
+def get_compiled_preferences(user):
+    """
+    Returns the compiled preferences of a user. They are cached in the
+    process by user ID, and compiled again whenever the `updated_at`
+    timestamp of the user changes.
+    """
+    if user.pk is None:
+        return CompiledPreferences(user.preferences)
+
+    cached = _compiled_preferences.get(user.pk)
+    if cached is not None and cached[0] == user.updated_at:
+        return cached[1]
+
+    compiled = CompiledPreferences(user.preferences)
+    _compiled_preferences.set(user.pk, (user.updated_at, compiled))
+    return compiled
+
+
+class PreferenceScorer:
+    """
+    Scores places by user preferences, remembering the score of every
+    place ID it has seen.
+
+    Places are scored from the place dicts that the Places API already
+    returned (e.g. from a nearby search), so scoring never needs any
+    additional requests as long as the dicts contain `id` and `types`.
+    """
+
+    def __init__(self, preferences):
+        self.preferences = preferences
+        self._scores = {}
+
+    def get_cached_score(self, place_id):
+        return self._scores.get(place_id)
+
+    def score(self, place):
+        """Returns the preference score of a single place dict."""
+        place_id = place['id']
+        score = self._scores.get(place_id)
+        if score is None:
+            score = self.preferences.score(place.get('types', ()))
+            self._scores[place_id] = score
+        return score
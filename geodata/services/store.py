@@ -0,0 +1,310 @@
+import base64
+import itertools
+import json
+from datetime import timedelta
+
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce, Least, NullIf, StrIndex
+from django.db.models.lookups import GreaterThan, LessThan
+from django.utils import timezone
+
+from ..models import AreaCell, Place
+from .geo import (
+    geohash_bounds,
+    geohash_center,
+    geohash_cover,
+    geohash_encode,
+    haversine_distance,
+    offset_location,
+)
+
+PLACE_GEOHASH_PRECISION = 12
+# Position of the types that a place does not have (see
+# get_score_expression), beyond that of any type it has.
+_NO_POSITION = 1000000
+AREA_CELL_STALE_AFTER = timedelta(days=7)
+MAX_AREA_CELLS = 64
+
+
+def get_restriction_bounds(location_restriction):
+    """
+    Returns the `(min_lat, min_lng, max_lat, max_lng)` bounds of a
+    location restriction in the Places API format, which is either a
+    `circle` (with a `center` and a `radius`) or a `rectangle` (with its
+    `low` and `high` corners).
+    """
+    if 'circle' in location_restriction:
+        circle = location_restriction['circle']
+        center = (circle['center']['latitude'], circle['center']['longitude'])
+        radius = circle['radius']
+        min_lat, min_lng = offset_location(center, -radius, -radius)
+        max_lat, max_lng = offset_location(center, radius, radius)
+        return min_lat, min_lng, max_lat, max_lng
+    if 'rectangle' in location_restriction:
+        low = location_restriction['rectangle']['low']
+        high = location_restriction['rectangle']['high']
+        return (low['latitude'], low['longitude'],
+                high['latitude'], high['longitude'])
+    raise ValueError('Unsupported location restriction.')
+
+
+def _contains(location_restriction, point):
+    if 'circle' in location_restriction:
+        circle = location_restriction['circle']
+        center = (circle['center']['latitude'], circle['center']['longitude'])
+        return haversine_distance(center, point) <= circle['radius']
+    return True
+
+
+def get_types_key(types):
+    """Returns the `types_key` of a place with the given types."""
+    return ','.join(['', *types, ''])
+
+
+def get_score_expression(preferences):
+    """
+    Returns a database expression of the score of a Place with the given
+    compiled preferences, which is the same as CompiledPreferences.score:
+    the weight of the first of its types that has one, or 0.
+
+    The position of every weighted type in the `types_key` of the place
+    is looked up, and the score is 1 if a liked type comes first, -1 if
+    a disliked one does, and 0 if there is neither.
+    """
+    def get_first_position(weight):
+        positions = [
+            Coalesce(
+                NullIf(StrIndex('types_key', Value(f',{type_str},')),
+                       Value(0)),
+                Value(_NO_POSITION),
+            )
+            for type_str, w in preferences.weights.items() if w == weight
+        ]
+        if not positions:
+            return Value(_NO_POSITION)
+        if len(positions) == 1:
+            return positions[0]
+        return Least(*positions)
+
+    liked = get_first_position(1)
+    disliked = get_first_position(-1)
+    return Case(
+        When(GreaterThan(disliked, liked), then=Value(1)),
+        When(LessThan(disliked, liked), then=Value(-1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+    except (ValueError, TypeError):
+        raise ValueError('The cursor is invalid.')
+
+
+class PlaceStore:
+    """
+    Local store of the places returned by the Places API, indexed by
+    location so that areas can be queried without calling the API.
+
+    Places are added through ingest whenever we receive a response that
+    contains their location. The store also keeps track of which geohash
+    cells have been fully fetched from the API (see AreaCell), so that
+    only the cells with missing or stale data need to be fetched again.
+    """
+
+    def __init__(self, stale_after=AREA_CELL_STALE_AFTER):
+        self.stale_after = stale_after
+
+    def ingest(self, places):
+        """
+        Stores (or updates) the given place dicts from a Places API
+        response. Places without a location are skipped, and the types
+        of a stored place are only updated if the response has them.
+        """
+        with_types = []
+        without_types = []
+        for place in places:
+            if 'id' not in place or 'location' not in place:
+                continue
+            point = place['location']
+            point = (point['latitude'], point['longitude'])
+            types = place.get('types', [])
+            obj = Place(
+                place_id=place['id'],
+                latitude=point[0],
+                longitude=point[1],
+                geohash=geohash_encode(point, PLACE_GEOHASH_PRECISION),
+                types=types,
+                types_key=get_types_key(types),
+            )
+            if 'types' in place:
+                with_types.append(obj)
+            else:
+                without_types.append(obj)
+
+        update_fields = ['latitude', 'longitude', 'geohash', 'updated_at']
+        types_fields = update_fields + ['types', 'types_key']
+        for objs, fields in ((with_types, types_fields),
+                             (without_types, update_fields)):
+            if objs:
+                Place.objects.bulk_create(
+                    objs,
+                    update_conflicts=True,
+                    unique_fields=['place_id'],
+                    update_fields=fields,
+                )
+
+    def get_area_cells(self, location_restriction):
+        """
+        Returns the geohashes of the cells covering the area of the
+        location restriction.
+        """
+        bounds = get_restriction_bounds(location_restriction)
+        return geohash_cover(bounds, MAX_AREA_CELLS)
+
+    def get_stale_cells(self, cells):
+        """
+        Returns the cells (in the given order) that have never been
+        fetched, or were last fetched too long ago. A cell also counts as
+        fetched if one of its parent cells was fetched.
+        """
+        prefixes = {c[:i] for c in cells for i in range(1, len(c) + 1)}
+        fresh = set(AreaCell.objects.filter(
+            geohash__in=prefixes,
+            fetched_at__gte=timezone.now() - self.stale_after,
+        ).values_list('geohash', flat=True))
+        return [
+            c for c in cells
+            if not any(c[:i] in fresh for i in range(1, len(c) + 1))
+        ]
+
+    def mark_fetched(self, cells):
+        AreaCell.objects.bulk_create(
+            [AreaCell(geohash=c, fetched_at=timezone.now()) for c in cells],
+            update_conflicts=True,
+            unique_fields=['geohash'],
+            update_fields=['fetched_at'],
+        )
+
+    def get_locations(self, place_ids):
+        """
+        Returns a dict mapping the given place IDs to their stored
+        `(latitude, longitude)`, leaving out the places not in the store.
+        """
+        rows = Place.objects.filter(place_id__in=place_ids).values_list(
+            'place_id', 'latitude', 'longitude')
+        return {place_id: (lat, lng) for place_id, lat, lng in rows}
+
+    def get_cell_circle(self, cell):
+        """
+        Returns the `(center, radius)` of the circle circumscribing a
+        cell, which is used to fetch the places of the cell.
+        """
+        center = geohash_center(cell)
+        min_lat, min_lng, _, _ = geohash_bounds(cell)
+        return center, haversine_distance(center, (min_lat, min_lng))
+
+    def get_places_in_circle(self, location, radius, limit=None):
+        """
+        Returns the stored places within `radius` meters of the location
+        as place dicts with their `id`, `location` and `types`, from the
+        nearest. This is used to answer searches without calling the API.
+        """
+        min_lat, min_lng = offset_location(location, -radius, -radius)
+        max_lat, max_lng = offset_location(location, radius, radius)
+        rows = Place.objects.filter(
+            latitude__range=(min_lat, max_lat),
+            longitude__range=(min_lng, max_lng),
+        ).values_list('place_id', 'latitude', 'longitude', 'types')
+
+        places = []
+        for place_id, lat, lng, types in rows:
+            distance = haversine_distance(location, (lat, lng))
+            if distance <= radius:
+                places.append((distance, {
+                    'id': place_id,
+                    'location': {'latitude': lat, 'longitude': lng},
+                    'types': types,
+                }))
+        places.sort(key=lambda p: p[0])
+        return [place for _, place in places[:limit]]
+
+    def query_area(
+        self,
+        location_restriction,
+        preferences,
+        cursor=None,
+        offset=0,
+        limit=20,
+    ):
+        """
+        Returns a page of the stored places in the area of the location
+        restriction, sorted by their score with the given compiled
+        preferences (highest first, then by place ID).
+
+        Returns a tuple of the dictionary mapping the place IDs of the
+        page to their scores, and the opaque cursor of the next page (or
+        None if this is the last page). Paging is keyset-based, so pages
+        stay consistent even when places are added in the meantime. The
+        offset is only used when no cursor is given.
+
+        The scores are computed, sorted and paged by the database (see
+        get_score_expression), so only the page (plus one row, to tell
+        whether there is a next one) is fetched from the database, in
+        chunks of that size. The database still scores and sorts every
+        stored place in the bounding box of the area to find the page.
+        Places in the bounding box of a circle but outside the circle
+        itself are skipped as they come, so circles may fetch a few more
+        chunks.
+        """
+        min_lat, min_lng, max_lat, max_lng = get_restriction_bounds(
+            location_restriction)
+        places = Place.objects.filter(
+            latitude__range=(min_lat, max_lat),
+            longitude__range=(min_lng, max_lng),
+        ).annotate(
+            score=get_score_expression(preferences),
+        ).order_by('-score', 'place_id')
+
+        key = decode_cursor(cursor) if cursor else None
+        rows = self._iter_sorted(places, location_restriction, key, limit + 1)
+        if key is None:
+            rows = itertools.islice(rows, offset, None)
+        page = list(itertools.islice(rows, limit + 1))
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            place_id, score = page[-1]
+            next_cursor = encode_cursor([-score, place_id])
+        return dict(page), next_cursor
+
+    def _iter_sorted(self, places, location_restriction, key, chunk_size):
+        """
+        Yields the `(place_id, score)` of the sorted places (see
+        query_area) after the given key, that are inside the location
+        restriction. They are read in chunks from the database.
+        """
+        while True:
+            chunk = places
+            if key is not None:
+                score, place_id = -key[0], key[1]
+                chunk = chunk.filter(
+                    Q(score__lt=score) | Q(score=score, place_id__gt=place_id))
+            rows = list(chunk.values_list(
+                'place_id', 'latitude', 'longitude', 'score')[:chunk_size])
+            for place_id, lat, lng, score in rows:
+                if _contains(location_restriction, (lat, lng)):
+                    yield place_id, score
+            if len(rows) < chunk_size:
+                return
+            key = (-rows[-1][3], rows[-1][0])
+
+
+place_store = PlaceStore()
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from math import ceil, sqrt
+
+import numpy as np
+
+from common.apis.budget import mark_degraded
+from common.apis.maps import MAX_RESTRICTION_RADIUS
+from googlemaps import exceptions
+
+from .concurrency import DEFAULT_CALL_TIMEOUT, get_call_timeout, submit
+from .geo import haversine_distance, offset_location, polyline_lengths
+
+DEFAULT_MAX_TILING_CALLS = 32
+DEFAULT_MAX_CORRIDOR_CALLS = 16
+MIN_TILE_RADIUS = 50.0
+
+# Errors of a single search that leave its circle out of the results,
+# rather than failing the whole tiled search.
+SEARCH_ERRORS = (
+    exceptions.ApiError,
+    exceptions.Timeout,
+    exceptions.TransportError,
+)
+
+
+def split_circle(location, radius):
+    """
+    Splits a circle into four smaller circles that together cover it.
+
+    The bounding square of the circle is split into quadrants, and each
+    sub-circle is the circumscribed circle of a quadrant.
+    """
+    offset = radius / 2
+    sub_radius = radius * sqrt(2) / 2
+    return [
+        (offset_location(location, north, east), sub_radius)
+        for north in (offset, -offset)
+        for east in (offset, -offset)
+    ]
+
+
+def cover_circle(location, radius, max_radius=MAX_RESTRICTION_RADIUS):
+    """
+    Returns a list of circles no larger than `max_radius` that together
+    cover the given circle.
+    """
+    circles = [(location, radius)]
+    while circles[0][1] > max_radius:
+        circles = [
+            sub for circle in circles for sub in split_circle(*circle)
+            if _intersects(sub, location, radius)
+        ]
+    return circles
+
+
+def cover_polyline(
+    polyline,
+    width,
+    max_circles=DEFAULT_MAX_CORRIDOR_CALLS,
+    max_radius=MAX_RESTRICTION_RADIUS,
+):
+    """
+    Returns a list of circles centered along a polyline (an array of
+    `(latitude, longitude)` rows) that cover the corridor of points
+    within `width` meters of it, using as few circles as possible.
+
+    Circles with radius R spaced at 2 * sqrt(R^2 - width^2) along the
+    line cover the corridor. The radius starts at width * sqrt(2), where
+    a circle covers the most corridor per area, and is enlarged until
+    at most `max_circles` circles are needed, up to `max_radius`. If
+    even that is not enough, `max_circles` circles are spread evenly
+    along the line and the corridor has gaps between them.
+    """
+    polyline = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    lengths = polyline_lengths(polyline)
+    total = lengths[-1]
+    if total == 0:
+        return [(tuple(polyline[0]), min(width, max_radius))]
+
+    radius = width * sqrt(2)
+    spacing = total / max_circles
+    radius = min(max(radius, sqrt((spacing / 2) ** 2 + width ** 2)),
+                 max_radius)
+    spacing = 2 * sqrt(max(radius ** 2 - width ** 2, 0.0))
+    count = max_circles
+    if spacing > 0:
+        count = min(max_circles, ceil(total / spacing))
+
+    positions = (np.arange(count) + 0.5) * total / count
+    lats = np.interp(positions, lengths, polyline[:, 0])
+    lngs = np.interp(positions, lengths, polyline[:, 1])
+    return [((float(lat), float(lng)), radius) for lat, lng in zip(lats, lngs)]
+
+
+def _intersects(circle, location, radius):
+    center, sub_radius = circle
+    return haversine_distance(center, location) < sub_radius + radius
+
+
+def iter_tiled_search(
+    search,
+    location,
+    radius,
+    max_calls=DEFAULT_MAX_TILING_CALLS,
+    call_timeout=DEFAULT_CALL_TIMEOUT,
+):
+    """
+    Searches a circle with more results than a single nearby search can
+    return, yielding lists of newly found place dicts as they arrive.
+
+    `search(location, radius)` must run a single nearby search and
+    return a tuple of its place dicts (including their `id` and
+    `location`) and whether it was saturated with the maximum number of
+    results (see NearbySearchCache.search_places). Whenever a search
+    comes back saturated, its circle is split into four smaller circles
+    that are searched as well, like an adaptive quadtree. Searches run
+    concurrently on the shared thread pool, at most `max_calls` searches
+    are made in total, and a search that takes longer than
+    `call_timeout` seconds (or goes past the deadline of the call
+    budget) is dropped, like a search that fails with one of
+    SEARCH_ERRORS. If circles are left unsearched because of any of
+    these, the call budget is marked degraded.
+
+    Every place is yielded once, and only if it lies inside the circle.
+    """
+    pending = {}
+    calls = 0
+
+    def submit_search(circle):
+        nonlocal calls
+        calls += 1
+        future = submit(search, *circle)
+        timeout = get_call_timeout(call_timeout)
+        pending[future] = (circle, time.monotonic() + timeout)
+
+    circles = cover_circle(location, radius)
+    if len(circles) > max_calls:
+        mark_degraded()
+    for circle in circles[:max_calls]:
+        submit_search(circle)
+
+    seen = set()
+    try:
+        while pending:
+            deadline = min(d for _, d in pending.values())
+            done, _ = wait(
+                pending,
+                timeout=max(0.0, deadline - time.monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+
+            now = time.monotonic()
+            for future in list(pending):
+                if future not in done and pending[future][1] <= now:
+                    future.cancel()
+                    del pending[future]
+                    mark_degraded()
+
+            for future in done:
+                circle, _ = pending.pop(future)
+                try:
+                    places, saturated = future.result()
+                except SEARCH_ERRORS:
+                    mark_degraded()
+                    continue
+                if saturated and circle[1] / 2 >= MIN_TILE_RADIUS:
+                    for sub in split_circle(*circle):
+                        if not _intersects(sub, location, radius):
+                            continue
+                        if calls < max_calls:
+                            submit_search(sub)
+                        else:
+                            mark_degraded()
+
+                new_places = _get_new_places(places, seen, location, radius)
+                if new_places:
+                    yield new_places
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def aiter_tiled_search(
+    search,
+    location,
+    radius,
+    max_calls=DEFAULT_MAX_TILING_CALLS,
+    call_timeout=DEFAULT_CALL_TIMEOUT,
+    circles=None,
+    leftover=None,
+):
+    """
+    Same as iter_tiled_search, as an async generator, where `search` is
+    a coroutine function. The searches run as tasks on the event loop
+    rather than on the thread pool, so a slow upstream API does not hold
+    any threads.
+
+    The search starts from the circles covering the search circle, or
+    from the given `circles` (as `(location, radius)` tuples). When a
+    `leftover` list is given, the circles that were not searched (due to
+    `max_calls`) or whose search was dropped or failed are appended to
+    it, so that the search can be resumed later by passing them as
+    `circles`.
+    """
+    loop = asyncio.get_running_loop()
+    if circles is None:
+        circles = cover_circle(location, radius)
+    if leftover is None:
+        leftover = []
+    leftover.extend(circles[max_calls:])
+
+    pending = {}
+    calls = 0
+
+    def start_search(circle):
+        nonlocal calls
+        calls += 1
+        task = asyncio.ensure_future(search(*circle))
+        timeout = get_call_timeout(call_timeout)
+        pending[task] = (circle, loop.time() + timeout)
+
+    for circle in circles[:max_calls]:
+        start_search(circle)
+
+    seen = set()
+    try:
+        while pending:
+            deadline = min(d for _, d in pending.values())
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=max(0.0, deadline - loop.time()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            now = loop.time()
+            for task in list(pending):
+                if task not in done and pending[task][1] <= now:
+                    task.cancel()
+                    leftover.append(pending.pop(task)[0])
+                    mark_degraded()
+
+            for task in done:
+                circle, _ = pending.pop(task)
+                try:
+                    places, saturated = task.result()
+                except SEARCH_ERRORS:
+                    leftover.append(circle)
+                    mark_degraded()
+                    continue
+                if saturated and circle[1] / 2 >= MIN_TILE_RADIUS:
+                    for sub in split_circle(*circle):
+                        if not _intersects(sub, location, radius):
+                            continue
+                        if calls < max_calls:
+                            start_search(sub)
+                        else:
+                            leftover.append(sub)
+
+                new_places = _get_new_places(places, seen, location, radius)
+                if new_places:
+                    yield new_places
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _get_new_places(places, seen, location, radius):
+    """
+    Returns the places inside the circle that are not in `seen` yet, and
+    adds them to it.
+    """
+    new_places = []
+    for place in places:
+        point = place['location']
+        point = (point['latitude'], point['longitude'])
+        if (place['id'] not in seen
+                and haversine_distance(point, location) <= radius):
+            seen.add(place['id'])
+            new_places.append(place)
+    return new_places
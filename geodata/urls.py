@@ -0,0 +1,10 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('places/nearby/', views.nearby_places),
+    path('places/area/', views.area_places),
+    path('places/details/', views.places_details),
+    path('places/photo/', views.place_photo),
+    path('routes/suggestions/', views.route_suggestions),
+]
@@ -1,3 +1,474 @@
-from django.shortcuts import render
+import json
+import logging
+import re
 
-# Create your views here.
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET, require_POST
+
+from common.apis.budget import call_budget, get_budget
+from common.apis.ratelimit import QuotaExceeded
+from googlemaps import exceptions
+
+from .caching import response_cache
+from .serializers import (
+    AreaSearchSerializer,
+    NearbySearchSerializer,
+    PlaceDetailsSerializer,
+    PlacePhotoSerializer,
+    RouteSuggestionsSerializer,
+)
+from .services import (
+    get_async_maps_client,
+    get_places_service,
+    get_routes_service,
+)
+from .services.concurrency import run_in_thread
+from .services.photos import photo_cache
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+# Photos are served by their content (see PhotoCache), so clients and
+# proxies can keep them for long.
+PHOTO_MAX_AGE = 30 * 24 * 60 * 60
+PHOTO_BLOCK_SIZE = 64 * 1024
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Logs the searched circles, which the warm_cache command reads to find
+# the hot regions (see the QUERY_LOG setting).
+query_logger = logging.getLogger('geodata.queries')
+
+# The views below are async, so that under ASGI a worker can hold many
+# requests that are waiting for the Maps API. DRF views cannot be async
+# yet, so they are plain Django views that validate their input with
+# DRF serializers and return errors in the same format as DRF.
+#
+# Results are streamed as newline-delimited JSON while the searches are
+# still running. Every line but the last is a batch of places,
+# `{"places": [{"id": ..., "score": ..., "location": ...}, ...]}`, in
+# the order they were found (so clients should sort them by score). The
+# last line is `{"next_cursor": ..., "partial": ...}`, where the cursor
+# continues the search (or is null), and `partial` says whether calls
+# were refused or dropped. A stream without that line was cut short.
+#
+# Responses of the GET views are cached by their quantized query (see
+# ResponseCache), and clients can revalidate them with ETags.
+
+
+def _to_line(data):
+    return (json.dumps(data, separators=(',', ':')) + '\n').encode()
+
+
+def _stream(lines):
+    response = StreamingHttpResponse(lines, content_type=NDJSON_CONTENT_TYPE)
+    # Keeps proxies such as nginx from buffering the whole response.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _stream_budget():
+    """
+    Returns the call budget of a stream, which tells whether the stream
+    is partial. It is nested in the budget of the request, which the
+    middleware keeps current while the stream is consumed.
+    """
+    return call_budget()
+
+
+async def _run_lines(lines, etag=None):
+    """
+    Runs the `lines(budget)` async generator with the budget of the
+    stream. If an ETag is given, the response is stored under it once
+    it is complete, unless it is partial.
+    """
+    chunks = []
+    with _stream_budget() as budget:
+        async for line in lines(budget):
+            chunks.append(line)
+            yield line
+    if etag is not None and not budget.degraded:
+        await run_in_thread(response_cache.set, etag, b''.join(chunks))
+
+
+async def _respond(request, name, query, lines):
+    """
+    Returns the response of a GET view to its quantized query, through
+    the response cache: a 304 if the client already has the stored
+    response, the stored body if there is one, or else the stream of
+    `lines(budget)`. The session user must be loaded already.
+
+    Only stored responses have an ETag and a Last-Modified date. A
+    stream may turn out partial (or be cut short), so it has none, and
+    clients never revalidate a partial response into a 304.
+    """
+    user = get_places_service(request).session['user']
+    etag, last_modified, body = await run_in_thread(
+        response_cache.lookup, name, query, user)
+    if body is None:
+        response = _stream(_run_lines(lines, etag))
+    else:
+        response = HttpResponse(body, content_type=NDJSON_CONTENT_TYPE)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+
+    # Responses are personalized, so only clients may cache them, and
+    # they have to revalidate them every time.
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ['Cookie'])
+    if body is None:
+        return response
+    return get_conditional_response(
+        request, etag=etag, last_modified=last_modified, response=response)
+
+
+def _log_query(location, radius):
+    query_logger.info('%s,%s,%s', location[0], location[1], radius)
+
+
+def _score_places(places_service, places):
+    """
+    Scores a batch of place dicts, leaving out the ones the user does
+    not like (like sort_places_by_preference).
+    """
+    scored = []
+    for place in places:
+        score = places_service.scorer.score(place)
+        if score >= 0:
+            scored.append({
+                'id': place['id'],
+                'score': score,
+                'location': place['location'],
+            })
+    return scored
+
+
+class _FileRange:
+    """
+    A file-like object reading the `length` bytes of a file from
+    `start`, for partial responses.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _get_range(request, size, etag):
+    """
+    Returns the `(start, end)` bytes (inclusive) of the single range
+    requested by the Range header, None if the whole file should be sent
+    (no range, several ranges, or an If-Range that no longer matches),
+    or False if the range cannot be satisfied.
+    """
+    header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if not header or (if_range is not None and if_range != etag):
+        return None
+    match = _RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        if not int(end):
+            return False
+        return max(0, size - int(end)), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, end
+
+
+def _file_response(request, photo, file, etag):
+    byte_range = _get_range(request, photo.size, etag)
+    if byte_range is False:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{photo.size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(file, content_type=photo.content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(_FileRange(file, start, end - start + 1),
+                                status=206, content_type=photo.content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{photo.size}'
+    response.block_size = PHOTO_BLOCK_SIZE
+    return response
+
+
+@require_GET
+async def nearby_places(request):
+    """
+    Streams the places within `radius` meters of `location`, searched
+    with tiled nearby searches (see get_all_nearby_places_sorted) of at
+    most `max_api_calls` calls. If the search needed more calls, the
+    cursor continues it with the tiles that were left over; a place may
+    then be found again on a later page.
+    """
+    serializer = NearbySearchSerializer(data=request.GET)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    params = serializer.validated_data
+
+    if 'circles' not in params:
+        _log_query(params['location'], params['radius'])
+
+    places_service = get_places_service(request)
+    await places_service.session.aload()
+    maps_client = get_async_maps_client()
+
+    async def lines(budget):
+        leftover = []
+        async for places in places_service.aiter_all_nearby_places(
+            maps_client,
+            params['location'],
+            params['radius'],
+            max_api_calls=params['max_api_calls'],
+            circles=params.get('circles'),
+            leftover=leftover,
+        ):
+            scored = _score_places(places_service, places)
+            if scored:
+                yield _to_line({'places': scored})
+        yield _to_line({
+            'next_cursor': serializer.get_cursor(
+                params['location'], params['radius'], leftover),
+            'partial': budget.degraded,
+        })
+
+    query = {
+        'location': params['location'],
+        'radius': params['radius'],
+        'circles': params.get('circles'),
+        'max_api_calls': params['max_api_calls'],
+    }
+    return await _respond(request, 'nearby_places', query, lines)
+
+
+@require_GET
+async def area_places(request):
+    """
+    Streams a page of `limit` places in an area, sorted by preference
+    (see get_places_in_area_sorted). The area is refreshed from the API
+    before the first page, and the cursor leads to the next page.
+    """
+    serializer = AreaSearchSerializer(data=request.GET)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    params = serializer.validated_data
+    circle = params['location_restriction'].get('circle')
+    if params['key'] is None and circle is not None:
+        center = circle['center']
+        _log_query((center['latitude'], center['longitude']), circle['radius'])
+
+    places_service = get_places_service(request)
+    await places_service.session.aload()
+
+    async def lines(budget):
+        scores, key = await run_in_thread(
+            places_service.get_places_in_area_sorted,
+            params['location_restriction'],
+            result_per_page=params['limit'],
+            cursor=params['key'],
+            max_api_calls=params['max_api_calls'],
+        )
+        if scores:
+            yield _to_line({'places': [
+                {'id': place_id, 'score': score}
+                for place_id, score in scores.items()
+            ]})
+        yield _to_line({
+            'next_cursor': serializer.get_cursor(
+                params['location_restriction'], key),
+            'partial': budget.degraded,
+        })
+
+    query = {
+        'location_restriction': params['location_restriction'],
+        'key': params['key'],
+        'limit': params['limit'],
+        'max_api_calls': params['max_api_calls'],
+    }
+    return await _respond(request, 'area_places', query, lines)
+
+
+@require_POST
+async def places_details(request):
+    """
+    Returns the given fields of a batch of places (see
+    get_places_details), as `{"places": [...], "missing": [...],
+    "partial": ...}`. The places that could not be fetched are listed in
+    `missing`. Places are answered from the cache where possible, and
+    the rest are fetched concurrently, with duplicate IDs fetched once.
+
+    With `"stream": true`, the places are streamed instead as they are
+    fetched, in `{"places": [...]}` lines, the last line being
+    `{"missing": [...], "partial": ...}`.
+
+    Like route_suggestions, the view reads a JSON body, and needs the
+    CSRF token of the session.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError as e:
+        return JsonResponse({'detail': f'JSON parse error - {e}'}, status=400)
+    serializer = PlaceDetailsSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    params = serializer.validated_data
+
+    places_service = get_places_service(request)
+    maps_client = get_async_maps_client()
+
+    def iter_places():
+        return places_service.aiter_places_details(
+            maps_client, place_ids, params['fields'])
+
+    place_ids = list(dict.fromkeys(params['ids']))
+
+    def get_missing(found):
+        return [i for i in place_ids if i not in found]
+
+    if params['stream']:
+        async def lines(budget):
+            found = set()
+            async for places in iter_places():
+                found.update(place['id'] for place in places)
+                yield _to_line({'places': places})
+            yield _to_line({
+                'missing': get_missing(found),
+                'partial': budget.degraded,
+            })
+
+        return _stream(_run_lines(lines))
+
+    places = {}
+    async for batch in iter_places():
+        places.update((place['id'], place) for place in batch)
+    budget = get_budget()
+    return JsonResponse({
+        'places': [places[i] for i in place_ids if i in places],
+        'missing': get_missing(places),
+        'partial': budget is not None and budget.degraded,
+    })
+
+
+@require_POST
+async def route_suggestions(request):
+    """
+    Streams the places near a route (see get_places_near_route_sorted).
+    The last line also has the best `max_count` of them as `top`, sorted
+    by score. Suggestions always fit in one page, so there is no cursor.
+
+    The route is sent in a JSON body since it can be long. Requests are
+    authenticated by the session cookie, so like any POST they need the
+    CSRF token (see the README).
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError as e:
+        return JsonResponse({'detail': f'JSON parse error - {e}'}, status=400)
+    serializer = RouteSuggestionsSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    params = serializer.validated_data
+
+    routes_service = get_routes_service(request)
+    places_service = routes_service.places_service
+    await places_service.session.aload()
+    maps_client = get_async_maps_client()
+
+    async def lines(budget):
+        found = []
+        async for places in routes_service.aiter_places_near_route(
+            maps_client,
+            params['route'],
+            max_distance=params['max_distance'],
+            max_api_calls=params['max_api_calls'],
+        ):
+            scored = _score_places(places_service, places)
+            if scored:
+                found.extend(scored)
+                yield _to_line({'places': scored})
+        top = sorted(found, key=lambda p: p['score'], reverse=True)
+        yield _to_line({
+            'top': [
+                {'id': p['id'], 'score': p['score']}
+                for p in top[:params['max_count']]
+            ],
+            'next_cursor': None,
+            'partial': budget.degraded,
+        })
+
+    return _stream(_run_lines(lines))
+
+
+@require_GET
+async def place_photo(request):
+    """
+    Serves a photo of a place, scaled down to fit in `max_width` and
+    `max_height` pixels. Photos are fetched from the Places API once,
+    then served from the disk cache (see PhotoCache) with HTTP range
+    support. They are immutable, so they are sent with a strong ETag and
+    can be cached publicly for PHOTO_MAX_AGE.
+
+    NOTE: full responses are sent with sendfile by WSGI servers that
+    support it; ASGI servers read them through the application.
+    """
+    serializer = PlacePhotoSerializer(data=request.GET)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    params = serializer.validated_data
+
+    try:
+        photo, file = await photo_cache.aopen(
+            get_async_maps_client(),
+            params['name'],
+            params['max_width'],
+            params['max_height'],
+        )
+    except (QuotaExceeded, FileNotFoundError):
+        return JsonResponse(
+            {'detail': 'The photo is not available right now.'}, status=503)
+    except exceptions.HTTPError as e:
+        if e.status_code < 500:
+            return JsonResponse({'detail': 'Not found.'}, status=404)
+        return JsonResponse(
+            {'detail': 'The photo could not be fetched.'}, status=502)
+    except (exceptions.Timeout, exceptions.TransportError):
+        return JsonResponse(
+            {'detail': 'The photo could not be fetched.'}, status=502)
+
+    etag = f'"{photo.digest}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = _file_response(request, photo, file, etag)
+    else:
+        file.close()
+    response['ETag'] = etag
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = f'public, max-age={PHOTO_MAX_AGE}, immutable'
+    return response
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from common.apis.fake import FakeMapsBackend
+from common.apis.maps import AsyncMapsClient, MapsClient
+from common.apis.ratelimit import LEGACY, PLACES_V2, ROUTES, RequestScheduler
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.test import AsyncClient
+
+import geodata.services
+import geodata.views
+from geodata.services.cache import nearby_search_cache, place_details_cache
+from geodata.services.matrix import travel_time_matrix_service
+from geodata.services.scoring import _compiled_preferences
+
+# Rate limits that never make the tests wait for a token.
+UNLIMITED_RATE_LIMITS = {
+    endpoint: (1e9, 1e9) for endpoint in (PLACES_V2, ROUTES, LEGACY)
+}
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Starts every test with empty caches, in both tiers."""
+    for alias in settings.CACHES:
+        caches[alias].clear()
+    for local in (
+        place_details_cache.local,
+        nearby_search_cache.local,
+        travel_time_matrix_service.local,
+        _compiled_preferences,
+    ):
+        local.clear()
+
+
+@pytest.fixture
+def backend():
+    """A fake Maps backend that makes up deterministic responses."""
+    return FakeMapsBackend()
+
+
+@pytest.fixture
+def scheduler():
+    return RequestScheduler(UNLIMITED_RATE_LIMITS)
+
+
+@pytest.fixture
+def maps_client(backend, scheduler, monkeypatch):
+    """
+    The Maps client of the process, served by the fake backend. Calls
+    are neither throttled by the scheduler nor by the googlemaps client.
+    """
+    client = MapsClient(
+        scheduler=scheduler,
+        key='AIzaTest',
+        requests_session=backend.session(),
+    )
+    client.client.queries_quota = 10 ** 9
+    monkeypatch.setattr(geodata.services, '_maps_client', client)
+    return client
+
+
+@pytest.fixture
+def async_maps_client(backend, scheduler, maps_client, monkeypatch):
+    """
+    Makes the views use async Maps clients served by the fake backend,
+    one per event loop like get_async_maps_client.
+    """
+    clients = {}
+
+    def get_async_maps_client():
+        loop = asyncio.get_running_loop()
+        if loop not in clients:
+            clients[loop] = AsyncMapsClient(
+                client=maps_client.client,
+                scheduler=scheduler,
+                transport=backend.async_transport(),
+            )
+        return clients[loop]
+
+    monkeypatch.setattr(
+        geodata.views, 'get_async_maps_client', get_async_maps_client)
+    return get_async_maps_client
+
+
+@pytest.fixture
+def make_client(db):
+    """
+    Returns a function that makes an AsyncClient logged in as the given
+    user (or anonymous), through the session like the users app.
+    """
+    def make_client(user=None):
+        client = AsyncClient()
+        if user is not None:
+            session = SessionStore()
+            session['user_id'] = user.pk
+            session.save()
+            client.cookies[settings.SESSION_COOKIE_NAME] = (
+                session.session_key)
+        return client
+
+    return make_client
+
+
+async def read_stream(response):
+    """Returns the body of a (streaming) response."""
+    if not response.streaming:
+        return response.content
+    return b''.join([chunk async for chunk in response.streaming_content])
@@ -0,0 +1,42 @@
+"""
+Settings of the test suite: the project settings, with a throwaway
+SQLite database and in-memory caches, so that the tests need no
+services.
+"""
+
+import os
+import tempfile
+
+from config.settings import *  # noqa: F401,F403
+
+SECRET_KEY = 'test'
+
+# The services write to the database from their thread pools, which an
+# in-memory SQLite database (shared between threads with table locks)
+# does not allow, so the test database is a temporary file.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        'TEST': {
+            'NAME': os.path.join(
+                tempfile.gettempdir(), f'midtreats-test-{os.getpid()}.db'),
+        },
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'default',
+    },
+    'geodata': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'geodata',
+    },
+}
+
+UPSTREAM_HEDGING = None
+UPSTREAM_TRACE = False
+QUERY_LOG = None
+LOGGING = {'version': 1, 'disable_existing_loggers': False}
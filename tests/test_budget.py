@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from common.apis.budget import (
+    BudgetExceeded,
+    call_budget,
+    get_call_cost,
+    mark_degraded,
+)
+from common.apis.maps import AsyncMapsClient, MapsClient
+from common.apis.ratelimit import (
+    INTERACTIVE,
+    PLACES_V2,
+    PREFETCH,
+    QuotaExceeded,
+    RequestScheduler,
+)
+
+from geodata.serializers import MAX_DETAILS_BATCH
+from geodata.services.tiling import (
+    DEFAULT_MAX_CORRIDOR_CALLS,
+    DEFAULT_MAX_TILING_CALLS,
+)
+
+# The largest request of every endpoint, as `(operation, calls)`.
+LARGEST_REQUESTS = [
+    ('places:searchNearby', DEFAULT_MAX_TILING_CALLS),
+    ('places:searchNearby', DEFAULT_MAX_CORRIDOR_CALLS),
+    ('places:get', MAX_DETAILS_BATCH),
+]
+
+
+@pytest.mark.parametrize('operation, calls', LARGEST_REQUESTS)
+def test_default_budget_covers_the_caps_of_the_endpoints(
+        settings, operation, calls):
+    budget = settings.UPSTREAM_BUDGET
+    assert calls <= budget['max_calls']
+    assert calls * get_call_cost(operation, 'PREFERRED') <= budget['max_cost']
+
+
+def test_only_budgets_that_refuse_calls_are_exhausted():
+    with call_budget(max_calls=1) as parent:
+        with call_budget() as child:
+            mark_degraded()
+        parent.charge(0.0)
+        with pytest.raises(BudgetExceeded):
+            parent.charge(0.0)
+
+    assert child.degraded and parent.degraded
+    assert parent.exhausted and not child.exhausted
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_calls_refused_by_the_scheduler_are_not_charged(backend, use_async):
+    # One call, then none for 100 seconds.
+    scheduler = RequestScheduler(
+        {PLACES_V2: (0.01, 1.0)}, {INTERACTIVE: 0.0, PREFETCH: 0.0})
+    client = MapsClient(scheduler=scheduler, key='AIzaTest',
+                        requests_session=backend.session())
+
+    async def aplace(place_id):
+        async_client = AsyncMapsClient(
+            client=client.client, scheduler=scheduler,
+            transport=backend.async_transport())
+        return await async_client.place(place_id, ['id'])
+
+    def place(place_id):
+        if use_async:
+            return asyncio.run(aplace(place_id))
+        return client.place(place_id, ['id'])
+
+    with call_budget(max_calls=10) as budget:
+        place('fake_1_2_0')
+        cost = budget.cost
+        with pytest.raises(QuotaExceeded):
+            place('fake_1_2_1')
+
+    assert backend.calls[PLACES_V2] == 1
+    assert budget.calls == 1
+    assert budget.cost == cost
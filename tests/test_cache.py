@@ -0,0 +1,137 @@
+import time
+
+import pytest
+from common.apis.ratelimit import PLACES_V2
+from users.models import User
+
+from geodata.services.cache import (
+    LRUCache,
+    NearbySearchCache,
+    PlaceDetailsCache,
+    get_circle_bucket,
+)
+from geodata.services.geo import (
+    geohash_bounds,
+    geohash_center,
+    geohash_cover,
+    geohash_encode,
+    haversine_distance,
+)
+from geodata.services.places import PlacesService
+
+FIELDS = ['id', 'location', 'types']
+
+
+def test_geohash_encode():
+    assert geohash_encode((57.64911, 10.40744), 11) == 'u4pruydqqvj'
+    assert geohash_encode((57.64911, 10.40744), 5) == 'u4pru'
+
+
+def test_geohash_bounds_contain_the_point():
+    geohash = geohash_encode((-6.2, 106.8), 7)
+    min_lat, min_lng, max_lat, max_lng = geohash_bounds(geohash)
+
+    assert min_lat <= -6.2 < max_lat
+    assert min_lng <= 106.8 < max_lng
+    assert geohash_encode(geohash_center(geohash), 7) == geohash
+
+
+def test_geohash_cover_covers_the_bounds():
+    bounds = (-6.21, 106.79, -6.19, 106.81)
+
+    cells = geohash_cover(bounds, 16)
+
+    assert 1 < len(cells) <= 16
+    for lat in (-6.21, -6.2, -6.19):
+        for lng in (106.79, 106.8, 106.81):
+            assert any(geohash_encode((lat, lng), len(c)) == c
+                       for c in cells)
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_entries_expire():
+    cache = LRUCache(max_entries=10, ttl=60)
+    cache.set('a', 1, ttl=0.01)
+    cache.set('b', 2)
+    time.sleep(0.02)
+
+    assert cache.get('a', 'expired') == 'expired'
+    assert cache.get('b') == 2
+
+
+def test_nearly_the_same_circles_share_a_bucket():
+    bucket = get_circle_bucket((-6.2, 106.8), 1000)
+
+    assert get_circle_bucket((-6.20001, 106.80001), 990) == bucket
+    assert get_circle_bucket((-6.2, 106.8), 2000) != bucket
+    assert get_circle_bucket((-6.3, 106.8), 1000) != bucket
+
+
+def test_nearby_searches_are_shared_by_nearby_circles(maps_client, backend):
+    cache = NearbySearchCache()
+
+    places, _ = cache.search_places(maps_client, (-6.2, 106.8), 500, FIELDS)
+    nearby, _ = cache.search_places(
+        maps_client, (-6.20002, 106.80002), 480, FIELDS)
+
+    assert backend.calls[PLACES_V2] == 1
+    assert places and nearby
+    for place in nearby:
+        point = place['location']
+        point = (point['latitude'], point['longitude'])
+        assert haversine_distance(point, (-6.20002, 106.80002)) <= 480
+
+
+def test_refreshing_nearby_cache_fetches_again(maps_client, backend):
+    NearbySearchCache().search_places(maps_client, (-6.2, 106.8), 500, FIELDS)
+    NearbySearchCache(refresh=True).search_places(
+        maps_client, (-6.2, 106.8), 500, FIELDS)
+    NearbySearchCache().search_places(maps_client, (-6.2, 106.8), 500, FIELDS)
+
+    assert backend.calls[PLACES_V2] == 2
+
+
+def test_refreshing_place_details_cache_fetches_every_field(
+        maps_client, backend):
+    place_ids = ['fake_3100_53400_0', 'fake_3101_53402_1']
+    cached = PlacesService(maps_client, {'user': User()})
+    cached.get_places_details(place_ids, ['types'])
+    refresh = PlacesService(
+        maps_client, {'user': User()},
+        place_cache=PlaceDetailsCache(refresh=True))
+
+    places = refresh.get_places_details(place_ids, ['types', 'rating'])
+
+    assert set(places) == set(place_ids)
+    assert all('rating' in place for place in places.values())
+    assert backend.calls[PLACES_V2] == 4
+    # The refreshed fields are stored for everybody.
+    cached.get_places_details(place_ids, ['types', 'rating'])
+    assert backend.calls[PLACES_V2] == 4
+
+
+@pytest.mark.parametrize('local', [True, False])
+def test_place_details_are_cached_by_field(local):
+    cache = PlaceDetailsCache()
+    cache.set_fields('a', ['types', 'rating'], {'types': ['cafe']})
+    if not local:
+        cache.local.clear()
+
+    assert cache.get_fields('a', ['types', 'rating', 'id']) == (
+        {'types': ['cafe']}, ['id'])
+    assert cache.get_many_fields(['a', 'b'], ['types']) == {
+        'a': ({'types': ['cafe']}, []),
+        'b': ({}, ['types']),
+    }
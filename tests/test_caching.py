@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+import json
+
+import pytest
+from common.apis.budget import call_budget
+from users.models import User
+
+from geodata.caching import response_cache
+
+from .conftest import read_stream
+
+NEARBY_URL = '/geodata/places/nearby/'
+QUERY = {'location': '-6.2,106.8', 'radius': 400, 'max_api_calls': 4}
+
+
+def get_scores(body):
+    lines = [json.loads(line) for line in body.splitlines()]
+    return {place['score'] for line in lines
+            for place in line.get('places', [])}
+
+
+@pytest.fixture
+def users(db):
+    """Two users with opposite preferences, updated in the same second."""
+    cafe_lover = User.objects.create(
+        username='a', email='a@example.com', preferences={'cafe': True})
+    cafe_hater = User.objects.create(
+        username='b', email='b@example.com', preferences={'cafe': False})
+    User.objects.update(updated_at=datetime.datetime(
+        2024, 1, 1, tzinfo=datetime.timezone.utc))
+    return [User.objects.get(pk=u.pk) for u in (cafe_lover, cafe_hater)]
+
+
+def test_validators_depend_on_the_preferences(users):
+    cafe_lover, cafe_hater = users
+    twin = User(pk=3, updated_at=cafe_lover.updated_at,
+                preferences={'cafe': True})
+
+    lover_etag, lover_modified = response_cache.get_validators(
+        'nearby_places', QUERY, cafe_lover)
+    hater_etag, hater_modified = response_cache.get_validators(
+        'nearby_places', QUERY, cafe_hater)
+
+    assert lover_etag != hater_etag
+    assert lover_modified == hater_modified
+    assert response_cache.get_validators(
+        'nearby_places', QUERY, twin)[0] == lover_etag
+
+
+@pytest.mark.django_db(transaction=True)
+def test_users_do_not_share_responses(
+        users, make_client, async_maps_client):
+    lover_client, hater_client = map(make_client, users)
+
+    async def get(client, **kwargs):
+        response = await client.get(NEARBY_URL, QUERY, **kwargs)
+        return response, await read_stream(response)
+
+    async def main():
+        lover, lover_body = await get(lover_client)
+        # Stored now, and served to the same user from the cache.
+        cached, cached_body = await get(lover_client)
+        hater, hater_body = await get(
+            hater_client, headers={'If-None-Match': cached['ETag']})
+        return lover_body, cached, cached_body, hater, hater_body
+
+    lover_body, cached, cached_body, hater, hater_body = asyncio.run(main())
+
+    assert not cached.streaming
+    assert cached_body == lover_body
+    assert hater.status_code == 200
+    assert get_scores(hater_body) == {0}
+    assert get_scores(lover_body) == {0, 1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_only_stored_responses_have_validators(make_client, async_maps_client):
+    client = make_client()
+
+    async def get(**kwargs):
+        response = await client.get(NEARBY_URL, QUERY, **kwargs)
+        await read_stream(response)
+        return response
+
+    async def main():
+        with call_budget(max_calls=1):
+            # Not stored, since some of the searches were refused.
+            partial = await get()
+        streamed = await get()
+        stored = await get()
+        revalidated = await get(headers={'If-None-Match': stored['ETag']})
+        return partial, streamed, stored, revalidated
+
+    partial, streamed, stored, revalidated = asyncio.run(main())
+
+    for response in (partial, streamed):
+        assert response.streaming
+        assert not response.has_header('ETag')
+        assert not response.has_header('Last-Modified')
+    assert not stored.streaming
+    assert stored.has_header('Last-Modified')
+    assert revalidated.status_code == 304
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from django.conf import settings
+from users.models import User
+
+from .conftest import read_stream
+
+CSRF_TOKEN = 'a' * 32
+ROUTE = [[-6.2, 106.8], [-6.19, 106.81]]
+
+
+@pytest.fixture
+def csrf_client(make_client, db):
+    """
+    Returns a function that makes a logged in client which enforces CSRF
+    checks, with the CSRF cookie set if `token` is True.
+    """
+    user = User.objects.create(username='a', email='a@example.com')
+
+    def csrf_client(token):
+        client = make_client(user)
+        client.handler.enforce_csrf_checks = True
+        if token:
+            client.cookies[settings.CSRF_COOKIE_NAME] = CSRF_TOKEN
+        return client
+
+    return csrf_client
+
+
+def post(client, url, data, headers=None):
+    async def main():
+        response = await client.post(
+            url, data, content_type='application/json', headers=headers)
+        await read_stream(response)
+        return response
+
+    return asyncio.run(main())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_route_suggestions_need_the_csrf_token(
+        csrf_client, async_maps_client):
+    url = '/geodata/routes/suggestions/'
+    data = {'route': ROUTE, 'max_api_calls': 1}
+
+    assert post(csrf_client(token=False), url, data).status_code == 403
+    assert post(csrf_client(token=True), url, data).status_code == 403
+    assert post(csrf_client(token=True), url, data,
+                headers={'X-CSRFToken': CSRF_TOKEN}).status_code == 200
+
+
+@pytest.mark.django_db(transaction=True)
+def test_places_details_need_the_csrf_token(csrf_client, maps_client):
+    url = '/geodata/places/details/'
+    data = {'ids': ['fake_3100_53400_0'], 'fields': ['types']}
+
+    assert post(csrf_client(token=False), url, data).status_code == 403
+    assert post(csrf_client(token=True), url, data,
+                headers={'X-CSRFToken': CSRF_TOKEN}).status_code == 200
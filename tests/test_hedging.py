@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import time
+
+import pytest
+from common.apis.hedging import HedgePolicy, acall_hedged, call_hedged
+
+
+def make_policy(**kwargs):
+    policy = HedgePolicy(min_samples=5, min_delay=0.01, burst=1.0,
+                         max_rate=1.0, **kwargs)
+    for _ in range(10):
+        policy.record('places:get', 0.02)
+    return policy
+
+
+def slow_first(delays):
+    """Returns a function whose calls take the given delays in turn."""
+    counter = itertools.count()
+
+    def fn():
+        call = next(counter)
+        time.sleep(delays[min(call, len(delays) - 1)])
+        return call
+
+    return fn
+
+
+def test_no_hedging_until_enough_samples():
+    policy = HedgePolicy(min_samples=5)
+    for _ in range(4):
+        policy.record('places:get', 0.1)
+
+    assert policy.get_delay('places:get') is None
+    policy.record('places:get', 0.1)
+    assert policy.get_delay('places:get') == pytest.approx(0.1)
+    assert policy.get_delay('places:searchNearby') is None
+
+
+def test_delay_follows_the_percentile():
+    policy = HedgePolicy(percentile=0.9, min_samples=1, min_delay=0.0)
+    for latency in range(1, 101):
+        policy.record('places:get', latency / 1000)
+
+    assert policy.get_delay('places:get') == pytest.approx(0.091)
+
+
+def test_hedge_rate_is_capped():
+    policy = HedgePolicy(max_rate=0.1, burst=1.0)
+
+    hedges = 0
+    for _ in range(100):
+        policy.get_delay('places:get')
+        hedges += policy.acquire()
+    assert 9 <= hedges <= 10
+
+
+def test_slow_call_is_hedged():
+    policy = make_policy()
+    fn = slow_first([1.0, 0.02])
+
+    started = time.monotonic()
+    result = call_hedged(policy, 'places_v2', 'places:get', fn)
+
+    assert result == 1
+    assert time.monotonic() - started < 0.5
+
+
+def test_fast_call_is_not_hedged():
+    policy = make_policy()
+    fn = slow_first([0.0])
+
+    assert call_hedged(policy, 'places_v2', 'places:get', fn) == 0
+    assert call_hedged(policy, 'places_v2', 'places:get', fn) == 1
+
+
+def test_hedge_errors_fall_back_to_the_primary():
+    policy = make_policy()
+    counter = itertools.count()
+
+    def fn():
+        if next(counter):
+            raise ValueError('hedge')
+        time.sleep(0.1)
+        return 'primary'
+
+    assert call_hedged(policy, 'places_v2', 'places:get', fn) == 'primary'
+
+
+def test_async_hedge_cancels_the_losing_attempt():
+    policy = make_policy()
+    attempts = []
+
+    async def fn():
+        attempt = len(attempts)
+        attempts.append('started')
+        try:
+            await asyncio.sleep(1.0 if attempt == 0 else 0.02)
+        except asyncio.CancelledError:
+            attempts[attempt] = 'cancelled'
+            raise
+        attempts[attempt] = 'done'
+        return attempt
+
+    async def main():
+        started = time.monotonic()
+        result = await acall_hedged(policy, 'places_v2', 'places:get', fn)
+        await asyncio.sleep(0)
+        return result, time.monotonic() - started
+
+    result, elapsed = asyncio.run(main())
+    assert result == 1
+    assert elapsed < 0.5
+    assert attempts == ['cancelled', 'done']
@@ -0,0 +1,112 @@
+import itertools
+
+import numpy as np
+import pytest
+from common.apis.budget import call_budget
+from common.apis.ratelimit import LEGACY
+
+from geodata.services.matrix import (
+    MAX_MATRIX_DESTINATIONS,
+    MAX_MATRIX_ELEMENTS,
+    MAX_MATRIX_ORIGINS,
+    TravelTimeMatrixService,
+    plan_matrix_calls,
+)
+
+PLACE_IDS = [f'fake_{3100 + i}_{53400 + 2 * i}_{i % 3}' for i in range(12)]
+
+
+def covered_pairs(calls):
+    return {(o, d) for origins, destinations in calls
+            for o in origins for d in destinations}
+
+
+def assert_within_limits(calls):
+    for origins, destinations in calls:
+        assert len(origins) <= MAX_MATRIX_ORIGINS
+        assert len(destinations) <= MAX_MATRIX_DESTINATIONS
+        assert len(origins) * len(destinations) <= MAX_MATRIX_ELEMENTS
+
+
+def test_full_matrix_is_split_into_the_fewest_calls():
+    pairs = list(itertools.product(range(30), range(30)))
+
+    calls = plan_matrix_calls(pairs)
+
+    assert_within_limits(calls)
+    assert covered_pairs(calls) >= set(pairs)
+    assert len(calls) == 9
+
+
+def test_sparse_pairs_skip_unneeded_elements():
+    # One new place added to a cached matrix: only its row and column.
+    pairs = ([(30, d) for d in range(30)]
+             + [(o, 30) for o in range(30)])
+
+    calls = plan_matrix_calls(pairs)
+
+    assert_within_limits(calls)
+    assert covered_pairs(calls) >= set(pairs)
+    assert sum(len(o) * len(d) for o, d in calls) == len(pairs)
+    # 30 destinations need two calls, and so do 30 origins.
+    assert len(calls) == 4
+
+
+def test_matrix_is_fetched_once_and_reused(maps_client, backend):
+    service = TravelTimeMatrixService()
+
+    matrix = service.get_matrix(maps_client, PLACE_IDS)
+    calls = backend.calls[LEGACY]
+
+    assert matrix.shape == (12, 12)
+    assert np.all(np.diag(matrix) == 0)
+    # Symmetric mode fetches one direction of every pair.
+    assert np.array_equal(matrix, matrix.T)
+    assert 0 < calls <= 2
+
+    subset = service.get_matrix(maps_client, PLACE_IDS[3:8])
+    assert backend.calls[LEGACY] == calls
+    assert np.array_equal(subset, matrix[3:8, 3:8])
+
+
+def test_overlapping_matrix_only_fetches_new_pairs(maps_client, backend):
+    service = TravelTimeMatrixService(symmetric=False)
+    service.get_matrix(maps_client, PLACE_IDS[:-1])
+    backend.reset()
+
+    service.get_matrix(maps_client, PLACE_IDS)
+
+    assert backend.calls[LEGACY] == 2
+
+
+def test_pair_travel_times_match_the_matrix(maps_client, backend):
+    service = TravelTimeMatrixService(symmetric=False)
+    legs = list(zip(PLACE_IDS[:-1], PLACE_IDS[1:])) + [PLACE_IDS[:1] * 2]
+
+    times = service.get_pair_travel_times(maps_client, legs)
+
+    # The legs are fetched together, not one call per leg.
+    assert backend.calls[LEGACY] <= 2
+    matrix = service.get_matrix(maps_client, PLACE_IDS)
+    assert times.tolist() == [*np.diag(matrix, 1), 0.0]
+
+
+@pytest.mark.django_db
+def test_refused_calls_are_estimated(maps_client):
+    service = TravelTimeMatrixService()
+    with call_budget(max_calls=0) as budget:
+        matrix = service.get_matrix(maps_client, PLACE_IDS[:3])
+
+    assert budget.degraded
+    # The places are not in the store, so they cannot be estimated.
+    assert np.all(np.isinf(matrix[~np.eye(3, dtype=bool)]))
+    assert service.local.get(
+        service._key(service._pair(*PLACE_IDS[:2]), 'driving', 'any')) is None
+
+
+@pytest.mark.parametrize('count', [1, 7, 25, 60])
+def test_block_plans_stay_within_limits(count):
+    pairs = list(itertools.product(range(count), range(count)))
+    calls = plan_matrix_calls(pairs)
+    assert_within_limits(calls)
+    assert covered_pairs(calls) >= set(pairs)
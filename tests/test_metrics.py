@@ -0,0 +1,103 @@
+import pytest
+from common.metrics import CONTENT_TYPE, Counter, Gauge, Histogram, Registry
+
+METRICS_URL = '/metrics/'
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_exposition(registry):
+    calls = Counter('calls', 'Calls per endpoint.', ['endpoint'],
+                    registry=registry)
+    calls.inc(endpoint='places')
+    calls.inc(2, endpoint='routes')
+    calls.inc(0.5, endpoint='say "hi"\n')
+
+    assert registry.render() == (
+        '# HELP calls Calls per endpoint.\n'
+        '# TYPE calls counter\n'
+        'calls_total{endpoint="places"} 1\n'
+        'calls_total{endpoint="routes"} 2\n'
+        'calls_total{endpoint="say \\"hi\\"\\n"} 0.5\n'
+    )
+    assert calls.get(endpoint='routes') == 2
+
+
+def test_labelled_histogram_exposition(registry):
+    latency = Histogram('latency', 'Latency in seconds.', ['endpoint'],
+                        buckets=(0.1, 1.0, float('inf')), registry=registry)
+    latency.observe(0.05, endpoint='places')
+    latency.observe(0.1, endpoint='places')
+    latency.observe(2.5, endpoint='places')
+    latency.observe(0.5, endpoint='routes')
+
+    assert registry.render().splitlines() == [
+        '# HELP latency Latency in seconds.',
+        '# TYPE latency histogram',
+        'latency_bucket{endpoint="places",le="0.1"} 2',
+        'latency_bucket{endpoint="places",le="1"} 2',
+        'latency_bucket{endpoint="places",le="+Inf"} 3',
+        'latency_sum{endpoint="places"} 2.65',
+        'latency_count{endpoint="places"} 3',
+        'latency_bucket{endpoint="routes",le="0.1"} 0',
+        'latency_bucket{endpoint="routes",le="1"} 1',
+        'latency_bucket{endpoint="routes",le="+Inf"} 1',
+        'latency_sum{endpoint="routes"} 0.5',
+        'latency_count{endpoint="routes"} 1',
+    ]
+
+
+def test_histogram_without_labels(registry):
+    sizes = Histogram('sizes', 'Sizes.', buckets=(10, float('inf')),
+                      registry=registry)
+    sizes.observe(3)
+
+    assert registry.render().splitlines()[2:] == [
+        'sizes_bucket{le="10"} 1',
+        'sizes_bucket{le="+Inf"} 1',
+        'sizes_sum 3',
+        'sizes_count 1',
+    ]
+
+
+def test_gauge_values_are_computed_when_exported(registry):
+    entries = {('local',): 3}
+    Gauge('entries', 'Cache entries.', ['tier'], callback=lambda: entries,
+          registry=registry)
+    entries = {('local',): 5, ('shared',): 7}
+
+    assert registry.render().splitlines()[2:] == [
+        'entries{tier="local"} 5',
+        'entries{tier="shared"} 7',
+    ]
+
+
+def test_metrics_are_checked(registry):
+    calls = Counter('calls', 'Calls.', ['endpoint'], registry=registry)
+
+    with pytest.raises(ValueError):
+        calls.inc(tier='basic')
+    with pytest.raises(ValueError):
+        Counter('calls', 'Calls again.', registry=registry)
+
+
+def test_metrics_endpoint(client):
+    response = client.get(METRICS_URL)
+
+    assert response.status_code == 200
+    assert response['Content-Type'] == CONTENT_TYPE
+    assert b'# TYPE maps_upstream_hedges counter' in response.content
+
+
+def test_metrics_endpoint_is_restricted(client, settings):
+    assert client.post(METRICS_URL).status_code == 405
+    assert client.get(
+        METRICS_URL, REMOTE_ADDR='203.0.113.7').status_code == 403
+
+    settings.METRICS_ALLOWED_IPS = ['203.0.113.7']
+    assert client.get(
+        METRICS_URL, REMOTE_ADDR='203.0.113.7').status_code == 200
+    assert client.get(METRICS_URL).status_code == 403
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+
+import pytest
+from asgiref.sync import iscoroutinefunction
+from common.apis.budget import get_budget
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+
+from core.middleware import (
+    PARTIAL_RESULTS_HEADER,
+    UPSTREAM_CALLS_HEADER,
+    CallBudgetMiddleware,
+    UpstreamTraceMiddleware,
+)
+
+from .conftest import read_stream
+
+NEARBY_URL = '/geodata/places/nearby/'
+QUERY = {'location': '-6.2,106.8', 'radius': 400, 'max_api_calls': 20}
+
+
+@pytest.fixture
+def budget_settings(settings):
+    settings.UPSTREAM_BUDGET = {'max_calls': 3}
+    settings.UPSTREAM_TRACE = True
+    return settings
+
+
+@pytest.mark.parametrize(
+    'middleware', [CallBudgetMiddleware, UpstreamTraceMiddleware])
+def test_middleware_follows_the_mode_of_the_chain(middleware, budget_settings):
+    async def aget_response(request):
+        return HttpResponse()
+
+    def get_response(request):
+        return HttpResponse()
+
+    assert iscoroutinefunction(middleware(aget_response))
+    assert not iscoroutinefunction(middleware(get_response))
+
+
+def test_budget_covers_the_body_of_streams(budget_settings):
+    budgets = []
+
+    async def lines():
+        budgets.append(get_budget())
+        yield b'{}\n'
+
+    async def get_response(request):
+        return StreamingHttpResponse(lines())
+
+    middleware = CallBudgetMiddleware(get_response)
+    request = RequestFactory().get('/')
+
+    async def main():
+        response = await middleware(request)
+        await read_stream(response)
+        return response
+
+    response = asyncio.run(main())
+    assert budgets == [request.call_budget]
+    assert PARTIAL_RESULTS_HEADER not in response
+
+
+@pytest.mark.django_db(transaction=True)
+def test_streams_trace_the_calls_of_their_body(
+        budget_settings, backend, make_client, async_maps_client, caplog):
+    client = make_client()
+
+    async def main():
+        response = await client.get(NEARBY_URL, QUERY)
+        return response, await read_stream(response)
+
+    with caplog.at_level(logging.INFO, logger='core.upstream'):
+        response, body = asyncio.run(main())
+
+    # The calls are made while the body is sent, after the headers.
+    assert UPSTREAM_CALLS_HEADER not in response
+    calls = sum(backend.calls.values())
+    assert calls == 3
+    # Refused calls are traced too, with their error.
+    assert f'places:searchNearby BASIC x{calls} ' in caplog.text
+    assert 'BudgetExceeded' in caplog.text
+    assert json.loads(body.splitlines()[-1])['partial'] is True
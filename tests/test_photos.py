@@ -0,0 +1,142 @@
+import asyncio
+import os
+
+import pytest
+from common.apis.fake import PHOTOS
+
+import geodata.views
+from geodata.services.photos import PhotoCache
+
+PHOTO_URL = '/geodata/places/photo/'
+QUERY = {'name': 'places/fake_1_2_0/photos/p0', 'max_width': 100}
+# The synthetic photo of QUERY: 16 bytes per pixel of width.
+PHOTO_SIZE = 1600
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture
+def photos(tmp_path, monkeypatch):
+    """Makes the views use a photo cache of their own."""
+    cache = PhotoCache(tmp_path)
+    monkeypatch.setattr(geodata.views, 'photo_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def get_photo(make_client, async_maps_client, photos):
+    """Returns a function that gets the photo of QUERY and its body."""
+    client = make_client()
+
+    def get_photo(**headers):
+        response = asyncio.run(client.get(PHOTO_URL, QUERY, headers=headers))
+        body = b''.join(response.streaming_content) if (
+            response.streaming) else response.content
+        response.close()
+        return response, body
+
+    return get_photo
+
+
+def test_photo_is_fetched_once(get_photo, backend):
+    response, body = get_photo()
+    again, body_again = get_photo()
+
+    assert response.status_code == again.status_code == 200
+    assert len(body) == PHOTO_SIZE
+    assert body_again == body
+    assert again['ETag'] == response['ETag']
+    assert backend.calls[PHOTOS] == 1
+
+
+def test_range_requests(get_photo):
+    _, body = get_photo()
+
+    response, part = get_photo(Range='bytes=100-199')
+    assert response.status_code == 206
+    assert part == body[100:200]
+    assert response['Content-Range'] == f'bytes 100-199/{PHOTO_SIZE}'
+
+    response, part = get_photo(Range='bytes=-100')
+    assert response.status_code == 206
+    assert part == body[-100:]
+    assert response['Content-Range'] == (
+        f'bytes {PHOTO_SIZE - 100}-{PHOTO_SIZE - 1}/{PHOTO_SIZE}')
+
+
+@pytest.mark.parametrize('header', [f'bytes={PHOTO_SIZE}-', 'bytes=-0'])
+def test_unsatisfiable_ranges_are_refused(get_photo, header):
+    response, _ = get_photo(Range=header)
+
+    assert response.status_code == 416
+    assert response['Content-Range'] == f'bytes */{PHOTO_SIZE}'
+
+
+def test_ranges_of_another_version_send_the_whole_photo(get_photo):
+    response, body = get_photo()
+
+    partial, part = get_photo(Range='bytes=0-9', If_Range=response['ETag'])
+    assert partial.status_code == 206
+    assert part == body[:10]
+
+    full, content = get_photo(Range='bytes=0-9', If_Range='"other"')
+    assert full.status_code == 200
+    assert content == body
+
+
+def test_etags_are_revalidated(get_photo):
+    response, _ = get_photo()
+
+    response, body = get_photo(If_None_Match=response['ETag'])
+
+    assert response.status_code == 304
+    assert body == b''
+
+
+def test_evicted_photo_is_fetched_again(get_photo, photos, backend,
+                                        monkeypatch):
+    _, body = get_photo()
+    lookup = photos.lookup
+
+    def lookup_then_evict(*args):
+        # Another worker evicts the photo right after it is found.
+        photo = lookup(*args)
+        if photo is not None:
+            photos.evict(max_bytes=0)
+        return photo
+
+    monkeypatch.setattr(photos, 'lookup', lookup_then_evict)
+    response, body_again = get_photo()
+
+    assert response.status_code == 200
+    assert body_again == body
+    assert backend.calls[PHOTOS] == 2
+
+
+def test_least_recently_used_photos_are_evicted(tmp_path):
+    photos = PhotoCache(tmp_path, max_bytes=10 ** 6)
+    for i, name in enumerate('abc'):
+        photo = photos.store(name, 100, None, name.encode() * 100,
+                             'image/jpeg')
+        os.utime(photo.path, (1000 + i, 1000 + i))
+    # Serving a photo makes it recent again.
+    os.utime(photos.lookup('a', 100).path)
+
+    assert photos.evict(max_bytes=200) == 1
+    assert photos.lookup('b', 100) is None
+    assert photos.lookup('a', 100) is not None
+    assert photos.lookup('c', 100) is not None
+    assert not os.path.lexists(photos._ref_path('b', 100, None))
+
+
+def test_cache_is_trimmed_when_it_overflows(tmp_path):
+    photos = PhotoCache(tmp_path, max_bytes=250)
+    for i, name in enumerate('abc'):
+        photo = photos.store(name, 100, None, name.encode() * 100,
+                             'image/jpeg')
+        os.utime(photo.path, (1000 + i, 1000 + i))
+
+    # Down to PHOTO_CACHE_LOW_WATER of the maximum size.
+    assert photos.lookup('a', 100) is None
+    assert photos.lookup('b', 100) is not None
+    assert photos.lookup('c', 100) is not None
@@ -0,0 +1,52 @@
+import pytest
+from common.apis.budget import call_budget
+from common.apis.ratelimit import PLACES_V2
+from users.models import User
+
+from geodata.models import AreaCell
+from geodata.services.places import PlacesService
+from geodata.services.store import PlaceStore
+
+# About 1.2 km by 1.1 km, covered by 6 geohash cells of precision 6.
+AREA = {'rectangle': {
+    'low': {'latitude': -6.205, 'longitude': 106.795},
+    'high': {'latitude': -6.195, 'longitude': 106.805},
+}}
+
+
+@pytest.fixture
+def places_service(maps_client):
+    user = User(preferences={'cafe': True, 'bar': False})
+    return PlacesService(maps_client, {'user': user})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_area_is_refreshed_once(places_service, backend):
+    cells = PlaceStore().get_area_cells(AREA)
+
+    with call_budget() as budget:
+        scores, cursor = places_service.get_places_in_area_sorted(
+            AREA, result_per_page=10, max_api_calls=600)
+
+    assert not budget.degraded
+    assert len(scores) == 10 and cursor is not None
+    assert set(AreaCell.objects.values_list('geohash', flat=True)) == set(
+        cells)
+
+    backend.reset()
+    places_service.get_places_in_area_sorted(AREA, result_per_page=10)
+    assert backend.calls[PLACES_V2] == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_truncated_refresh_only_marks_covered_cells(places_service):
+    cells = PlaceStore().get_area_cells(AREA)
+
+    with call_budget() as budget:
+        places_service.get_places_in_area_sorted(
+            AREA, max_api_calls=len(cells) - 1)
+
+    assert budget.degraded
+    # No cell could be split when it was saturated, so none is complete,
+    # and the last one was not searched at all.
+    assert not AreaCell.objects.exists()
@@ -0,0 +1,121 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from geodata.services import planning
+from geodata.services.planning import (
+    UNREACHABLE_COST,
+    find_best_insertions,
+    get_route_cost,
+    plan_routes,
+)
+
+
+def random_costs(count, seed):
+    rng = np.random.default_rng(seed)
+    points = rng.random((count, 2))
+    distances = np.linalg.norm(points[:, None] - points[None], axis=2)
+    # Slightly asymmetric, like travel times.
+    return distances * (1 + 0.2 * rng.random((count, count)))
+
+
+def brute_force_routes(costs, anchors, free, max_count):
+    """Enumerates every route through the anchors and the free nodes."""
+    routes = set()
+    for order in itertools.permutations(free):
+        for cuts in itertools.combinations_with_replacement(
+                range(len(order) + 1), len(anchors) - 2):
+            route = [anchors[0]]
+            start = 0
+            for gap, end in enumerate([*cuts, len(order)]):
+                route += [*order[start:end], anchors[gap + 1]]
+                start = end
+            routes.add(tuple(route))
+    return sorted((get_route_cost(costs, r), list(r)) for r in routes)[
+        :max_count]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_held_karp_finds_the_best_routes(seed):
+    costs = random_costs(8, seed)
+    anchors, free = [0, 1, 2], [3, 4, 5, 6, 7]
+
+    routes = plan_routes(costs, anchors, free, 3)
+
+    expected = brute_force_routes(costs, anchors, free, 3)
+    assert [c for c, _ in routes] == pytest.approx([c for c, _ in expected])
+    for cost, route in routes:
+        assert cost == pytest.approx(get_route_cost(costs, route))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_local_search_is_close_to_the_best_route(seed, monkeypatch):
+    costs = random_costs(8, seed)
+    anchors, free = [0, 1], [2, 3, 4, 5, 6, 7]
+    best_cost, _ = brute_force_routes(costs, anchors, free, 1)[0]
+
+    monkeypatch.setattr(planning, 'HELD_KARP_MAX_PLACES', 0)
+    (cost, route), = plan_routes(costs, anchors, free, 1)
+
+    assert route[0] == 0 and route[-1] == 1
+    assert sorted(route[1:-1]) == free
+    assert cost <= best_cost * 1.05
+
+
+def test_large_routes_visit_every_node_once():
+    costs = random_costs(40, 0)
+
+    routes = plan_routes(costs, [0, 1], list(range(2, 40)), 3)
+
+    assert len(routes) == 3
+    assert [c for c, _ in routes] == sorted(c for c, _ in routes)
+    for _, route in routes:
+        assert sorted(route) == list(range(40))
+        assert route[0] == 0 and route[-1] == 1
+
+
+def test_unreachable_routes_are_left_out():
+    costs = random_costs(4, 0)
+    costs[:, 3] = np.inf
+
+    assert plan_routes(costs, [0, 1], [2, 3], 3) == []
+    assert plan_routes(costs, [0, 1], [2], 3)[0][0] < UNREACHABLE_COST
+
+
+def test_plan_routes_requires_two_anchors():
+    with pytest.raises(ValueError):
+        plan_routes(random_costs(3, 0), [0], [1, 2], 1)
+
+
+def test_find_best_insertions():
+    costs = random_costs(6, 0)
+    route = [0, 1, 2]
+    candidates = [3, 4, 5]
+    penalties = np.array([0.0, -0.5, 0.0])
+    leg_costs = [costs[0, 1], costs[1, 2]]
+
+    insertions = find_best_insertions(
+        leg_costs,
+        costs[np.ix_(route, candidates)],
+        costs[np.ix_(candidates, route)],
+        penalties,
+        max_count=4,
+    )
+
+    expected = sorted(
+        (costs[route[leg], c] + costs[c, route[leg + 1]] - leg_costs[leg]
+         + penalties[k], k, leg)
+        for k, c in enumerate(candidates) for leg in range(2)
+    )[:4]
+    assert [(k, leg) for _, _, k, leg in insertions] == [
+        (k, leg) for _, k, leg in expected]
+    assert [s for s, _, _, _ in insertions] == pytest.approx(
+        [s for s, _, _ in expected])
+
+
+def test_no_insertions_are_asked_for():
+    costs = random_costs(4, 0)
+
+    assert find_best_insertions(
+        [costs[0, 1]], costs[:2, 2:], costs[2:, :2], [0.0, 0.0], 0) == []
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from users.models import User
+
+from geodata.services.places import PlacesService
+from geodata.services.ranking import (
+    RRF_K,
+    fuse_scores,
+    get_rank_fusion_scores,
+    merge_rankings,
+    select_top,
+)
+
+PLACES = [{'id': place_id, 'types': [place_type]} for place_id, place_type
+          in zip('abcde', ['cafe', 'bar', 'cafe', 'museum', 'bar'])]
+BY_DISTANCE = PLACES
+BY_POPULARITY = [PLACES[3], PLACES[1], PLACES[0], PLACES[1]]
+
+
+def test_merge_rankings():
+    candidates, ranks = merge_rankings([BY_DISTANCE, BY_POPULARITY])
+
+    assert [p['id'] for p in candidates] == list('abcde')
+    # Duplicates keep their first rank, missing places have rank 0.
+    assert ranks.tolist() == [[1, 2, 3, 4, 5], [3, 2, 0, 1, 0]]
+
+
+def test_reciprocal_rank_fusion():
+    scores = get_rank_fusion_scores([[1, 2], [0, 1]])
+
+    assert scores == pytest.approx([
+        1 / (RRF_K + 1),
+        1 / (RRF_K + 2) + 1 / (RRF_K + 1),
+    ])
+    assert fuse_scores([[1, 2], [0, 1]], [1, -1]) == pytest.approx(
+        scores + [1, -1])
+
+
+def test_select_top():
+    assert select_top([1, 3, 3, 2], 2) == [1, 2]
+    assert select_top([1, 3, 3, 2]) == [1, 2, 3, 0]
+    assert select_top([1, 3, 3, 2], candidates=[0, 2, 3]) == [2, 3, 0]
+    assert select_top(np.array([]), 3) == []
+
+
+def test_places_are_ranked_by_preference_then_ranks():
+    user = User(preferences={'cafe': True, 'bar': False})
+    service = PlacesService(None, {'user': user})
+
+    ranked = service.rank_places([BY_DISTANCE, BY_POPULARITY])
+
+    # Preferred cafes first (a is ranked in both lists), then the museum;
+    # disliked bars are filtered out.
+    assert list(ranked) == ['a', 'c', 'd']
+    assert ranked['a'] > ranked['c'] > 1 > ranked['d'] > 0
+
+
+def test_ranking_without_filtering():
+    user = User(preferences={'cafe': True, 'bar': False})
+    service = PlacesService(None, {'user': user})
+
+    ranked = service.rank_places(
+        [BY_DISTANCE, BY_POPULARITY], filter_by_preference=False,
+        max_count=4)
+
+    assert list(ranked) == ['a', 'c', 'd', 'b']
+    assert service.rank_places([]) == {}
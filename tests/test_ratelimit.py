@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from common.apis.ratelimit import (
+    INTERACTIVE,
+    PLACES_V2,
+    PREFETCH,
+    QuotaExceeded,
+    RequestScheduler,
+    TokenBucket,
+    priority,
+)
+
+
+def make_scheduler(rate=20.0, capacity=2.0, max_wait=1.0):
+    return RequestScheduler(
+        {PLACES_V2: (rate, capacity)},
+        {INTERACTIVE: max_wait, PREFETCH: max_wait},
+    )
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=10.0, capacity=2.0)
+    bucket.tokens = 0.0
+
+    bucket.refill(bucket.updated_at + 0.1)
+    assert bucket.tokens == pytest.approx(1.0)
+    assert bucket.get_wait(2) == pytest.approx(0.1)
+
+    bucket.refill(bucket.updated_at + 10)
+    assert bucket.tokens == 2.0
+
+
+def test_bursts_are_admitted_then_smoothed():
+    scheduler = make_scheduler(rate=20.0, capacity=2.0)
+
+    started = time.monotonic()
+    for _ in range(4):
+        scheduler.acquire(PLACES_V2)
+
+    # Two calls from the burst, and two after 1 / 20 s each.
+    assert time.monotonic() - started == pytest.approx(0.1, abs=0.05)
+
+
+def test_calls_that_would_wait_too_long_fail_right_away():
+    scheduler = make_scheduler(rate=1.0, capacity=1.0, max_wait=0.2)
+    scheduler.acquire(PLACES_V2)
+
+    started = time.monotonic()
+    with pytest.raises(QuotaExceeded):
+        scheduler.acquire(PLACES_V2)
+    assert time.monotonic() - started < 0.05
+    assert not scheduler.try_acquire(PLACES_V2)
+
+
+def test_interactive_calls_go_before_prefetch_calls():
+    scheduler = make_scheduler(rate=20.0, capacity=1.0)
+    scheduler.acquire(PLACES_V2)
+    order = []
+
+    def call(level, name):
+        with priority(level):
+            scheduler.acquire(PLACES_V2)
+        order.append(name)
+
+    threads = []
+    for i in range(3):
+        threads.append(threading.Thread(
+            target=call, args=(PREFETCH, f'prefetch{i}')))
+        threads[-1].start()
+        time.sleep(0.005)
+    threads.append(threading.Thread(
+        target=call, args=(INTERACTIVE, 'interactive')))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+    # The first prefetch call was already next when the interactive one
+    # arrived; the others wait for it.
+    assert order.index('interactive') <= 1
+
+
+def test_drain_empties_the_bucket():
+    scheduler = make_scheduler(rate=1.0, capacity=5.0, max_wait=0.0)
+    scheduler.drain(PLACES_V2)
+
+    with pytest.raises(QuotaExceeded):
+        scheduler.acquire(PLACES_V2)
+
+
+def test_async_calls_wait_on_the_event_loop():
+    scheduler = make_scheduler(rate=20.0, capacity=1.0)
+    threads = []
+
+    async def count_threads():
+        await asyncio.sleep(0.05)
+        threads.append(threading.active_count())
+
+    async def main():
+        started = time.monotonic()
+        await asyncio.gather(
+            count_threads(),
+            *[scheduler.acquire_async(PLACES_V2) for _ in range(4)],
+        )
+        return time.monotonic() - started
+
+    before = threading.active_count()
+    assert asyncio.run(main()) == pytest.approx(0.15, abs=0.05)
+    assert threads == [before]
+
+
+def test_async_and_sync_calls_share_the_queue():
+    scheduler = make_scheduler(rate=20.0, capacity=1.0)
+    scheduler.acquire(PLACES_V2)
+    order = []
+
+    def call():
+        with priority(PREFETCH):
+            scheduler.acquire(PLACES_V2)
+        order.append('prefetch')
+
+    async def main():
+        thread = threading.Thread(target=call)
+        thread.start()
+        await asyncio.sleep(0.01)
+        # The interactive call goes ahead of the waiting thread.
+        await scheduler.acquire_async(PLACES_V2)
+        order.append('interactive')
+        thread.join()
+
+    asyncio.run(main())
+    assert order == ['interactive', 'prefetch']
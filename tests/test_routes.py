@@ -0,0 +1,121 @@
+import asyncio
+import itertools
+
+import pytest
+from common.apis.budget import call_budget
+from common.apis.ratelimit import PLACES_V2
+from googlemaps import exceptions
+from users.models import User
+
+from geodata.services.places import PlacesService
+from geodata.services.routes import RoutesService
+
+PLACE_IDS = [f'fake_{3100 + i}_{53400 + 2 * i}_{i % 3}' for i in range(8)]
+ROUTE, CANDIDATES = PLACE_IDS[:3], PLACE_IDS[3:]
+# About 4.5 km, searched with a few corridor searches.
+POLYLINE = [(-6.2 + 0.01 * i, 106.8 + 0.01 * i) for i in range(4)]
+
+
+@pytest.fixture
+def routes_service(maps_client):
+    user = User(preferences={'cafe': True, 'bar': False})
+    return RoutesService(maps_client, {'user': user})
+
+
+def fail(*args, **kwargs):
+    raise AssertionError('The places are looked up one by one.')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_candidates_are_scored_in_one_batch(
+        routes_service, backend, monkeypatch):
+    monkeypatch.setattr(PlacesService, 'get_place_details', fail)
+
+    variants = routes_service.add_places_into_planned_route(
+        CANDIDATES, ROUTE, max_count=3)
+
+    assert len(variants) == 3
+    for variant in variants:
+        added = set(variant['places']) - set(ROUTE)
+        assert len(added) == 1 and added <= set(CANDIDATES)
+    assert backend.calls[PLACES_V2] == len(CANDIDATES)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_only_the_legs_of_the_route_are_fetched(
+        routes_service, maps_client, monkeypatch):
+    matrix_service = routes_service.matrix_service
+    fetch = matrix_service._fetch
+    fetched = []
+
+    def spy(maps_client, pairs, *args):
+        fetched.extend(pairs)
+        return fetch(maps_client, pairs, *args)
+
+    monkeypatch.setattr(matrix_service, '_fetch', spy)
+    variants = routes_service.add_places_into_planned_route(
+        CANDIDATES, ROUTE, max_count=1)
+
+    between_stops = {frozenset(p) for p in fetched if set(p) <= set(ROUTE)}
+    assert between_stops == {frozenset(ROUTE[:2]), frozenset(ROUTE[1:])}
+    matrix = matrix_service.get_matrix(maps_client, ROUTE)
+    variant, = variants
+    assert variant['duration'] - variant['added_duration'] == (
+        pytest.approx(matrix[0, 1] + matrix[1, 2]))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_no_variants_are_asked_for(routes_service):
+    assert routes_service.add_places_into_planned_route(
+        CANDIDATES, ROUTE, max_count=0) == []
+
+
+def fail_once(search):
+    """Makes the second call of a search (or coroutine) fail."""
+    counter = itertools.count()
+
+    def flaky_search(*args, **kwargs):
+        if next(counter) == 1:
+            raise exceptions.TransportError('Connection reset.')
+        return search(*args, **kwargs)
+
+    async def aflaky_search(*args, **kwargs):
+        return await flaky_search(*args, **kwargs)
+
+    if asyncio.iscoroutinefunction(search):
+        return aflaky_search
+    return flaky_search
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_corridor_searches_are_left_out(routes_service):
+    places_service = routes_service.places_service
+    with call_budget() as budget:
+        complete = routes_service.get_places_near_route_sorted(
+            POLYLINE, max_count=None)
+    assert not budget.degraded
+
+    places_service.nearby_cache.local.clear()
+    places_service._search_nearby = fail_once(places_service._search_nearby)
+    with call_budget() as budget:
+        partial = routes_service.get_places_near_route_sorted(
+            POLYLINE, max_count=None)
+
+    assert budget.degraded
+    assert partial and set(partial) < set(complete)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_async_corridor_searches_are_left_out(
+        routes_service, async_maps_client):
+    nearby_cache = routes_service.places_service.nearby_cache
+    nearby_cache.asearch_places = fail_once(nearby_cache.asearch_places)
+
+    async def collect():
+        return [p async for batch in routes_service.aiter_places_near_route(
+            async_maps_client(), POLYLINE) for p in batch]
+
+    with call_budget() as budget:
+        places = asyncio.run(collect())
+
+    assert budget.degraded and places
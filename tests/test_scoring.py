@@ -0,0 +1,53 @@
+import pytest
+from users.models import User
+
+from geodata.services.scoring import (
+    CompiledPreferences,
+    PreferenceScorer,
+    get_compiled_preferences,
+)
+
+CAFE = {'id': 'a', 'types': ['cafe', 'food']}
+BAR = {'id': 'b', 'types': ['bar']}
+MUSEUM = {'id': 'c', 'types': ['museum']}
+
+
+def test_first_weighted_type_fixes_the_score():
+    preferences = CompiledPreferences(
+        {'cafe': True, 'food': False, 'bar': None})
+
+    assert preferences.weights == {'cafe': 1, 'food': -1}
+    assert preferences.score(['food', 'cafe']) == -1
+    assert preferences.score(['cafe', 'food']) == 1
+    assert preferences.score(['bar', 'museum']) == 0
+    # The same weights have the same digest, whatever their order.
+    assert preferences.digest == CompiledPreferences(
+        {'food': False, 'cafe': True}).digest
+
+
+@pytest.mark.django_db
+def test_compiled_preferences_follow_the_updates_of_the_user():
+    user = User.objects.create(
+        username='a', email='a@example.com',
+        preferences={'cafe': True, 'bar': False})
+    compiled = get_compiled_preferences(user)
+    assert get_compiled_preferences(User.objects.get(pk=user.pk)) is compiled
+
+    user.preferences = {'cafe': False, 'museum': True}
+    user.save()
+    updated = get_compiled_preferences(User.objects.get(pk=user.pk))
+
+    assert updated is not compiled
+    assert updated.weights == {'cafe': -1, 'museum': 1}
+    assert updated.digest != compiled.digest
+    scorer = PreferenceScorer(updated)
+    assert [scorer.score(p) for p in (CAFE, BAR, MUSEUM)] == [-1, 0, 1]
+
+
+def test_unsaved_users_are_not_cached():
+    user = User(preferences={'cafe': True})
+    compiled = get_compiled_preferences(user)
+
+    user.preferences = {'cafe': False}
+    assert get_compiled_preferences(user).weights == {'cafe': -1}
+    assert compiled.weights == {'cafe': 1}
@@ -0,0 +1,39 @@
+import pytest
+
+from geodata.serializers import RouteSuggestionsSerializer
+
+
+def validate_route(route):
+    serializer = RouteSuggestionsSerializer(data={'route': route})
+    return serializer.is_valid(), serializer
+
+
+def test_route_points_are_validated_as_locations():
+    valid, serializer = validate_route([[-6.2, 106.8], ['-6.21', 106.81]])
+
+    assert valid
+    assert serializer.validated_data['route'] == [
+        (-6.2, 106.8), (-6.21, 106.81)]
+
+
+def test_encoded_polylines_are_valid_routes():
+    valid, serializer = validate_route('_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    assert valid
+    assert serializer.validated_data['route'][0] == (38.5, -120.2)
+
+
+@pytest.mark.parametrize('route', [
+    [],
+    [[-6.2, 106.8], [-6.2]],
+    [[-6.2, 106.8], ['north', 106.8]],
+    [[-6.2, 106.8], [None, 106.8]],
+    [[-6.2, 106.8], [91.0, 106.8]],
+    [[-6.2, 106.8], [-6.2, 'nan']],
+    {'polyline': {}},
+])
+def test_invalid_routes_are_rejected(route):
+    valid, serializer = validate_route(route)
+
+    assert not valid
+    assert 'route' in serializer.errors
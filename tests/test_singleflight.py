@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from common.apis.budget import BudgetExceeded, call_budget
+from common.apis.ratelimit import PLACES_V2
+from common.apis.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_are_coalesced():
+    joined = []
+    flights = SingleFlight(on_join=joined.append)
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        time.sleep(0.1)
+        return {'key': key}
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(
+            lambda i: flights.do(i % 2, fetch, i % 2), range(8)))
+
+    assert sorted(calls) == [0, 1]
+    assert len(joined) == 6
+    assert results[0] is results[2]
+    # Nothing is cached once the calls are done.
+    flights.do(0, fetch, 0)
+    assert len(calls) == 3
+
+
+def test_errors_are_shared():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('upstream')
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flights.do, 'key', fail)
+        started.wait()
+        follower = executor.submit(flights.do, 'key', fail)
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_budget_refusals_are_not_shared(maps_client, backend):
+    started = threading.Event()
+
+    def lead():
+        with call_budget(max_calls=0):
+            started.set()
+            with pytest.raises(BudgetExceeded):
+                maps_client.place('fake_9_9_9', ['id'])
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(lead)
+        started.wait()
+        follower = executor.submit(maps_client.place, 'fake_9_9_9', ['id'])
+        leader.result()
+        assert follower.result()['id'] == 'fake_9_9_9'
+
+
+def test_async_calls_are_coalesced():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        flights = AsyncSingleFlight()
+        return await asyncio.gather(
+            *[flights.do('key', fetch) for _ in range(10)])
+
+    assert asyncio.run(main()) == ['result'] * 10
+    assert len(calls) == 1
+
+
+def test_async_call_survives_the_leader_giving_up():
+    async def main():
+        flights = AsyncSingleFlight()
+        leader = asyncio.ensure_future(
+            flights.do('key', asyncio.sleep, 0.05, 'result'))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(
+            flights.do('key', asyncio.sleep, 0.05, 'result'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower, flights._calls
+
+    result, calls = asyncio.run(main())
+    assert result == 'result'
+    assert calls == {}
+
+
+def test_identical_maps_requests_are_coalesced(maps_client, backend):
+    backend.latency = 0.1
+
+    with ThreadPoolExecutor(10) as executor:
+        results = list(executor.map(
+            lambda _: maps_client.place('fake_1_2_0', ['id', 'types']),
+            range(10)))
+
+    assert backend.calls[PLACES_V2] == 1
+    assert all(result == results[0] for result in results)
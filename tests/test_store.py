@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from geodata.models import Place
+from geodata.services.geo import haversine_distance, offset_location
+from geodata.services.scoring import CompiledPreferences
+from geodata.services.store import PlaceStore
+
+CENTER = (-6.2, 106.8)
+TYPES = ['cafe', 'bar', 'museum', 'park', 'bakery', 'point_of_interest']
+PREFERENCES = CompiledPreferences({'cafe': True, 'park': True, 'bar': False,
+                                   'bakery': None})
+CIRCLE = {'circle': {
+    'center': {'latitude': CENTER[0], 'longitude': CENTER[1]},
+    'radius': 800,
+}}
+RECTANGLE = {'rectangle': {
+    'low': dict(zip(('latitude', 'longitude'),
+                    offset_location(CENTER, -800, -800))),
+    'high': dict(zip(('latitude', 'longitude'),
+                     offset_location(CENTER, 800, 800))),
+}}
+
+
+@pytest.fixture
+def places(db):
+    rng = random.Random(0)
+    places = []
+    for i in range(300):
+        lat, lng = offset_location(
+            CENTER, rng.uniform(-1000, 1000), rng.uniform(-1000, 1000))
+        places.append({
+            'id': f'place{i:03d}',
+            'location': {'latitude': lat, 'longitude': lng},
+            'types': rng.sample(TYPES, rng.randint(0, 3)),
+        })
+    PlaceStore().ingest(places)
+    return places
+
+
+def get_expected(places):
+    """The `(place_id, score)` of the places in the circle, in order."""
+    keys = []
+    for place in places:
+        point = (place['location']['latitude'],
+                 place['location']['longitude'])
+        if haversine_distance(point, CENTER) <= 800:
+            keys.append((-PREFERENCES.score(place['types']), place['id']))
+    return [(place_id, -key) for key, place_id in sorted(keys)]
+
+
+@pytest.mark.parametrize('restriction', [CIRCLE, RECTANGLE])
+def test_pages_follow_the_preference_order(places, restriction):
+    store = PlaceStore()
+
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = store.query_area(
+            restriction, PREFERENCES, cursor=cursor, limit=25)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    results = [item for page in pages for item in page.items()]
+    assert all(len(page) == 25 for page in pages[:-1])
+    if restriction is CIRCLE:
+        assert results == get_expected(places)
+    assert {score for _, score in results} == {-1, 0, 1}
+    assert results == sorted(results, key=lambda r: (-r[1], r[0]))
+
+
+def test_offset_without_cursor(places):
+    store = PlaceStore()
+    first, _ = store.query_area(CIRCLE, PREFERENCES, limit=20)
+    second, _ = store.query_area(CIRCLE, PREFERENCES, offset=10, limit=20)
+
+    assert list(first)[10:] == list(second)[:10]
+
+
+def test_scores_match_the_compiled_preferences(places):
+    scores, _ = PlaceStore().query_area(RECTANGLE, PREFERENCES, limit=1000)
+
+    types = dict(Place.objects.values_list('place_id', 'types'))
+    assert len(scores) > 100
+    for place_id, score in scores.items():
+        assert score == PREFERENCES.score(types[place_id])
+
+
+def test_no_preferences(places):
+    scores, _ = PlaceStore().query_area(
+        CIRCLE, CompiledPreferences({}), limit=10)
+
+    assert list(scores) == sorted(scores)
+    assert set(scores.values()) == {0}
@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+from functools import partial
+
+import pytest
+from common.apis.budget import call_budget
+from common.apis.fake import SyntheticMaps
+from common.apis.ratelimit import PLACES_V2
+from googlemaps import exceptions
+
+from geodata.services.cache import NearbySearchCache
+from geodata.services.geo import haversine_distance
+from geodata.services.tiling import (
+    aiter_tiled_search,
+    cover_circle,
+    cover_polyline,
+    iter_tiled_search,
+)
+
+CENTER = (-6.2, 106.8)
+FIELDS = ['id', 'location', 'types']
+
+
+def get_places_in_circle(location, radius):
+    """The IDs of all the synthetic places in a circle."""
+    response = SyntheticMaps().search_nearby({
+        'locationRestriction': {'circle': {
+            'center': {'latitude': location[0], 'longitude': location[1]},
+            'radius': radius,
+        }},
+        'maxResultCount': 10 ** 6,
+    })
+    return {place['id'] for place in response['places']}
+
+
+@pytest.fixture
+def search(maps_client):
+    return partial(NearbySearchCache().search_places, maps_client,
+                   fields=FIELDS)
+
+
+def test_tiled_search_finds_every_place_once(search, backend):
+    batches = list(iter_tiled_search(search, CENTER, 600, max_calls=100))
+
+    ids = [place['id'] for batch in batches for place in batch]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == get_places_in_circle(CENTER, 600)
+    # A single search returns at most 20 places.
+    assert len(ids) > 20
+    assert backend.calls[PLACES_V2] <= 100
+
+
+def test_tiled_search_stays_within_max_calls(search, backend):
+    places = [p for batch in iter_tiled_search(search, CENTER, 600,
+                                               max_calls=3)
+              for p in batch]
+
+    assert backend.calls[PLACES_V2] == 3
+    for place in places:
+        point = place['location']
+        point = (point['latitude'], point['longitude'])
+        assert haversine_distance(point, CENTER) <= 600
+
+
+def test_truncated_tiled_search_is_degraded(search):
+    with call_budget() as budget:
+        for _ in iter_tiled_search(search, CENTER, 600, max_calls=3):
+            pass
+    assert budget.degraded
+
+    with call_budget() as budget:
+        for _ in iter_tiled_search(search, CENTER, 120000, max_calls=1):
+            pass
+    assert budget.degraded
+
+    with call_budget() as budget:
+        for _ in iter_tiled_search(search, CENTER, 600, max_calls=100):
+            pass
+    assert not budget.degraded
+
+
+def test_async_tiled_search_returns_leftover_circles(search):
+    async def collect(**kwargs):
+        async def asearch(location, radius):
+            return await asyncio.to_thread(search, location, radius)
+
+        return [p['id'] async for batch in aiter_tiled_search(
+            asearch, CENTER, 600, **kwargs) for p in batch]
+
+    leftover = []
+    first = asyncio.run(collect(max_calls=3, leftover=leftover))
+    assert leftover
+
+    rest = asyncio.run(collect(max_calls=100, circles=leftover))
+    assert set(first) | set(rest) == get_places_in_circle(CENTER, 600)
+
+
+@pytest.fixture
+def flaky_search(search):
+    """A search that fails for the second circle it is given."""
+    counter = itertools.count()
+    failed = []
+
+    def flaky_search(location, radius):
+        if next(counter) == 1:
+            failed.append((location, radius))
+            raise exceptions.TransportError('Connection reset.')
+        return search(location, radius)
+
+    flaky_search.failed = failed
+    return flaky_search
+
+
+def test_failed_tiles_are_left_out(flaky_search):
+    with call_budget() as budget:
+        ids = {p['id'] for batch in iter_tiled_search(
+            flaky_search, CENTER, 600, max_calls=100) for p in batch}
+
+    assert budget.degraded
+    assert ids and ids < get_places_in_circle(CENTER, 600)
+
+
+def test_failed_async_tiles_are_leftover(flaky_search):
+    async def asearch(location, radius):
+        return await asyncio.to_thread(flaky_search, location, radius)
+
+    async def collect(leftover):
+        return [p async for batch in aiter_tiled_search(
+            asearch, CENTER, 600, max_calls=100, leftover=leftover)
+            for p in batch]
+
+    leftover = []
+    with call_budget() as budget:
+        places = asyncio.run(collect(leftover))
+
+    assert budget.degraded
+    assert places and leftover == flaky_search.failed
+
+
+def test_cover_circle_stays_within_max_radius():
+    circles = cover_circle(CENTER, 120000, max_radius=50000)
+
+    assert len(circles) > 1
+    assert all(radius <= 50000 for _, radius in circles)
+
+
+def test_cover_polyline_covers_the_corridor():
+    polyline = [(-6.2 + 0.01 * i, 106.8 + 0.01 * i) for i in range(50)]
+
+    circles = cover_polyline(polyline, 500, max_circles=400)
+
+    assert len(circles) <= 400
+    for point in polyline:
+        assert any(haversine_distance(point, center) <= radius
+                   for center, radius in circles)
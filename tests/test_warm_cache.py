@@ -0,0 +1,109 @@
+from io import StringIO
+
+import pytest
+from common.apis.maps import MAX_RESTRICTION_RADIUS
+from common.apis.ratelimit import PLACES_V2
+from django.core.management import CommandError, call_command
+
+from geodata.management.commands.warm_cache import (
+    parse_hot_location,
+    read_hot_regions,
+)
+from geodata.serializers import quantize_circle
+from geodata.services.geo import haversine_distance
+from geodata.services.places import PlacesService
+
+# Lines of the query log, as written by the views.
+QUERY_LOG = '''\
+2026-10-18 12:00:00,123 -6.2,106.8,400
+2026-10-18 12:00:01,456 -6.20001,106.80001,390.0
+2026-10-18 12:00:02,789 -6.3,106.9,1000
+'''
+
+
+@pytest.fixture
+def query_log(tmp_path):
+    path = tmp_path / 'queries.log'
+    path.write_text(QUERY_LOG)
+    return str(path)
+
+
+@pytest.mark.parametrize('line, circle', [
+    ('2026-10-18 12:00:00,123 -6.2,106.8,400',
+     ((-6.2, 106.8), 400.0)),
+    ('2026-10-18 12:00:00,123 -6.2,106.8', ((-6.2, 106.8), 1000.0)),
+    ('-6.2,106.8,1000000', ((-6.2, 106.8), MAX_RESTRICTION_RADIUS)),
+    ('48.85,2.35 ', ((48.85, 2.35), 1000.0)),
+    ('2026-10-18 12:00:00,123 restarted', None),
+])
+def test_parse_hot_location(line, circle):
+    assert parse_hot_location(line, 1000.0) == circle
+
+
+@pytest.mark.parametrize('location, radius', [
+    ((-6.2, 106.8), 400), ((48.85, 2.35), 1000), ((0.0, 0.0), 30000)])
+def test_quantized_circles_cover_the_circle(location, radius):
+    center, bucket_radius = quantize_circle(location, radius)
+
+    assert bucket_radius >= radius
+    assert haversine_distance(center, location) <= radius / 10
+
+
+def test_nearly_the_same_queries_are_counted_together(query_log):
+    regions = read_hot_regions([query_log], 1000.0)
+
+    assert regions == {
+        quantize_circle((-6.2, 106.8), 400): 2,
+        quantize_circle((-6.3, 106.9), 1000): 1,
+    }
+    assert list(read_hot_regions([query_log], 1000.0, tail=1)) == [
+        quantize_circle((-6.3, 106.9), 1000)]
+
+
+def test_configured_locations_come_first(query_log, settings):
+    settings.GEODATA_HOT_LOCATIONS = [(48.85, 2.35), (-6.3, 106.9, 1000)]
+
+    regions = read_hot_regions([query_log], 500.0)
+
+    # As hot as the hottest logged region, plus their own queries.
+    paris = quantize_circle((48.85, 2.35), 500.0)
+    assert regions[paris] == 2
+    assert regions[quantize_circle((-6.3, 106.9), 1000)] == 3
+    assert read_hot_regions([], 500.0) == {
+        paris: 1, quantize_circle((-6.3, 106.9), 1000): 1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_warm_cache_command(tmp_path, maps_client, backend, monkeypatch):
+    # Two overlapping regions.
+    locations = tmp_path / 'locations.txt'
+    locations.write_text('-6.2,106.8,200\n-6.2,106.8,300\n')
+    get_places_details = PlacesService.get_places_details
+    refreshed = []
+
+    def spy(self, place_ids, fields):
+        refreshed.extend(place_ids)
+        return get_places_details(self, place_ids, fields)
+
+    monkeypatch.setattr(PlacesService, 'get_places_details', spy)
+    stdout = StringIO()
+    call_command(
+        'warm_cache', locations=[str(locations)], workers=2, stdout=stdout)
+
+    assert 'Warmed 2 of 2 regions' in stdout.getvalue()
+    assert refreshed
+    # Places found in both regions are only refreshed once.
+    assert len(refreshed) == len(set(refreshed))
+    calls = backend.calls[PLACES_V2]
+
+    # The searches are cached, and the command refreshes them again.
+    call_command('warm_cache', locations=[str(locations)], stdout=StringIO())
+    assert backend.calls[PLACES_V2] == 2 * calls
+
+
+def test_warm_cache_needs_hot_locations(settings):
+    settings.QUERY_LOG = None
+    settings.GEODATA_HOT_LOCATIONS = []
+
+    with pytest.raises(CommandError, match='No hot locations'):
+        call_command('warm_cache', stdout=StringIO())
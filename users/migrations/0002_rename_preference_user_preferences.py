@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='user',
+            old_name='preference',
+            new_name='preferences',
+        ),
+    ]